@@ -2,7 +2,9 @@ import streamlit as st
 import google.generativeai as genai
 import tempfile
 import os
+import shutil
 import pandas as pd
+import numpy as np
 import json
 import io
 import openpyxl
@@ -13,6 +15,29 @@ import traceback
 import time
 from google.generativeai.types import GenerationConfig
 import zipfile
+import threading
+import queue
+import contextlib
+import contextvars
+import uuid
+import secrets
+import zlib
+import itertools
+import sys
+import hashlib
+import sqlite3
+import xml.sax
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import XMLGenerator, XMLFilterBase
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from collections import deque
+from datetime import timedelta
+from google.generativeai import caching
+
+try:
+    from pypdf import PdfReader  # Optional: local text layer of digital PDFs
+except ImportError:
+    PdfReader = None
 
 # --- CONSTANTS & CONFIGURATION ---
 COMPANY_NAME = "Rüttenscheid Baukonzepte GmbH"
@@ -132,42 +157,1348 @@ QUALITÄTSKRITERIEN:
 Starte jetzt die Analyse und gib NUR das JSON-Array zurück!
 """
 
-# Secondary prompt if first attempt returns zero prices
-PRICING_CORRECTION_PROMPT = """
-Du bist Kalkulations-Experte. Die folgenden Positionen haben teilweise Preis 0.00 oder unrealistische Preise.
-
-AUFGABE: Korrigiere ALLE Preise und stelle sicher, dass jede Position einen realistischen Marktpreis hat.
+# Static instructions for correcting flagged prices - flagged positions follow as compact lines
+PRICING_CORRECTION_PROMPT = """Du bist Kalkulations-Experte. Die folgenden Positionen haben fehlende oder auffällige Einheitspreise.
 
-REGELN:
+AUFGABE: Gib für JEDE Position einen realistischen EINHEITSPREIS (EP) in EUR.
 
-JEDE Position MUSS unit_price > 0 haben
-Preise müssen marktgerecht und wettbewerbsfähig sein
-Berücksichtige Material, Lohn, Geräte, Transport, BGK, AGK, W&G
-Orientierung an typischen Baupreisen 2024/2025
-PREISREFERENZEN:
+EINGABE je Zeile:
+Nummer | OZ | Beschreibung | Menge Einheit | aktueller EP | Auffälligkeit | üblicher EP ähnlicher Positionen
 
-Einfache Arbeiten (Aushub, Abbruch): 10,50-50,75 EUR
-Mittlere Komplexität (Mauerwerk, Schalung): 50,25-150,80 EUR
-Hohe Komplexität (Beton, Bewehrung): 150,50-300,75 EUR
-Spezialleistungen (Abdichtung, Dämmung): 300,00+ EUR
+REGELN:
+- JEDE Position MUSS unit_price > 0 haben
+- Preise müssen marktgerecht und wettbewerbsfähig sein
+- Berücksichtige Material, Lohn, Geräte, Transport, BGK, AGK, W&G
+- Orientierung an typischen Baupreisen 2024/2025
+- Der "übliche EP" stammt aus eigenen früheren Preisen und dem Dokument - weiche nur begründet davon ab
+- Ist der aktuelle EP plausibel (z.B. Sonderleistung), gib ihn unverändert zurück
 
 ⚠️ WICHTIG:
 • Alle Preise MÜSSEN Cent-Beträge haben (z.B. 45.50, 125.75, 250.25)
 • NIEMALS nur runde Zahlen wie 100.00 oder 250.00!
-• Realistische Baupreise haben IMMER Nachkommastellen!
-Eingabe-Positionen:
-{positions_json}
 
-AUSGABE: NUR das vollständige JSON-Array mit ALLEN Positionen und korrigierten Preisen.
-Keine Erklärungen, nur JSON!
+Ausgabe NUR als JSON-Array:
+[{"pos": "Nummer", "unit_price": Preis}, ...]
 """
 
+# Static instructions for batch pricing - sent once as cached context, positions follow per batch
+PRICING_BATCH_PROMPT = """Du bist ein erfahrener Baukalkulator. Gib für JEDE Position den EINHEITSPREIS (EP) in EUR.
+
+⚠️ KRITISCH - EINHEITSPREIS (EP):
+- Gib NUR den EINHEITSPREIS pro Einheit zurück!
+- Bei "140 St" → Preis für 1 Stück (z.B. 150 EUR/St)
+- Bei "1 psch" → Pauschalpreis für die gesamte Leistung
+- Bei "psch" mit Mengenangaben im Text (z.B. "31.200 MeterWochen") → Multipliziere!
+
+TYPISCHE EINHEITSPREISE:
+- Verkehrszeichen (St): 100-200 EUR/St
+- Baustelleneinrichtung (psch): 5.000-15.000 EUR
+- Erdaushub (m³): 12-18 EUR/m³
+- Asphalt (m²): 25-45 EUR/m²
+- Beton C25/30 (m³): 180-260 EUR/m³
+- Bauzaun mit MeterWochen (psch): Berechne aus Mengenangabe!
+
+REFERENZEN:
+- "Referenz"-Zeilen sind eigene, bestätigte Preise ähnlicher früherer Positionen
+- Orientiere dich daran und passe nur an, wo sich die Leistung tatsächlich unterscheidet
+
+Ausgabe NUR als JSON-Array:
+[{"pos": "Nummer", "unit_price": Preis}, ...]
+"""
+
+# Response schemas for constrained JSON output (application/json)
+POSITION_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "pos": {"type": "string"},
+            "description": {"type": "string"},
+            "quantity": {"type": "number"},
+            "unit": {"type": "string"},
+            "unit_price": {"type": "number"},
+        },
+        "required": ["pos", "description", "quantity", "unit", "unit_price"],
+    },
+}
+PRICE_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "pos": {"type": "string"},
+            "unit_price": {"type": "number"},
+        },
+        "required": ["pos", "unit_price"],
+    },
+}
+
+# --- METRICS & TRACING ---
+# Local working directory for metrics, traces and other runtime data (not part of the repo)
+DATA_DIR = os.environ.get("KALKULATION_DATA_DIR", ".kalkulation")
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+PROMETHEUS_FILE = os.path.join(METRICS_DIR, "kalkulation.prom")  # For node_exporter textfile collector
+TRACE_LOG_FILE = os.path.join(METRICS_DIR, "trace.jsonl")
+
+# Histogram buckets: stage durations in seconds, token counts per model call
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000)
+
+# Trace ID of the pipeline run in the current script thread
+_current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms, shared by all Streamlit sessions.
+    Rendered in Prometheus text format and mirrored as a JSONL trace log.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge to the current value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter by value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """Add one observation to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self.histograms[key] = hist
+            # Prometheus buckets are cumulative (le = less or equal)
+            for idx, bound in enumerate(hist["buckets"]):
+                if value <= bound:
+                    hist["counts"][idx] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def write_trace(self, record):
+        """Append one span record to the JSONL trace log"""
+        try:
+            line = json.dumps(record, ensure_ascii=False, default=str)
+            with self.lock:
+                os.makedirs(METRICS_DIR, exist_ok=True)
+                with open(TRACE_LOG_FILE, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"⚠️ Could not write trace log: {e}")
+
+    def to_prometheus_text(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        def format_labels(label_items, extra=None):
+            items = list(label_items) + (extra or [])
+            if not items:
+                return ""
+            parts = []
+            for k, v in items:
+                v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                parts.append(f'{k}="{v}"')
+            return "{" + ",".join(parts) + "}"
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, label_items), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{format_labels(label_items)} {value}")
+
+            for (name, label_items), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} gauge")
+                    typed.add(name)
+                lines.append(f"{name}{format_labels(label_items)} {value}")
+
+            for (name, label_items), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, count in zip(hist["buckets"], hist["counts"]):
+                    lines.append(f"{name}_bucket{format_labels(label_items, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{format_labels(label_items, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{format_labels(label_items)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{format_labels(label_items)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics_registry():
+    """Return the process-wide metrics registry (survives reruns and is shared across sessions)"""
+    return MetricsRegistry()
+
+def start_trace(document_name=""):
+    """
+    Start a new trace for one pipeline run. All following spans in this thread carry its ID.
+    """
+    trace_id = uuid.uuid4().hex[:16]
+    _current_trace_id.set(trace_id)
+    get_metrics_registry().write_trace({
+        "ts": datetime.now().isoformat(timespec='milliseconds'),
+        "trace_id": trace_id,
+        "event": "trace_start",
+        "document": document_name,
+    })
+    return trace_id
+
+@contextlib.contextmanager
+def metrics_span(stage, **labels):
+    """
+    Time a pipeline stage, record it in the duration histogram and the trace log.
+    Labels become Prometheus labels; extra keys set on the yielded dict only go to the trace.
+    """
+    registry = get_metrics_registry()
+    span = {"trace_id": _current_trace_id.get(), "stage": stage, **labels}
+    span_start = time.time()
+    status = "ok"
+    try:
+        yield span
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        span["duration"] = time.time() - span_start
+        span["status"] = status
+        registry.observe("kalkulation_stage_duration_seconds", span["duration"], stage=stage, status=status, **labels)
+        registry.write_trace({"ts": datetime.now().isoformat(timespec='milliseconds'), **span})
+
+def record_token_usage(response, model_name, stage, span=None):
+    """
+    Read usage_metadata from a Gemini response and count input/output tokens.
+    Returns tuple: (input_tokens, output_tokens)
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return 0, 0
+    input_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0  # Part of input_tokens
+
+    registry = get_metrics_registry()
+    registry.inc("kalkulation_tokens_total", input_tokens, model=model_name, stage=stage, direction="input")
+    registry.inc("kalkulation_tokens_total", output_tokens, model=model_name, stage=stage, direction="output")
+    if cached_tokens:
+        registry.inc("kalkulation_tokens_total", cached_tokens, model=model_name, stage=stage, direction="cached")
+    registry.observe("kalkulation_call_tokens", input_tokens + output_tokens, buckets=TOKEN_BUCKETS, model=model_name, stage=stage)
+
+    cost = record_cost(model_name, stage, input_tokens, output_tokens, cached_tokens)
+    if span is not None:
+        span["input_tokens"] = input_tokens
+        span["output_tokens"] = output_tokens
+        span["cached_tokens"] = cached_tokens
+        span["cost_usd"] = round(cost, 6)
+    return input_tokens, output_tokens
+
+def flush_metrics():
+    """Write the Prometheus text file atomically so a scraper never sees a partial file"""
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        tmp_path = PROMETHEUS_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(get_metrics_registry().to_prometheus_text())
+        os.replace(tmp_path, PROMETHEUS_FILE)
+    except Exception as e:
+        print(f"⚠️ Could not write metrics file: {e}")
+
+# --- COST ACCOUNTING & BUDGET ---
+# Estimated list prices in USD per 1M tokens: (input, output). Adjust when Google changes pricing.
+MODEL_PRICING = {
+    'gemini-2.5-flash':      (0.30, 2.50),
+    'gemini-2.5-flash-lite': (0.10, 0.40),
+    'gemini-2.5-pro':        (1.25, 10.00),
+    'gemini-2.0-flash':      (0.10, 0.40),
+    'gemini-2.0-flash-lite': (0.075, 0.30),
+    'gemini-3-pro':          (2.00, 12.00),
+    'gemini-3-flash':        (0.50, 3.00),
+}
+DEFAULT_MODEL_PRICING = (1.25, 10.00)  # Unknown models are priced conservatively
+
+# Optional budgets in USD (0 = no limit); the per-document budget can be overridden in the sidebar
+BUDGET_PER_DOCUMENT_USD = float(os.environ.get("KALKULATION_BUDGET_PER_DOCUMENT_USD", "0") or 0)
+BUDGET_PER_DAY_USD = float(os.environ.get("KALKULATION_BUDGET_PER_DAY_USD", "0") or 0)
+BUDGET_TIGHT_RATIO = 0.8  # From 80% usage on: cheaper models only, optional AI calls skipped
+COST_LEDGER_FILE = os.path.join(DATA_DIR, "cost_ledger.jsonl")
+
+# Optional stages that are skipped first when the budget gets tight
+OPTIONAL_AI_STAGES = ("pricing_fallback", "price_correction")
+
+# Cost tracker of the pipeline run in the current script thread
+_current_cost_tracker = contextvars.ContextVar("current_cost_tracker", default=None)
+
+class BudgetExceededError(Exception):
+    """Raised when an AI call would exceed the per-document or per-day budget."""
+    pass
+
+def estimate_call_cost(model_name, input_tokens, output_tokens, cached_tokens=0):
+    """Estimated cost in USD for one model call (cached input tokens at the reduced rate)"""
+    price_in, price_out = MODEL_PRICING.get(model_name, DEFAULT_MODEL_PRICING)
+    uncached_tokens = max(input_tokens - cached_tokens, 0)
+    input_cost = uncached_tokens * price_in + cached_tokens * price_in * CACHED_TOKEN_PRICE_RATIO
+    return (input_cost + output_tokens * price_out) / 1_000_000
+
+class CostTracker:
+    """
+    Accumulates tokens and estimated cost per (model, stage) for one pipeline run.
+    """
+    def __init__(self, budget_usd=0.0):
+        self.lock = threading.Lock()
+        self.budget_usd = budget_usd or 0.0
+        self.entries = {}
+        self.skipped_stages = []
+        self.budget_exceeded = False
+        self.prefilter_tokens = 0  # Estimated document tokens before the local pre-filter
+        self.prefilter_saved_tokens = 0  # ... of which were dropped as boilerplate
+        self.queue_wait_seconds = 0.0  # Time model calls waited for an admission slot
+
+    def add(self, model_name, stage, input_tokens, output_tokens, cached_tokens=0):
+        cost = estimate_call_cost(model_name, input_tokens, output_tokens, cached_tokens)
+        with self.lock:
+            entry = self.entries.setdefault((model_name, stage), {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0})
+            entry["calls"] += 1
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["cost_usd"] += cost
+        return cost
+
+    @property
+    def total_cost(self):
+        with self.lock:
+            return sum(e["cost_usd"] for e in self.entries.values())
+
+    @property
+    def total_tokens(self):
+        """Returns tuple: (input_tokens, output_tokens)"""
+        with self.lock:
+            return (sum(e["input_tokens"] for e in self.entries.values()),
+                    sum(e["output_tokens"] for e in self.entries.values()))
+
+    def summary_df(self):
+        """Per model and stage breakdown for display"""
+        with self.lock:
+            rows = [{"Modell": model_name, "Stufe": stage, "Aufrufe": e["calls"],
+                     "Input-Tokens": e["input_tokens"], "Output-Tokens": e["output_tokens"],
+                     "Kosten (USD)": round(e["cost_usd"], 4)}
+                    for (model_name, stage), e in sorted(self.entries.items())]
+        return pd.DataFrame(rows)
+
+class CostLedger:
+    """
+    Process-wide daily spend, persisted to disk so the per-day budget survives restarts.
+    Every model call appends one JSON line (date, model, stage, cost); the daily totals are
+    summed from these lines on start and kept in memory.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.daily = {}
+        try:
+            # Daily totals of the former JSON ledger (rewritten on every call)
+            with open(os.path.splitext(path)[0] + ".json", 'r', encoding='utf-8') as f:
+                self.daily = {day: float(cost) for day, cost in json.load(f).items()}
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError, ValueError):
+            pass
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.daily[entry["date"]] = self.daily.get(entry["date"], 0.0) + float(entry["cost_usd"])
+                    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                        continue  # Line cut off by a crash while appending
+        except FileNotFoundError:
+            pass
+
+    def add(self, cost_usd, model_name=None, stage=None):
+        today = datetime.now().strftime('%Y-%m-%d')
+        line = json.dumps({"date": today, "time": datetime.now().strftime('%H:%M:%S'), "model": model_name,
+                           "stage": stage, "cost_usd": cost_usd}) + "\n"
+        with self.lock:
+            self.daily[today] = self.daily.get(today, 0.0) + cost_usd
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except Exception as e:
+                print(f"⚠️ Could not write cost ledger: {e}")
+
+    def spent_today(self):
+        with self.lock:
+            return self.daily.get(datetime.now().strftime('%Y-%m-%d'), 0.0)
+
+@st.cache_resource
+def get_cost_ledger():
+    """Return the process-wide daily cost ledger"""
+    return CostLedger(COST_LEDGER_FILE)
+
+def start_cost_tracking(budget_usd=None):
+    """
+    Start cost accounting for one pipeline run in this thread.
+    """
+    tracker = CostTracker(BUDGET_PER_DOCUMENT_USD if budget_usd is None else budget_usd)
+    _current_cost_tracker.set(tracker)
+    return tracker
+
+def get_current_cost_tracker():
+    """Return the cost tracker of the current run (None outside a pipeline run)"""
+    return _current_cost_tracker.get()
+
+def record_cost(model_name, stage, input_tokens, output_tokens, cached_tokens=0):
+    """Book a call on the current run, the daily ledger and the cost metric"""
+    tracker = get_current_cost_tracker()
+    if tracker is not None:
+        cost = tracker.add(model_name, stage, input_tokens, output_tokens, cached_tokens)
+    else:
+        cost = estimate_call_cost(model_name, input_tokens, output_tokens, cached_tokens)
+    get_cost_ledger().add(cost, model_name, stage)
+    get_metrics_registry().inc("kalkulation_cost_usd_total", cost, model=model_name, stage=stage)
+    return cost
+
+def get_budget_status():
+    """
+    Check document and daily budget.
+    Returns "ok", "tight" (>= 80% used) or "exhausted".
+    """
+    ratios = []
+    tracker = get_current_cost_tracker()
+    if tracker is not None and tracker.budget_usd > 0:
+        ratios.append(tracker.total_cost / tracker.budget_usd)
+    if BUDGET_PER_DAY_USD > 0:
+        ratios.append(get_cost_ledger().spent_today() / BUDGET_PER_DAY_USD)
+
+    usage = max(ratios) if ratios else 0.0
+    if usage >= 1.0:
+        return "exhausted"
+    if usage >= BUDGET_TIGHT_RATIO:
+        return "tight"
+    return "ok"
+
+def budget_allows_stage(stage):
+    """
+    Decide whether an AI call for this stage may run under the current budget.
+    Optional stages are skipped once the budget is tight; skips are recorded on the run.
+    """
+    status = get_budget_status()
+    allowed = status == "ok" or (status == "tight" and stage not in OPTIONAL_AI_STAGES)
+    if not allowed:
+        tracker = get_current_cost_tracker()
+        if tracker is not None:
+            tracker.skipped_stages.append(stage)
+            if status == "exhausted":
+                tracker.budget_exceeded = True
+        get_metrics_registry().inc("kalkulation_budget_skips_total", stage=stage, status=status)
+        print(f"💶 Budget {status} - skipping AI call for stage '{stage}'")
+    return allowed
+
+# --- CONTEXT CACHING ---
+# Static prompt prefixes are registered once per model as Gemini cached content
+CONTEXT_CACHE_TTL_MINUTES = 60
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 300   # Extend TTL when less than 5 min remain
+CONTEXT_CACHE_RETRY_AFTER_SECONDS = 3600     # Do not retry models that rejected caching for 1h
+# Minimum prompt size Gemini accepts for cached content (approximate tokens)
+CONTEXT_CACHE_MIN_TOKENS = {'gemini-2.5-pro': 4096, 'gemini-3-pro': 4096}
+CONTEXT_CACHE_DEFAULT_MIN_TOKENS = 1024
+CACHED_TOKEN_PRICE_RATIO = 0.25  # Cached input tokens are billed at roughly a quarter of the input price
+
+class PromptCacheManager:
+    """
+    Process-wide registry of cached prompt prefixes, keyed by (model, prompt hash).
+    Handles TTL refresh and remembers models where caching is unavailable. The create/update
+    API calls hold only the lock of their own key, so other prompts are not blocked meanwhile.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.entries = {}
+
+    def get_model(self, model_name, static_prompt, generation_config=None):
+        """
+        Return a GenerativeModel bound to the cached prefix, or None to send the prompt inline.
+        """
+        # Generous estimate (German text ~3 chars/token); borderline prompts are tried and the
+        # server's rejection is remembered via unavailable_until
+        min_tokens = CONTEXT_CACHE_MIN_TOKENS.get(model_name, CONTEXT_CACHE_DEFAULT_MIN_TOKENS)
+        if len(static_prompt) // 3 < min_tokens:
+            # Too small for explicit caching - Gemini's implicit prefix caching still applies
+            return None
+
+        key = (model_name, hashlib.sha256(static_prompt.encode('utf-8')).hexdigest()[:16])
+        registry = get_metrics_registry()
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            now = time.time()  # After waiting for a create/update of the same key
+            entry = self.entries.get(key)
+            if entry and entry.get("unavailable_until", 0) > now:
+                return None
+
+            try:
+                if entry and entry.get("cache") is not None and entry["expires"] - now > CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                    registry.inc("kalkulation_context_cache_total", model=model_name, result="hit")
+                elif entry and entry.get("cache") is not None and entry["expires"] > now:
+                    entry["cache"].update(ttl=timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES))
+                    entry["expires"] = now + CONTEXT_CACHE_TTL_MINUTES * 60
+                    registry.inc("kalkulation_context_cache_total", model=model_name, result="refreshed")
+                else:
+                    cache = caching.CachedContent.create(
+                        model=f"models/{model_name}",
+                        display_name=f"kalkulation-{key[1]}",
+                        system_instruction=static_prompt,
+                        ttl=timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
+                    )
+                    entry = {"cache": cache, "expires": now + CONTEXT_CACHE_TTL_MINUTES * 60}
+                    self.entries[key] = entry
+                    registry.inc("kalkulation_context_cache_total", model=model_name, result="created")
+                    print(f"🗄️ Context cache created for {model_name}: {cache.name}")
+
+                return genai.GenerativeModel.from_cached_content(entry["cache"], generation_config=generation_config)
+
+            except Exception as e:
+                print(f"⚠️ Context caching unavailable for {model_name}: {str(e)[:100]}")
+                self.entries[key] = {"cache": None, "unavailable_until": now + CONTEXT_CACHE_RETRY_AFTER_SECONDS}
+                registry.inc("kalkulation_context_cache_total", model=model_name, result="unavailable")
+                return None
+
+    def invalidate(self, model_name, static_prompt):
+        """Forget a cache entry (e.g. after it expired or was deleted on the server)"""
+        key = (model_name, hashlib.sha256(static_prompt.encode('utf-8')).hexdigest()[:16])
+        with self.lock:
+            self.entries.pop(key, None)
+
+@st.cache_resource
+def get_prompt_cache():
+    """Return the process-wide prompt cache manager"""
+    return PromptCacheManager()
+
+# --- ADMISSION CONTROL ---
+# Concurrent model calls for the whole server (all Streamlit sessions together)
+AI_MAX_CONCURRENT_CALLS = int(os.environ.get("KALKULATION_AI_MAX_CONCURRENT", "4"))
+ADMISSION_WAIT_SAMPLES = 100  # Recent waits shown in the UI
+
+_current_session_id = contextvars.ContextVar("current_session_id", default="default")
+
+def set_session_owner(session_id):
+    """Attribute the model calls of this thread (and threads started from it) to a session"""
+    _current_session_id.set(session_id)
+
+def is_throttling_error(error):
+    """429/503 responses: the API wants fewer concurrent requests"""
+    error_str = str(error)
+    return ('429' in error_str or '503' in error_str or 'RESOURCE_EXHAUSTED' in error_str
+            or 'overloaded' in error_str.lower())
+
+class AdmissionController:
+    """
+    Process-wide limit on concurrent model calls, shared by all Streamlit sessions.
+    Waiting calls are admitted fair-share: the waiting session with the fewest calls in flight
+    goes first (round-robin on ties), so a small LV is not queued behind another session's large job.
+    429/503 responses halve the limit, successes raise it slowly back to the maximum (AIMD),
+    so a rate-limited API is not hit by a storm of retries.
+    """
+    def __init__(self, max_concurrent=AI_MAX_CONCURRENT_CALLS):
+        self.cond = threading.Condition()
+        self.max_concurrent = max(1, max_concurrent)
+        self.limit = float(self.max_concurrent)
+        self.active = {}     # session -> calls in flight
+        self.waiting = {}    # session -> deque of tickets, FIFO within a session
+        self.turn = deque()  # Sessions with waiting calls in round-robin order
+        self.waits = deque(maxlen=ADMISSION_WAIT_SAMPLES)
+
+    def _next_session(self):
+        # min() keeps the first of equal sessions, i.e. round-robin order on ties
+        return min(self.turn, key=lambda session_id: self.active.get(session_id, 0)) if self.turn else None
+
+    def _publish(self):
+        registry = get_metrics_registry()
+        registry.set_gauge("kalkulation_admission_queue_depth", sum(len(q) for q in self.waiting.values()))
+        registry.set_gauge("kalkulation_admission_active_calls", sum(self.active.values()))
+        registry.set_gauge("kalkulation_admission_limit", int(self.limit))
+
+    def acquire(self, session_id):
+        """Block until this session may start a model call. Returns seconds waited."""
+        ticket = object()
+        start = time.time()
+        with self.cond:
+            tickets = self.waiting.setdefault(session_id, deque())
+            if session_id not in self.turn:
+                self.turn.append(session_id)
+            tickets.append(ticket)
+            self._publish()
+            while not (sum(self.active.values()) < int(self.limit)
+                       and self._next_session() == session_id and tickets[0] is ticket):
+                self.cond.wait()
+            tickets.popleft()
+            self.turn.remove(session_id)
+            if tickets:
+                self.turn.append(session_id)  # Back of the line for its next call
+            else:
+                del self.waiting[session_id]
+            self.active[session_id] = self.active.get(session_id, 0) + 1
+            waited = time.time() - start
+            self.waits.append(waited)
+            self._publish()
+            self.cond.notify_all()  # Another slot may still be free for the next session
+        return waited
+
+    def release(self, session_id, throttled=False):
+        with self.cond:
+            self.active[session_id] -= 1
+            if not self.active[session_id]:
+                del self.active[session_id]
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                print(f"🚦 API throttling - concurrent model calls limited to {int(self.limit)}")
+            else:
+                self.limit = min(float(self.max_concurrent), self.limit + 1.0 / self.limit)
+            self._publish()
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, stage):
+        """Hold one model call slot for the current session; throttling errors lower the limit"""
+        session_id = _current_session_id.get()
+        waited = self.acquire(session_id)
+        get_metrics_registry().observe("kalkulation_admission_wait_seconds", waited, stage=stage)
+        cost_tracker = get_current_cost_tracker()
+        if cost_tracker is not None:
+            cost_tracker.queue_wait_seconds += waited
+        if waited >= 1.0:
+            print(f"🚦 Waited {waited:.1f}s for a model call slot ({stage})")
+        throttled = False
+        try:
+            yield waited
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            raise
+        finally:
+            self.release(session_id, throttled)
+
+    def status(self, session_id=None):
+        """Returns dict with limit, active and waiting calls (total and for session_id) and recent waits"""
+        with self.cond:
+            waits = sorted(self.waits)
+            return {
+                "limit": int(self.limit),
+                "max": self.max_concurrent,
+                "active": sum(self.active.values()),
+                "waiting": sum(len(q) for q in self.waiting.values()),
+                "sessions": len(set(self.active) | set(self.waiting)),
+                "session_active": self.active.get(session_id, 0),
+                "session_waiting": len(self.waiting.get(session_id, ())),
+                "wait_p50": latency_percentile(waits, 0.5) or 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+@st.cache_resource
+def get_admission_controller():
+    """Return the process-wide admission controller (shared by all sessions)"""
+    return AdmissionController()
+
+# --- REQUEST HEDGING ---
+# Optional: fire a duplicate request at the next healthy model when a call is slower than usual
+HEDGE_ENABLED = os.environ.get("KALKULATION_HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("KALKULATION_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = 20          # Learn the latency distribution before hedging
+HEDGE_WINDOW_SIZE = 200         # Recent calls per (model, stage) used for the percentile
+HEDGE_MIN_DELAY_SECONDS = 2.0   # Never hedge earlier than this
+HEDGE_MAX_WORKERS = 8
+MODEL_UNHEALTHY_SECONDS = 60    # Models answering 429/503 are not used as hedge target for this long
+
+def latency_percentile(samples, q):
+    """Percentile q (0-1) of a list of durations, nearest-rank"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class LatencyTracker:
+    """
+    Process-wide record of recent model call latencies and model health.
+    Primary latencies drive the hedge delay; effective latencies show what users actually waited.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.primary = {}      # (model, stage) -> deque of call durations without hedging effect
+        self.effective = {}    # stage -> deque of durations until the first valid response
+        self.calls = {}        # stage -> deque of booleans (True = hedge fired)
+        self.unhealthy_until = {}
+
+    def record_primary(self, model_name, stage, duration):
+        with self.lock:
+            self.primary.setdefault((model_name, stage), deque(maxlen=HEDGE_WINDOW_SIZE)).append(duration)
+
+    def record_effective(self, stage, duration, hedged):
+        with self.lock:
+            self.effective.setdefault(stage, deque(maxlen=HEDGE_WINDOW_SIZE)).append(duration)
+            self.calls.setdefault(stage, deque(maxlen=HEDGE_WINDOW_SIZE)).append(hedged)
+            primary_samples = [d for (_, sample_stage), samples in self.primary.items() if sample_stage == stage for d in samples]
+            effective_p99 = latency_percentile(list(self.effective[stage]), 0.99)
+            primary_p99 = latency_percentile(primary_samples, 0.99)
+            hedge_rate = sum(self.calls[stage]) / len(self.calls[stage])
+
+        registry = get_metrics_registry()
+        registry.set_gauge("kalkulation_hedge_rate", round(hedge_rate, 4), stage=stage)
+        registry.set_gauge("kalkulation_call_latency_p99_seconds", round(effective_p99, 3), stage=stage, kind="effective")
+        if primary_p99 is not None:
+            registry.set_gauge("kalkulation_call_latency_p99_seconds", round(primary_p99, 3), stage=stage, kind="primary")
+            registry.set_gauge("kalkulation_hedge_p99_improvement_seconds", round(primary_p99 - effective_p99, 3), stage=stage)
+
+    def hedge_delay(self, model_name, stage):
+        """Seconds to wait before hedging, or None while there are too few samples"""
+        with self.lock:
+            samples = list(self.primary.get((model_name, stage), ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(latency_percentile(samples, HEDGE_PERCENTILE), HEDGE_MIN_DELAY_SECONDS)
+
+    def mark_unhealthy(self, model_name):
+        with self.lock:
+            self.unhealthy_until[model_name] = time.time() + MODEL_UNHEALTHY_SECONDS
+
+    def is_healthy(self, model_name):
+        with self.lock:
+            return self.unhealthy_until.get(model_name, 0) <= time.time()
+
+@st.cache_resource
+def get_latency_tracker():
+    """Return the process-wide latency tracker"""
+    return LatencyTracker()
+
+@st.cache_resource
+def get_hedge_executor():
+    """Thread pool for hedged requests; abandoned calls finish in the background"""
+    return ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+def generate_with_model(model_name, contents, stage, static_prompt=None, generation_config=None, attempt=1, hedge=False):
+    """
+    One generate_content call on one model, recorded as a "model_call" span with token usage.
+    The call waits for a slot of the process-wide admission controller first.
+    Raises if the response carries no text, so only valid responses count as success.
+    """
+    with get_admission_controller().slot(stage), metrics_span("model_call", model=model_name, attempt=str(attempt), call_stage=stage,
+                      hedge="true" if hedge else "false") as span:
+        model = get_prompt_cache().get_model(model_name, static_prompt) if static_prompt else None
+        if model is not None:
+            span["context_cache"] = True
+            request_contents = contents
+        else:
+            model = genai.GenerativeModel(model_name)
+            request_contents = [static_prompt] + list(contents) if static_prompt else contents
+        response = model.generate_content(request_contents, generation_config=generation_config)
+        record_token_usage(response, model_name, stage, span=span)
+        _ = response.text  # Raises ValueError for blocked/empty candidates
+    return response
+
+def hedged_generate(primary_model, hedge_candidates, contents, stage, static_prompt=None, generation_config=None, attempt=1):
+    """
+    Call primary_model; if it has not answered after the learned latency percentile, send the
+    same request to the next healthy model. The first valid response wins, the other is abandoned
+    (its tokens are still booked when it finishes).
+    Returns tuple: (response, model_used, hedge_fired)
+    """
+    tracker = get_latency_tracker()
+    registry = get_metrics_registry()
+    executor = get_hedge_executor()
+    delay = tracker.hedge_delay(primary_model, stage)
+
+    def submit(model_name, is_hedge):
+        started = time.time()
+        # Each worker gets its own copy of the context so trace ID and cost tracker carry over
+        ctx = contextvars.copy_context()
+        future = executor.submit(ctx.run, generate_with_model, model_name, contents, stage,
+                                 static_prompt, generation_config, attempt, is_hedge)
+
+        def on_done(f):
+            if f.exception() is None:
+                tracker.record_primary(model_name, stage, time.time() - started)
+            elif is_hedge and is_throttling_error(f.exception()):
+                # Also seen when the hedge lost and was abandoned; the primary's errors reach the caller
+                tracker.mark_unhealthy(model_name)
+        future.add_done_callback(on_done)
+        return future
+
+    primary = submit(primary_model, False)
+    try:
+        return primary.result(timeout=delay), primary_model, False
+    except FuturesTimeoutError:
+        pass
+
+    hedge_model = next((m for m in hedge_candidates if tracker.is_healthy(m)), None)
+    if hedge_model is None:
+        return primary.result(), primary_model, False
+
+    print(f"⏱️ {primary_model} slower than {delay:.1f}s - hedging with {hedge_model}")
+    registry.inc("kalkulation_hedge_total", stage=stage, outcome="fired")
+    pending = {primary: primary_model, submit(hedge_model, True): hedge_model}
+    first_error = None
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            model_name = pending.pop(future)
+            if future.exception() is None:
+                registry.inc("kalkulation_hedge_total", stage=stage,
+                             outcome="primary_won" if model_name == primary_model else "hedge_won")
+                return future.result(), model_name, True
+            first_error = first_error or future.exception()
+    raise first_error
+
+# --- RESPONSE CACHE ---
+# Identical requests (model, normalised prompt, uploaded file) are answered from a local cache
+RESPONSE_CACHE_ENABLED = os.environ.get("KALKULATION_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_FILE = os.path.join(DATA_DIR, "response_cache.sqlite3")
+RESPONSE_CACHE_TTL_HOURS = float(os.environ.get("KALKULATION_RESPONSE_CACHE_TTL_HOURS", "168"))
+RESPONSE_CACHE_MAX_MB = float(os.environ.get("KALKULATION_RESPONSE_CACHE_MB", "256"))
+# live = cache only; record = also write every live response as fixture file; replay = serve fixtures only (offline)
+AI_MODE = os.environ.get("KALKULATION_AI_MODE", "live").lower()
+AI_FIXTURE_DIR = os.environ.get("KALKULATION_AI_FIXTURES", os.path.join(DATA_DIR, "fixtures"))
+
+class ReplayMissError(Exception):
+    """Replay mode has no recorded fixture for a request"""
+
+class CachedResponse:
+    """Stand-in for a Gemini response served from the cache or a fixture (no tokens are booked)"""
+    usage_metadata = None
+
+    def __init__(self, text):
+        self.text = text
+
+def response_cache_key(model, stage, contents, static_prompt=None, response_schema=None, file_hash=None):
+    """
+    Cache key of one request: model, stage, instructions, schema and the prompt with whitespace
+    normalised. Uploaded files count by content (file_hash), since each upload gets a new URI.
+    """
+    digest = hashlib.sha256()
+    schema = json.dumps(response_schema, sort_keys=True) if response_schema else ""
+    for part in (model, stage, static_prompt or "", schema, file_hash or ""):
+        digest.update(str(part).encode('utf-8') + b"\0")
+    for part in contents:
+        if isinstance(part, str):
+            digest.update(re.sub(r"\s+", " ", part).strip().encode('utf-8'))
+        elif file_hash is None:
+            digest.update(str(getattr(part, "uri", part)).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def file_content_hash(source):
+    """SHA-256 of a document source (path or bytes), read in 1 MB blocks"""
+    digest = hashlib.sha256()
+    stream = open_source(source)
+    handle = open(stream, 'rb') if isinstance(stream, (str, os.PathLike)) else stream
+    with handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ResponseCache:
+    """
+    Process-wide SQLite cache of model responses with TTL and a size limit.
+    Entries expire after RESPONSE_CACHE_TTL_HOURS; above RESPONSE_CACHE_MAX_MB the least recently
+    used entries are evicted.
+    """
+    def __init__(self, path, ttl_hours=RESPONSE_CACHE_TTL_HOURS, max_mb=RESPONSE_CACHE_MAX_MB):
+        self.lock = threading.Lock()
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                model_used TEXT NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used);
+        """)
+        self.conn.commit()
+
+    def get(self, key):
+        """Returns tuple (text, model_used) or None"""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT text, model_used, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl_seconds:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key, stage, model_used, text):
+        """Store a response, then drop expired entries and evict least recently used ones above the size limit"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, stage, model_used, text, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, stage, model_used, text, len(text.encode('utf-8')), now, now)
+            )
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Evict down to 90% of the limit so not every put has to evict
+                excess = total - int(self.max_bytes * 0.9)
+                for old_key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                    if excess <= 0:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    excess -= size
+
+    def stats(self):
+        """Returns dict with entries, size in bytes, hits and misses of this process"""
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+@st.cache_resource
+def get_response_cache():
+    """Return the process-wide response cache"""
+    return ResponseCache(RESPONSE_CACHE_FILE)
+
+def lookup_cached_response(key, stage):
+    """
+    Serve a request from a fixture (replay mode) or the response cache.
+    Returns tuple (CachedResponse, model_used) or None. Raises ReplayMissError in replay mode without fixture.
+    """
+    registry = get_metrics_registry()
+    if AI_MODE == "replay":
+        fixture_path = os.path.join(AI_FIXTURE_DIR, f"{key}.json")
+        if not os.path.exists(fixture_path):
+            registry.inc("kalkulation_response_cache_total", stage=stage, result="replay_miss")
+            raise ReplayMissError(f"Replay-Modus: kein Fixture für '{stage}' ({key[:12]}) in {AI_FIXTURE_DIR}")
+        with open(fixture_path, encoding='utf-8') as f:
+            fixture = json.load(f)
+        registry.inc("kalkulation_response_cache_total", stage=stage, result="replay")
+        if _current_progress.get() is not None:
+            _current_progress.get().cached_responses += 1
+        print(f"📼 Replayed {stage} response from fixture {key[:12]}")
+        return CachedResponse(fixture["text"]), fixture["model_used"]
+
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    cached = get_response_cache().get(key)
+    registry.inc("kalkulation_response_cache_total", stage=stage, result="hit" if cached else "miss")
+    if cached is None:
+        return None
+    estimator = _current_progress.get()
+    if estimator is not None:
+        estimator.cached_responses += 1
+    print(f"♻️ {stage} response served from cache ({cached[1]})")
+    return CachedResponse(cached[0]), cached[1]
+
+def response_is_cacheable(text):
+    """Only replies that parse to a non-empty JSON array of records are cached (no empty, truncated or prose replies)"""
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return False
+    return isinstance(data, list) and any(isinstance(item, dict) for item in data)
+
+def store_response(key, stage, model_used, response, contents=None):
+    """Cache a valid live response and, in record mode, write it as fixture file"""
+    try:
+        text = response.text
+        if not response_is_cacheable(text):
+            get_metrics_registry().inc("kalkulation_response_cache_total", stage=stage, result="not_stored")
+            print(f"⚠️ {stage} response not cached (empty or not parseable)")
+            return
+        if RESPONSE_CACHE_ENABLED:
+            get_response_cache().put(key, stage, model_used, text)
+        if AI_MODE == "record":
+            os.makedirs(AI_FIXTURE_DIR, exist_ok=True)
+            prompt_preview = next((part[:300] for part in (contents or []) if isinstance(part, str)), "")
+            tmp_path = os.path.join(AI_FIXTURE_DIR, f"{key}.json.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"key": key, "stage": stage, "model_used": model_used, "recorded": datetime.now().isoformat(timespec='seconds'),
+                           "prompt_preview": prompt_preview, "text": text}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, os.path.join(AI_FIXTURE_DIR, f"{key}.json"))
+    except Exception as e:
+        print(f"⚠️ Could not cache response: {e}")
+
+# --- PRICE HISTORY INDEX ---
+# Local similarity search over confirmed historical positions (character n-gram TF-IDF)
+PRICE_INDEX_DIR = os.path.join(DATA_DIR, "price_index")
+PRICE_INDEX_DIMENSIONS = 2 ** 14   # Hashed n-gram feature space (no vocabulary to refit)
+PRICE_INDEX_NGRAM = 3
+PRICE_INDEX_PREFILL_SIMILARITY = float(os.environ.get("KALKULATION_PREFILL_SIMILARITY", "0.92"))
+PRICE_INDEX_REFERENCE_SIMILARITY = 0.5   # Neighbours above this are given to the model as reference
+PRICE_INDEX_REFERENCES = 3
+# Changes are appended to a journal; the full snapshot is rewritten once the journal has more
+# lines than this or than the index has entries (amortized constant cost per change)
+PRICE_INDEX_COMPACT_MIN_CHANGES = 1000
+
+def normalize_unit(unit):
+    """Normalize unit spelling so prices are only compared per identical unit (m² == m2, Stk == St)"""
+    unit = str(unit or "").strip().lower().replace('²', '2').replace('³', '3').replace('.', '')
+    aliases = {'stk': 'st', 'stück': 'st', 'stck': 'st', 'pauschal': 'psch', 'pausch': 'psch', 'to': 't'}
+    return aliases.get(unit, unit)
+
+def text_ngram_vector(text):
+    """
+    Hashed character n-gram term frequencies (sublinear) of a position text.
+    Returns tuple: (sorted indices as int32, values as float32)
+    """
+    text = " " + " ".join(str(text).lower().split()) + " "
+    counts = {}
+    for i in range(max(len(text) - PRICE_INDEX_NGRAM + 1, 1)):
+        bucket = zlib.crc32(text[i:i + PRICE_INDEX_NGRAM].encode('utf-8')) % PRICE_INDEX_DIMENSIONS
+        counts[bucket] = counts.get(bucket, 0) + 1
+    indices = np.array(sorted(counts), dtype=np.int32)
+    values = 1.0 + np.log(np.array([counts[i] for i in indices], dtype=np.float32))
+    return indices, values
+
+class PriceIndex:
+    """
+    Process-wide nearest-neighbour index over historical priced positions.
+    Vectors are stored as one CSR-style sparse matrix in NumPy arrays; IDF weights are
+    derived from document frequencies at query time, so adding entries needs no refit.
+    On disk: a snapshot (vectors.npz, entries.json) plus an append-only journal of later changes
+    (changes.jsonl), replayed on load and folded into the snapshot from time to time.
+    """
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0, dtype=np.float32)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_freq = np.zeros(PRICE_INDEX_DIMENSIONS, dtype=np.float32)
+        self.entries = []      # {"key", "description", "unit", "unit_price", "source", "updated"}
+        self.key_to_row = {}
+        self.journal_lines = 0
+        self._query_cache = None
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        try:
+            with open(os.path.join(self.directory, "entries.json"), 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            with np.load(os.path.join(self.directory, "vectors.npz")) as data:
+                self.indices, self.values = data["indices"], data["values"]
+                self.indptr, self.doc_freq = data["indptr"], data["doc_freq"]
+            self.entries = entries
+            self.key_to_row = {e["key"]: row for row, e in enumerate(entries)}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Could not load price index: {e}")
+        try:
+            changes = []
+            with open(os.path.join(self.directory, "changes.jsonl"), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        changes.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue  # Line cut off by a crash while appending
+            self._apply(changes)
+            self.journal_lines = len(changes)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Could not replay price index changes: {e}")
+        if self.entries:
+            print(f"📚 Price index loaded: {len(self.entries)} historical positions ({self.journal_lines} journal changes)")
+
+    def save(self):
+        """Write vectors and entries atomically as new snapshot and drop the journal it contains"""
+        os.makedirs(self.directory, exist_ok=True)
+        vectors_tmp = os.path.join(self.directory, "vectors.tmp.npz")
+        entries_tmp = os.path.join(self.directory, "entries.tmp.json")
+        with open(vectors_tmp, 'wb') as f:
+            np.savez(f, indices=self.indices, values=self.values, indptr=self.indptr, doc_freq=self.doc_freq)
+        with open(entries_tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(vectors_tmp, os.path.join(self.directory, "vectors.npz"))
+        os.replace(entries_tmp, os.path.join(self.directory, "entries.json"))
+        # Replaying a journal left over by a crash here is harmless (changes are keyed upserts)
+        try:
+            os.remove(os.path.join(self.directory, "changes.jsonl"))
+        except FileNotFoundError:
+            pass
+        self.journal_lines = 0
+
+    def _append_changes(self, changes):
+        """Append changed entries to the journal; rewrite the snapshot once the journal is large"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "changes.jsonl"), 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(change, ensure_ascii=False) + "\n" for change in changes)
+        self.journal_lines += len(changes)
+        if self.journal_lines > max(PRICE_INDEX_COMPACT_MIN_CHANGES, len(self.entries)):
+            self.save()
+
+    def _apply(self, changes):
+        """
+        Insert or update entries in memory. changes: entry dicts ({"key", "description", ...});
+        known keys only get price, source and date updated. Returns number of new entries.
+        """
+        new_indices, new_values, new_lengths = [], [], []
+        for change in changes:
+            row = self.key_to_row.get(change["key"])
+            if row is not None:
+                self.entries[row].update({k: change[k] for k in ("unit_price", "source", "updated")})
+                continue
+            indices, values = text_ngram_vector(change["description"])
+            new_indices.append(indices)
+            new_values.append(values)
+            new_lengths.append(len(indices))
+            self.doc_freq[indices] += 1
+            self.key_to_row[change["key"]] = len(self.entries)
+            self.entries.append(dict(change))
+
+        if new_indices:
+            self.indices = np.concatenate([self.indices] + new_indices)
+            self.values = np.concatenate([self.values] + new_values)
+            self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(new_lengths)])
+        self._query_cache = None
+        return len(new_indices)
+
+    def add_many(self, records, source="confirmed"):
+        """
+        Add or update positions. records: iterable of (description, unit, unit_price).
+        Known texts (same description and unit) only get their price updated. Only the changes
+        are written to disk (journal), not the whole index.
+        Returns number of new entries.
+        """
+        today = datetime.now().strftime('%Y-%m-%d')
+        changes = [
+            {"key": position_content_hash(description, unit), "description": str(description)[:500], "unit": str(unit or ""),
+             "unit_price": float(unit_price), "source": source, "updated": today}
+            for description, unit, unit_price in records
+            if not (pd.isna(description) or not str(description).strip() or pd.isna(unit_price)
+                    or not np.isfinite(unit_price) or unit_price <= 0)
+        ]
+        with self.lock:
+            added = self._apply(changes)
+            if changes:
+                self._append_changes(changes)
+        return added
+
+    def _prepare(self):
+        """IDF-weighted values, row norms and units, cached until the next change"""
+        if self._query_cache is None:
+            idf = np.log((1.0 + len(self.entries)) / (1.0 + self.doc_freq)) + 1.0
+            weighted = self.values * idf[self.indices]
+            row_norms = np.sqrt(np.add.reduceat(weighted ** 2, self.indptr[:-1]))
+            units = np.array([normalize_unit(e["unit"]) for e in self.entries], dtype=object)
+            self._query_cache = (idf, weighted, row_norms, units)
+        return self._query_cache
+
+    def query(self, text, unit=None, k=PRICE_INDEX_REFERENCES):
+        """
+        k most similar historical positions (cosine similarity), restricted to the same unit if given.
+        Returns list of dicts with similarity, description, unit, unit_price.
+        """
+        with self.lock:
+            if not self.entries or not str(text).strip():
+                return []
+            idf, weighted, row_norms, units = self._prepare()
+            q_indices, q_values = text_ngram_vector(text)
+            query = np.zeros(PRICE_INDEX_DIMENSIONS, dtype=np.float32)
+            query[q_indices] = q_values * idf[q_indices]
+            query_norm = np.linalg.norm(query)
+
+            dots = np.add.reduceat(weighted * query[self.indices], self.indptr[:-1])
+            similarities = dots / np.maximum(row_norms * query_norm, 1e-9)
+            if unit is not None:
+                similarities = np.where(units == normalize_unit(unit), similarities, -1.0)
+
+            k = min(k, len(similarities))
+            top = np.argpartition(-similarities, k - 1)[:k]
+            top = top[np.argsort(-similarities[top])]
+            return [{"similarity": float(similarities[row]), **self.entries[row]} for row in top if similarities[row] > 0]
+
+    def price_table(self):
+        """Description, unit and unit price of all historical positions as DataFrame"""
+        with self.lock:
+            return pd.DataFrame({
+                "description": [e["description"] for e in self.entries],
+                "unit": [e["unit"] for e in self.entries],
+                "unit_price": np.array([e["unit_price"] for e in self.entries], dtype=np.float64),
+            })
+
+@st.cache_resource
+def get_price_index():
+    """Return the process-wide price history index"""
+    return PriceIndex(PRICE_INDEX_DIR)
+
+# --- PROGRESS & ETA ---
+STAGE_RATES_FILE = os.path.join(DATA_DIR, "stage_rates.json")
+STAGE_RATE_ALPHA = 0.3  # Weight of the newest run in the learned seconds per unit
+# Work units: "extraction" counts 1,000 characters of text (uploads: 100 KB of file), "pricing" counts positions
+
+_current_progress = contextvars.ContextVar("current_progress", default=None)
+
+class StageRates:
+    """
+    Process-wide learned seconds per work unit for each (stage, source), persisted to disk.
+    Updated as an exponentially weighted average, so the estimate follows API speed changes.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.rates = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.rates = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, key):
+        """Seconds per unit or None without history"""
+        with self.lock:
+            entry = self.rates.get(key)
+        return entry["seconds_per_unit"] if entry else None
+
+    def record(self, key, seconds, units):
+        if units <= 0 or seconds <= 0:
+            return
+        rate = seconds / units
+        with self.lock:
+            entry = self.rates.get(key)
+            if entry is None:
+                entry = self.rates[key] = {"seconds_per_unit": rate, "runs": 0}
+            else:
+                entry["seconds_per_unit"] += STAGE_RATE_ALPHA * (rate - entry["seconds_per_unit"])
+            entry["runs"] += 1
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.rates, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"⚠️ Could not write stage rates: {e}")
+
+@st.cache_resource
+def get_stage_rates():
+    """Return the process-wide learned stage rates"""
+    return StageRates(STAGE_RATES_FILE)
+
+def format_duration(seconds):
+    """Short German duration, e.g. '45 s' or '3:20 min'"""
+    seconds = int(round(seconds))
+    return f"{seconds} s" if seconds < 60 else f"{seconds // 60}:{seconds % 60:02d} min"
+
+class ProgressEstimator:
+    """
+    Progress and ETA of one pipeline run. Stages report work done in their own units;
+    remaining work is timed with this run's observed rate once the stage has made progress,
+    before that with the rate learned from past runs. Completed stages update the learned rates.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.stages = {}  # stage -> {"key", "done", "total", "started"}
+        self.shown_percent = 0
+        self.cached_responses = 0  # Runs served from the response cache are not learned from
+
+    def report(self, stage, done, total, source="", final=False):
+        """Record progress of a stage: done of total units. final=True ends the stage and learns its rate."""
+        now = time.time()
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {"key": f"{stage}:{source}" if source else stage,
+                                              "done": 0, "total": 0, "started": now}
+            entry["done"], entry["total"] = done, max(total, done)
+        if final and not self.cached_responses:
+            get_stage_rates().record(entry["key"], now - entry["started"], entry["total"])
+
+    def remaining_seconds(self):
+        """Estimated seconds until all reported stages are done, None without open work or if a stage has no rate yet"""
+        now = time.time()
+        remaining = 0.0
+        with self.lock:
+            stages = [dict(entry) for entry in self.stages.values()]
+        for entry in stages:
+            left = entry["total"] - entry["done"]
+            if left <= 0:
+                continue
+            if entry["done"] > 0:
+                rate = (now - entry["started"]) / entry["done"]
+            else:
+                rate = get_stage_rates().get(entry["key"])
+                if rate is None:
+                    return None
+            remaining += left * rate
+        return remaining or None
+
+    def throughput(self, stage="pricing"):
+        """Units per second of a stage in this run (positions/s for pricing), None before progress"""
+        with self.lock:
+            entry = self.stages.get(stage)
+            if not entry or not entry["done"]:
+                return None
+            elapsed = time.time() - entry["started"]
+        return entry["done"] / elapsed if elapsed > 0 else None
+
+    def render(self, percent, message):
+        """
+        Returns tuple (percent, text) for the progress bar. With an estimate the percentage is
+        elapsed / (elapsed + remaining), otherwise the caller's fixed stage percentage. Never goes back.
+        """
+        elapsed = time.time() - self.start
+        finished = percent >= 100
+        remaining = None if finished else self.remaining_seconds()
+        if remaining is not None:
+            percent = int(100 * elapsed / (elapsed + remaining))
+        percent = 100 if finished else max(self.shown_percent, min(percent, 99))
+        self.shown_percent = percent
+
+        parts = [message]
+        rate = self.throughput("pricing")
+        if rate is not None and not finished:
+            parts.append(f"{format_german_number(rate, 1)} Pos./s")
+        if remaining is not None:
+            parts.append(f"noch ca. {format_duration(remaining)}")
+        parts.append(f"Laufzeit {format_duration(elapsed)}")
+        return percent, " · ".join(parts)
+
+def start_progress_tracking():
+    """Start progress/ETA estimation for one pipeline run in this thread"""
+    estimator = ProgressEstimator()
+    _current_progress.set(estimator)
+    return estimator
+
+def report_work(stage, done, total, source="", final=False):
+    """Report stage progress to the current run's estimator (no-op outside a run)"""
+    estimator = _current_progress.get()
+    if estimator is not None:
+        estimator.report(stage, done, total, source, final)
+
 # --- AI EXTRACTION FUNCTIONS ---
 def get_mime_type(file_path):
     """
-    Determine MIME type based on file extension.
+    Determine MIME type based on file extension (file path or bare extension like '.pdf').
     """
-    ext = os.path.splitext(file_path)[1].lower()
+    ext = (os.path.splitext(file_path)[1] or file_path).lower()
     
     mime_types = {
         # Documents
@@ -191,12 +1522,31 @@ def get_mime_type(file_path):
     
     return mime_types.get(ext, 'application/octet-stream')
 
-def call_ai_with_retry(model, contents, max_retries=3, initial_delay=5):
+def call_ai_with_retry(model, contents, max_retries=3, initial_delay=5, stage="extraction", static_prompt=None,
+                       response_schema=None, file_hash=None, use_cache=True):
     """
     Call AI API with exponential backoff retry logic and automatic model switching.
     Tries alternative models when encountering 503 (overloaded) or 429 (quota exceeded) errors.
+    Every attempt is recorded as a "model_call" span with its token usage under the given stage.
+    static_prompt is an optional instruction prefix that is served from the Gemini context cache
+    when possible and otherwise sent inline in front of contents.
+    With response_schema the model is asked for application/json matching that schema.
+    With HEDGE_ENABLED, slow calls are hedged at the next healthy model (see hedged_generate).
+    Repeated requests are answered from the response cache (or fixtures in replay mode);
+    file_hash identifies uploaded files in contents by their content. use_cache=False asks the model
+    again (retries of failed replies); only replies that parse to a non-empty JSON array are cached.
+    Raises BudgetExceededError if the cost budget does not allow a call for this stage.
     Returns tuple: (response, model_used)
     """
+    # Cached answers cost nothing, so they are served even when the budget is used up
+    cache_key = response_cache_key(model, stage, contents, static_prompt, response_schema, file_hash)
+    cached = lookup_cached_response(cache_key, stage) if use_cache or AI_MODE == "replay" else None
+    if cached is not None:
+        return cached
+
+    if not budget_allows_stage(stage):
+        raise BudgetExceededError(f"KI-Budget erschöpft - Aufruf für '{stage}' übersprungen")
+
     # Define available models in priority order (strongest first, then faster fallbacks)
     available_models = [
         'gemini-2.5-flash',       # Best balance: fast + capable
@@ -214,7 +1564,23 @@ def call_ai_with_retry(model, contents, max_retries=3, initial_delay=5):
         models_to_try = [model] + [m for m in available_models if m != model]
     else:
         models_to_try = available_models
+
+    # Tight budget: never escalate to a model more expensive than the requested one, cheapest first
+    if get_budget_status() == "tight":
+        def model_cost(m):
+            return sum(MODEL_PRICING.get(m, DEFAULT_MODEL_PRICING))
+        max_cost = model_cost(models_to_try[0])
+        models_to_try = sorted([m for m in models_to_try if model_cost(m) <= max_cost], key=model_cost)
+        print(f"💶 Budget tight - limiting to cheaper models: {', '.join(models_to_try)}")
     
+    # Constrained JSON output: the response parses with a single json.loads
+    generation_config = None
+    if response_schema is not None:
+        generation_config = GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=response_schema
+        )
+
     last_error = None
     
     for model_idx, current_model in enumerate(models_to_try):
@@ -222,16 +1588,43 @@ def call_ai_with_retry(model, contents, max_retries=3, initial_delay=5):
         
         for attempt in range(max_retries):
             try:
-                model = genai.GenerativeModel(current_model)
-                response = model.generate_content(contents)
-                if model_idx > 0:
-                    print(f"✅ Successfully switched to model: {current_model}")
-                return response, current_model
+                latency_tracker = get_latency_tracker()
+                call_start = time.time()
+                # Hedging doubles cost for slow calls - only with enough samples and an unconstrained budget
+                hedge_fired = False
+                if (HEDGE_ENABLED and get_budget_status() == "ok"
+                        and latency_tracker.hedge_delay(current_model, stage) is not None):
+                    response, model_used, hedge_fired = hedged_generate(
+                        current_model, models_to_try[model_idx + 1:], contents, stage,
+                        static_prompt=static_prompt, generation_config=generation_config, attempt=attempt + 1
+                    )
+                else:
+                    response = generate_with_model(
+                        current_model, contents, stage,
+                        static_prompt=static_prompt, generation_config=generation_config, attempt=attempt + 1
+                    )
+                    model_used = current_model
+                    latency_tracker.record_primary(current_model, stage, time.time() - call_start)
+                latency_tracker.record_effective(stage, time.time() - call_start, hedged=hedge_fired)
+
+                if model_used != models_to_try[0]:
+                    print(f"✅ Successfully switched to model: {model_used}")
+                    get_metrics_registry().inc("kalkulation_model_switches_total", model=model_used, stage=stage)
+                store_response(cache_key, stage, model_used, response, contents)
+                return response, model_used
                 
             except Exception as e:
                 last_error = e
                 error_str = str(e)
+
+                # Expired or deleted cached content: drop it so the next attempt recreates it
+                if static_prompt and 'cachedcontent' in error_str.lower().replace('_', '').replace(' ', ''):
+                    get_prompt_cache().invalidate(current_model, static_prompt)
                 
+                # Overloaded or rate-limited models are not used as hedge targets for a while
+                if '503' in error_str or '429' in error_str or 'overloaded' in error_str.lower() or 'RESOURCE_EXHAUSTED' in error_str:
+                    get_latency_tracker().mark_unhealthy(current_model)
+
                 # Check for 503/overloaded errors
                 if '503' in error_str or 'overloaded' in error_str.lower():
                     print(f"⚠️ Model {current_model} is overloaded (503)")
@@ -302,25 +1695,43 @@ def call_ai_with_retry(model, contents, max_retries=3, initial_delay=5):
     else:
         raise Exception("All models exhausted without successful response")
 
-def safe_remove_file(file_path, max_retries=3, delay=0.5):
+# Uploads up to this size are processed straight from memory; larger ones are spooled to a temp file
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("KALKULATION_UPLOAD_SPOOL_MB", "64")) * 1024 * 1024
+
+def open_source(source):
     """
-    Safely remove a file with retry logic for Windows file locking issues.
+    Return something openpyxl/pandas/the File API can read for a document source.
+    source: file path or the raw bytes of an upload. Each call returns an independent
+    buffer (sharing the bytes, not copying them) so sheets can be read in parallel threads.
     """
-    for attempt in range(max_retries):
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return True
-        except PermissionError:
-            if attempt < max_retries - 1:
-                time.sleep(delay)
-            else:
-                print(f"⚠️ Could not delete temporary file: {file_path}")
-                return False
-        except Exception as e:
-            print(f"⚠️ Error deleting file: {e}")
-            return False
-    return False
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+def source_size(source):
+    """Size of a document source in bytes"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    return os.path.getsize(source)
+
+@contextlib.contextmanager
+def upload_source(uploaded_file, suffix):
+    """
+    Yield an uploaded file as a document source for extract_with_ai.
+    Small uploads are passed as the in-memory bytes without a copy; uploads above
+    UPLOAD_SPOOL_MAX_BYTES are spooled to a temp file that is removed on exit.
+    """
+    if uploaded_file.size <= UPLOAD_SPOOL_MAX_BYTES:
+        yield uploaded_file.getvalue()
+        return
+
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp_dir:
+        temp_path = os.path.join(tmp_dir, f"upload{suffix}")
+        uploaded_file.seek(0)
+        with open(temp_path, "wb") as tmp:
+            shutil.copyfileobj(uploaded_file, tmp)
+        print(f"💾 Upload spooled to disk ({uploaded_file.size / 1024 / 1024:.1f} MB)")
+        yield temp_path
 
 def sanitize_filename(filename):
     """
@@ -344,128 +1755,161 @@ def sanitize_filename(filename):
     
     return sanitized
 
-def check_excel_structure(file_path):
+# Excel layout detection limits (rows scanned from the top of each sheet)
+EXCEL_MARKER_SCAN_ROWS = 50
+EXCEL_HEADER_SCAN_ROWS = 20
+# Workbooks with more rows than this (over all sheets) are extracted sheet-by-sheet in parallel
+EXCEL_PARALLEL_MIN_ROWS = 2000
+EXCEL_MAX_WORKERS = 4
+# Ordnungszahl in column B of the old format, e.g. "0010", "01.02.0030." or "1.2.10a"
+EXCEL_POSITION_NUMBER_PATTERN = re.compile(r"^\d{1,4}(?:\.\d{1,4}){0,4}\.?[a-z]?$", re.IGNORECASE)
+
+def find_lv_header_row(rows):
+    """
+    Find the German LV header (Ordnungszahl | Kurztext | Langtext in columns B-D).
+    rows: list of row value tuples from the top of a sheet.
+    Returns 1-based row number or None.
+    """
+    for row_num, values in enumerate(rows[:EXCEL_HEADER_SCAN_ROWS], start=1):
+        values = tuple(values) + (None,) * 4
+        cell_b = str(values[1] or "").strip().lower()
+        cell_c = str(values[2] or "").strip().lower()
+        cell_d = str(values[3] or "").strip().lower()
+        if "ordnungszahl" in cell_b and "kurztext" in cell_c and "langtext" in cell_d:
+            return row_num
+    return None
+
+def is_position_marker(value):
+    """Check if a column A value marks a position row (old format)"""
+    if not value:
+        return False
+    cell_str = str(value).strip().lower()
+    return "position" in cell_str or cell_str.startswith("pos")
+
+def is_position_row(values):
+    """
+    Check if a row is a position of the old format without header: position marker in column A,
+    an Ordnungszahl in column B and a text in C or D. Other rows of header-less sheets are skipped.
+    """
+    values = tuple(values) + (None,) * 4
+    return (is_position_marker(values[0])
+            and bool(EXCEL_POSITION_NUMBER_PATTERN.match(str(values[1] or "").strip()))
+            and bool(values[2] or values[3]))
+
+def check_excel_structure(source):
     """
     Check if Excel file has the expected structure for direct extraction.
-    Returns True if structure matches (Position in col A OR Ordnungszahl in col B).
+    Returns True if at least one sheet matches (Position in col A OR Ordnungszahl in col B).
     """
     try:
-        workbook = openpyxl.load_workbook(file_path)
-        sheet = workbook.active
-
-        # Strategy 1: Check for "Position" in column A
-        position_count = 0
-        for row in range(1, min(50, sheet.max_row + 1)):
-            cell_value = sheet[f'A{row}'].value
-            if cell_value:
-                cell_str = str(cell_value).strip().lower()
-                if "position" in cell_str or cell_str.startswith("pos"):
-                    position_count += 1
-                    print(f"[OK] Found position marker at row {row}: '{cell_value}'")
-                    if position_count >= 1:
-                        workbook.close()
-                        print(f"[OK] Found {position_count} Position(s) in column A - structure detected")
-                        return True
+        workbook = openpyxl.load_workbook(open_source(source), read_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                rows = list(sheet.iter_rows(max_row=EXCEL_MARKER_SCAN_ROWS, max_col=4, values_only=True))
 
-        # Strategy 2: Check for "Ordnungszahl" header structure
-        for row in range(1, min(20, sheet.max_row + 1)):
-            cell_b = str(sheet[f'B{row}'].value or "").strip().lower()
-            cell_c = str(sheet[f'C{row}'].value or "").strip().lower()
-            cell_d = str(sheet[f'D{row}'].value or "").strip().lower()
+                # Strategy 1: Check for "Position" in column A with an Ordnungszahl in column B
+                for row_num, values in enumerate(rows, start=1):
+                    if values and is_position_row(values):
+                        print(f"[OK] Sheet '{sheet.title}': position marker at row {row_num}: '{values[0]}' - structure detected")
+                        return True
 
-            # Look for the typical German structure: Ordnungszahl | Kurztext | Langtext
-            if "ordnungszahl" in cell_b and "kurztext" in cell_c and "langtext" in cell_d:
-                workbook.close()
-                print(f"[OK] Found German LV structure at row {row}: Ordnungszahl | Kurztext | Langtext")
-                return True
+                # Strategy 2: Check for "Ordnungszahl" header structure
+                header_row = find_lv_header_row(rows)
+                if header_row:
+                    print(f"[OK] Sheet '{sheet.title}': German LV structure at row {header_row}: Ordnungszahl | Kurztext | Langtext")
+                    return True
+        finally:
+            workbook.close()
 
-        workbook.close()
         print(f"⚠️ No matching structure found")
         return False
     except Exception as e:
         print(f"Error checking Excel structure: {e}")
         return False
 
-def extract_positions_from_structured_excel(file_path):
+def extract_positions_from_sheet(source, sheet_name):
     """
-    Extract positions from Excel file with known structure.
+    Extract positions from one sheet. Opens its own read-only workbook so sheets
+    can be processed in parallel threads.
     Supports two formats:
     1. Position in column A (old format)
     2. Typ | Ordnungszahl | Kurztext | Langtext (German LV format)
-    Returns list of dictionaries with position data.
+    Returns list of dictionaries with position data, tagged with the sheet name.
     """
+    workbook = openpyxl.load_workbook(open_source(source), read_only=True, data_only=True)
     try:
-        workbook = openpyxl.load_workbook(file_path)
-        sheet = workbook.active
-        positions = []
+        rows = [tuple(values) + (None,) * 6 for values in workbook[sheet_name].iter_rows(max_col=6, values_only=True)]
+    finally:
+        workbook.close()
 
-        # Find header row for German LV format
-        header_row = None
-        for row in range(1, min(20, sheet.max_row + 1)):
-            cell_b = str(sheet[f'B{row}'].value or "").strip().lower()
-            cell_c = str(sheet[f'C{row}'].value or "").strip().lower()
-            cell_d = str(sheet[f'D{row}'].value or "").strip().lower()
+    def make_position(values):
+        _, ordnungszahl, kurztext, langtext, menge, einheit = values[:6]
+        return {
+            "ordnungszahl": str(ordnungszahl) if ordnungszahl else "",
+            "kurztext": str(kurztext) if kurztext else "",
+            "langtext": str(langtext) if langtext else "",
+            "menge": menge if menge else 1.0,
+            "einheit": str(einheit) if einheit else "Psch",
+            "sheet": sheet_name
+        }
 
-            if "ordnungszahl" in cell_b and "kurztext" in cell_c and "langtext" in cell_d:
-                header_row = row
-                print(f"[OK] Found header row at row {row}")
-                break
+    positions = []
+    header_row = find_lv_header_row(rows)
 
-        # Extract using German LV format
-        if header_row:
-            for row in range(header_row + 1, sheet.max_row + 1):
-                typ = str(sheet[f'A{row}'].value or "").strip().lower()
-
-                # Only extract rows marked as "Position" (including variants like "Position (Ohne Gesamtpreis)")
-                if typ.startswith("position"):
-                    ordnungszahl = sheet[f'B{row}'].value
-                    kurztext = sheet[f'C{row}'].value
-                    langtext = sheet[f'D{row}'].value
-                    menge = sheet[f'E{row}'].value
-                    einheit = sheet[f'F{row}'].value
-
-                    # Skip if no description
-                    if not kurztext and not langtext:
-                        continue
+    # Extract using German LV format
+    if header_row:
+        print(f"[OK] Sheet '{sheet_name}': header row at row {header_row}")
+        for values in rows[header_row:]:
+            typ = str(values[0] or "").strip().lower()
 
-                    position = {
-                        "ordnungszahl": str(ordnungszahl) if ordnungszahl else "",
-                        "kurztext": str(kurztext) if kurztext else "",
-                        "langtext": str(langtext) if langtext else "",
-                        "menge": menge if menge else 1.0,
-                        "einheit": str(einheit) if einheit else "Psch"
-                    }
+            # Only extract rows marked as "Position" (including variants like "Position (Ohne Gesamtpreis)")
+            # and skip rows without description
+            if typ.startswith("position") and (values[2] or values[3]):
+                positions.append(make_position(values))
 
-                    positions.append(position)
-                    print(f"[OK] Row {row}: {position['kurztext'][:50]}")
+    # Fallback: old format with "Position" in column A (only rows with an Ordnungszahl)
+    else:
+        for values in rows:
+            if is_position_row(values):
+                positions.append(make_position(values))
 
-        # Fallback: old format with "Position" in column A
-        else:
-            for row in range(1, sheet.max_row + 1):
-                cell_value = sheet[f'A{row}'].value
-
-                if cell_value:
-                    cell_str = str(cell_value).strip().lower()
-                    if "position" in cell_str or cell_str.startswith("pos"):
-                        ordnungszahl = sheet[f'B{row}'].value
-                        kurztext = sheet[f'C{row}'].value
-                        langtext = sheet[f'D{row}'].value
-                        menge = sheet[f'E{row}'].value
-                        einheit = sheet[f'F{row}'].value
-
-                        position = {
-                            "ordnungszahl": str(ordnungszahl) if ordnungszahl else "",
-                            "kurztext": str(kurztext) if kurztext else "",
-                            "langtext": str(langtext) if langtext else "",
-                            "menge": menge if menge else 1.0,
-                            "einheit": str(einheit) if einheit else "Psch"
-                        }
-
-                        positions.append(position)
-                        print(f"[OK] Row {row}: {position['kurztext'][:50]}")
+    print(f"[OK] Sheet '{sheet_name}': {len(positions)} positions")
+    return positions
 
+def extract_positions_from_structured_excel(source, on_sheet=None):
+    """
+    Extract positions from all sheets of an Excel file with known structure
+    (e.g. one sheet per Gewerk or Los). Large workbooks are processed sheet-by-sheet in parallel.
+    on_sheet: Optional function(positions) called in sheet order as soon as a sheet is extracted
+    Returns list of dictionaries with position data in sheet order.
+    """
+    try:
+        workbook = openpyxl.load_workbook(open_source(source), read_only=True)
+        sheet_rows = {sheet.title: sheet.max_row or 0 for sheet in workbook.worksheets}
         workbook.close()
-        print(f"\n📊 Total positions extracted: {len(positions)}")
+
+        sheet_names = list(sheet_rows)
+        total_rows = sum(sheet_rows.values())
+
+        if len(sheet_names) > 1 and total_rows >= EXCEL_PARALLEL_MIN_ROWS:
+            workers = min(EXCEL_MAX_WORKERS, len(sheet_names))
+            print(f"📑 {len(sheet_names)} sheets, {total_rows:,} rows - extracting in parallel ({workers} threads)")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                sheet_results = []
+                for sheet_positions in executor.map(lambda name: extract_positions_from_sheet(source, name), sheet_names):
+                    sheet_results.append(sheet_positions)
+                    if on_sheet is not None:
+                        on_sheet(sheet_positions)
+        else:
+            sheet_results = []
+            for name in sheet_names:
+                sheet_results.append(extract_positions_from_sheet(source, name))
+                if on_sheet is not None:
+                    on_sheet(sheet_results[-1])
+
+        positions = [pos for sheet_positions in sheet_results for pos in sheet_positions]
+        matched_sheets = sum(1 for sheet_positions in sheet_results if sheet_positions)
+        print(f"\n📊 Total positions extracted: {len(positions)} from {matched_sheets} sheet(s)")
         return positions
 
     except Exception as e:
@@ -474,137 +1918,257 @@ def extract_positions_from_structured_excel(file_path):
         print(traceback.format_exc())
         return []
 
-def estimate_prices_with_ai(positions, progress_callback=None):
+def normalize_position_number(pos_str):
+    """Normalize position number: remove trailing dots, leading zeros in segments"""
+    if not pos_str:
+        return ""
+    segments = str(pos_str).strip().rstrip('.').split('.')
+    return '.'.join(seg.lstrip('0') or '0' for seg in segments)
+
+class PositionIndex:
     """
-    Use AI to estimate prices for positions based on Langtext descriptions.
-    Processes in batches to avoid token limits and JSON truncation.
+    Document-level lookup from AI reply keys to positions.
+    Every position gets a stable row ID (pos['row_id']) that is sent to the model, so duplicate
+    OZ across Titel/Lose cannot collide. Raw and normalized OZ stay resolvable as fallback
+    for replies that echo the OZ instead of the ID. add() extends the index while a document is
+    still being extracted (pipelined pricing).
+    """
+    def __init__(self, positions):
+        self.by_id = {}
+        self.by_number = {}
+        self.add(positions)
 
-    Args:
-        positions: List of position dictionaries
-        progress_callback: Optional function(percent, message) to report progress
+    def add(self, positions):
+        """Index further positions of the same document (row IDs continue the numbering)"""
+        for pos in positions:
+            pos.setdefault('row_id', f"R{len(self.by_id) + 1}")
+            self.by_id[str(pos['row_id'])] = pos
+            number = str(pos.get('ordnungszahl') or '').strip()
+            if number:
+                for key in {number, normalize_position_number(number)}:
+                    self.by_number.setdefault(key, []).append(pos)
+
+    def resolve(self, key, scope=None):
+        """
+        Positions addressed by a reply key: the row with this ID, otherwise all rows with this OZ.
+        scope: optional set of row IDs the reply may refer to (e.g. the current batch).
+        """
+        key = str(key).strip()
+        if key in self.by_id:
+            matches = [self.by_id[key]]
+        else:
+            matches = self.by_number.get(key) or self.by_number.get(normalize_position_number(key), [])
+        if scope is not None:
+            matches = [pos for pos in matches if pos['row_id'] in scope]
+        return matches
+
+def format_price_references(pos):
+    """Similar historical positions as price reference for the model"""
+    return "".join(
+        f"\nReferenz ({ref['similarity']:.0%} ähnlich): {ref['description'][:150]} = {ref['unit_price']:.2f} EUR/{ref['unit']}"
+        for ref in pos.get('references', [])
+    )
+
+def get_ai_prices_for_batch(batch_positions, use_cache=True):
+    """Get prices for a batch of positions from AI (use_cache=False for retries of failed batches)"""
+    positions_text = "\n\n".join([
+        f"Position:\n"
+        f"Nummer: {pos['row_id']}\n"
+        f"OZ: {pos['ordnungszahl']}\n"
+        f"Beschreibung: {(pos['langtext'] or pos['kurztext'])[:500]}\n"
+        f"Menge: {pos['menge']} {pos['einheit']}"
+        f"{format_price_references(pos)}"
+        for pos in batch_positions
+    ])
+
+    # Static instructions come from the context cache (or are prepended), only positions vary
+    response, model_used = call_ai_with_retry(
+        model='gemini-2.0-flash-lite',
+        contents=[f"Positionen:\n{positions_text}"],
+        stage="pricing_batch",
+        static_prompt=PRICING_BATCH_PROMPT,
+        response_schema=PRICE_LIST_SCHEMA,
+        use_cache=use_cache
+    )
+
+    return load_json_response(response, stage="pricing_batch")
+
+def apply_prices_from_data(prices_data, target_positions, position_index):
+    """Apply prices from AI response (PRICE_LIST_SCHEMA items) to positions. Returns number of positions priced."""
+    matched = 0
+    scope = {pos['row_id'] for pos in target_positions}
+    for item in prices_data:
+        try:
+            price = float(item['unit_price'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if price <= 0:
+            continue
+        for pos in position_index.resolve(item['pos'], scope):
+            if not pos.get('unit_price'):
+                matched += 1
+            pos['unit_price'] = price
+    return matched
+
+def prefill_prices_from_history(positions):
     """
-    # Helper function to normalize position numbers for comparison
-    def normalize_pos(pos_str):
-        """Normalize position number: remove trailing dots, leading zeros in segments"""
-        if not pos_str:
-            return ""
-        pos_str = pos_str.rstrip('.')
-        segments = pos_str.split('.')
-        normalized = []
-        for seg in segments:
-            normalized.append(seg.lstrip('0') or '0')
-        return '.'.join(normalized)
-
-    def get_ai_prices_for_batch(batch_positions):
-        """Get prices for a batch of positions from AI"""
-        positions_text = "\n\n".join([
-            f"Position:\n"
-            f"Nummer: {pos['ordnungszahl']}\n"
-            f"Beschreibung: {(pos['langtext'] or pos['kurztext'])[:500]}\n"
-            f"Menge: {pos['menge']} {pos['einheit']}"
-            for pos in batch_positions
+    Price routine positions from near-identical historical positions; the others get similar
+    ones as references. Returns the positions left for the AI.
+    """
+    ai_positions = []
+    prefilled = 0
+    price_index = get_price_index()
+    with metrics_span("price_index_lookup") as span:
+        for pos in positions:
+            neighbours = price_index.query(pos['langtext'] or pos['kurztext'], pos['einheit'])
+            if neighbours and neighbours[0]['similarity'] >= PRICE_INDEX_PREFILL_SIMILARITY:
+                pos['unit_price'] = neighbours[0]['unit_price']
+                pos['price_source'] = "history"
+                prefilled += 1
+                continue
+            pos['references'] = [n for n in neighbours if n['similarity'] >= PRICE_INDEX_REFERENCE_SIMILARITY]
+            ai_positions.append(pos)
+        span["prefilled"] = prefilled
+    if prefilled:
+        get_metrics_registry().inc("kalkulation_price_index_prefilled_total", prefilled)
+        print(f"   📚 {prefilled} positions priced from history ({span['duration']*1000:.0f} ms), {len(ai_positions)} left for AI")
+    return ai_positions
+
+def complete_missing_prices(positions, position_index, failed_batches=(), progress_callback=None):
+    """
+    Once per document after the batch calls: retry failed batches, one fallback AI call for all
+    positions still without price, then unit-based default prices for the rest.
+    failed_batches: list of (batch number, batch positions)
+    """
+    # Retry failed batches after a longer delay (not when the budget is already used up)
+    if failed_batches and get_budget_status() != "exhausted":
+        if progress_callback:
+            progress_callback(86, f"Wiederhole {len(failed_batches)} fehlgeschlagene Batches...")
+        print(f"   🔄 Retrying {len(failed_batches)} failed batches after delay...")
+        time.sleep(10)
+        for batch_num, batch in failed_batches:
+            print(f"   📦 Retrying batch {batch_num}...")
+            try:
+                with metrics_span("pricing_batch", retry="true") as span:
+                    span["batch"] = batch_num
+                    span["positions"] = len(batch)
+                    prices_data = get_ai_prices_for_batch(batch, use_cache=False)
+                    matched = apply_prices_from_data(prices_data, batch, position_index)
+                    span["matched"] = matched
+                print(f"   ✓ Batch {batch_num} retry: {matched}/{len(batch)} prices matched")
+            except Exception as retry_error:
+                print(f"   ⚠️ Batch {batch_num} retry failed: {retry_error}")
+                get_metrics_registry().inc("kalkulation_pricing_batch_failures_total", phase="retry")
+            time.sleep(3)
+
+    print(f"   📊 Total matched: {sum(1 for pos in positions if pos.get('unit_price'))}/{len(positions)}")
+
+    # Collect positions without prices for a second AI call
+    missing_positions = []
+    for pos in positions:
+        current_price = pos.get('unit_price', 0)
+        if current_price is None or current_price == 0:
+            missing_positions.append(pos)
+
+    # If there are missing positions, make a second AI call specifically for them (budget permitting)
+    if missing_positions and budget_allows_stage("pricing_fallback"):
+        print(f"   {len(missing_positions)} positions without prices, making second AI call...")
+
+        # Create focused prompt for missing positions only
+        missing_text = "\n".join([
+            f"Pos {p['row_id']} (OZ {p['ordnungszahl']}): {p.get('beschreibung', 'Keine Beschreibung')[:200]} | Einheit: {p.get('einheit', 'Psch')} | Menge: {p.get('menge', 1)}"
+            for p in missing_positions
         ])
 
-        prompt = f"""Du bist ein erfahrener Baukalkulator. Gib für JEDE Position den EINHEITSPREIS (EP) in EUR.
-
-⚠️ KRITISCH - EINHEITSPREIS (EP):
-- Gib NUR den EINHEITSPREIS pro Einheit zurück!
-- Bei "140 St" → Preis für 1 Stück (z.B. 150 EUR/St)
-- Bei "1 psch" → Pauschalpreis für die gesamte Leistung
-- Bei "psch" mit Mengenangaben im Text (z.B. "31.200 MeterWochen") → Multipliziere!
+        fallback_prompt = f"""Du bist ein erfahrener deutscher Baukalkulant.
+Gib realistische Einheitspreise (EP) in EUR für diese Baupositionen.
 
-TYPISCHE EINHEITSPREISE:
-- Verkehrszeichen (St): 100-200 EUR/St
-- Baustelleneinrichtung (psch): 5.000-15.000 EUR
-- Erdaushub (m³): 12-18 EUR/m³
-- Asphalt (m²): 25-45 EUR/m²
-- Beton C25/30 (m³): 180-260 EUR/m³
-- Bauzaun mit MeterWochen (psch): Berechne aus Mengenangabe!
+WICHTIG:
+- Analysiere jede Beschreibung genau
+- Gib realistische deutsche Baumarktpreise
+- Alle Preise mit Cent-Beträgen (z.B. 125.50, nicht 125.00)
 
 Positionen:
-{positions_text}
+{missing_text}
 
 Ausgabe NUR als JSON-Array:
-[{{"pos": "Nummer", "unit_price": Preis}}, ...]
+[
+  {{"pos": "Nummer", "unit_price": Preis}},
+  ...
+]
 """
-        response, model_used = call_ai_with_retry(
-            model='gemini-2.0-flash-lite',
-            contents=[prompt]
-        )
+        try:
+            fallback_response, _ = call_ai_with_retry(
+                model='gemini-2.0-flash',  # Use slightly better model for retry
+                contents=[fallback_prompt],
+                stage="pricing_fallback",
+                response_schema=PRICE_LIST_SCHEMA
+            )
 
-        text = response.text.strip()
-        if text.startswith('```'):
-            text = text.split('```')[1]
-            if text.startswith('json'):
-                text = text[4:]
-            text = text.strip()
-
-        return json.loads(text)
-
-    def apply_prices_from_data(prices_data, target_positions):
-        """Apply prices from AI response to positions"""
-        price_lookup = {}
-        for item in prices_data:
-            pos_key = None
-            for key in ['pos', 'nummer', 'position', 'ordnungszahl', 'nr']:
-                if key in item:
-                    pos_key = str(item[key])
-                    break
-
-            if pos_key:
-                for key in ['unit_price', 'unitprice', 'preis', 'ep', 'einheitspreis', 'price']:
-                    if key in item:
-                        try:
-                            price_lookup[pos_key] = float(item[key])
-                        except:
-                            pass
-                        break
+            fallback_prices = load_json_response(fallback_response, stage="pricing_fallback")
+            print(f"   Second AI call returned {len(fallback_prices)} prices")
+
+            # Apply fallback prices from second AI call
+            fallback_matched = apply_prices_from_data(fallback_prices, missing_positions, position_index)
+            print(f"   AI fallback matched {fallback_matched}/{len(missing_positions)} positions")
+
+        except Exception as fallback_error:
+            print(f"   Second AI call failed: {fallback_error}")
+
+    # Final fallback: use unit-based defaults for any still missing
+    final_missing = 0
+    for pos in positions:
+        current_price = pos.get('unit_price', 0)
+        if current_price is None or current_price == 0:
+            final_missing += 1
+            unit = pos.get('einheit', 'Psch').lower()
+            if 'psch' in unit or 'pau' in unit:
+                pos['unit_price'] = 1500.50
+            elif 'm³' in unit or 'm3' in unit:
+                pos['unit_price'] = 125.75
+            elif 'm²' in unit or 'm2' in unit:
+                pos['unit_price'] = 65.50
+            elif 'm' in unit:
+                pos['unit_price'] = 35.25
             else:
-                for k, v in item.items():
-                    try:
-                        price_lookup[str(k)] = float(v)
-                    except:
-                        pass
-
-        # Create normalized lookup
-        normalized_lookup = {}
-        for key, value in price_lookup.items():
-            norm_key = normalize_pos(key)
-            normalized_lookup[norm_key] = value
-            if key not in normalized_lookup:
-                normalized_lookup[key] = value
-
-        matched = 0
-        for pos in target_positions:
-            pos_num = pos['ordnungszahl']
-            norm_pos_num = normalize_pos(pos_num)
-
-            if pos_num in price_lookup and price_lookup[pos_num] > 0:
-                pos['unit_price'] = price_lookup[pos_num]
-                matched += 1
-            elif norm_pos_num in normalized_lookup and normalized_lookup[norm_pos_num] > 0:
-                pos['unit_price'] = normalized_lookup[norm_pos_num]
-                matched += 1
+                pos['unit_price'] = 85.50
+            print(f"   Final fallback for {pos['ordnungszahl']}: {pos['unit_price']}")
+
+    if final_missing > 0:
+        print(f"   ⚠️ {final_missing} positions still needed unit-based fallback")
 
-        return matched
+def estimate_prices_with_ai(positions, progress_callback=None):
+    """
+    Use AI to estimate prices for positions based on Langtext descriptions.
+    Processes in batches to avoid token limits and JSON truncation.
 
+    Args:
+        positions: List of position dictionaries
+        progress_callback: Optional function(percent, message) to report progress
+    """
     try:
         print(f"\n💰 Estimating prices with AI for {len(positions)} positions...")
 
+        # Built once per document: AI replies are matched by row ID (or OZ) without per-batch lookups
+        position_index = PositionIndex(positions)
+
+        # Routine positions are priced from near-identical historical positions, others get references
+        ai_positions = prefill_prices_from_history(positions)
+
         # Process in batches of 50 to avoid token limits
         BATCH_SIZE = 50
-        total_matched = 0
+        total_matched = len(positions) - len(ai_positions)
         failed_batches = []
 
         # Progress goes from 30% to 85% during batch processing
         START_PROGRESS = 30
         END_PROGRESS = 85
 
-        total_batches = (len(positions) + BATCH_SIZE - 1) // BATCH_SIZE
+        total_batches = (len(ai_positions) + BATCH_SIZE - 1) // BATCH_SIZE
 
-        for batch_start in range(0, len(positions), BATCH_SIZE):
-            batch_end = min(batch_start + BATCH_SIZE, len(positions))
-            batch = positions[batch_start:batch_end]
+        for batch_start in range(0, len(ai_positions), BATCH_SIZE):
+            batch_end = min(batch_start + BATCH_SIZE, len(ai_positions))
+            batch = ai_positions[batch_start:batch_end]
             batch_num = (batch_start // BATCH_SIZE) + 1
 
             # Calculate progress percentage for this batch
@@ -612,164 +2176,40 @@ Ausgabe NUR als JSON-Array:
             progress_msg = f"Schätze Preise... Batch {batch_num}/{total_batches}"
 
             if progress_callback:
+                report_work("pricing", batch_start, len(ai_positions))
                 progress_callback(progress_pct, progress_msg)
 
             print(f"   📦 Processing batch {batch_num}/{total_batches} ({len(batch)} positions)...")
 
             try:
-                prices_data = get_ai_prices_for_batch(batch)
-                matched = apply_prices_from_data(prices_data, batch)
+                with metrics_span("pricing_batch") as span:
+                    span["batch"] = batch_num
+                    span["positions"] = len(batch)
+                    prices_data = get_ai_prices_for_batch(batch)
+                    matched = apply_prices_from_data(prices_data, batch, position_index)
+                    span["matched"] = matched
                 total_matched += matched
-                print(f"   ✓ Batch {batch_num}: {matched}/{len(batch)} prices matched")
+                print(f"   ✓ Batch {batch_num}: {matched}/{len(batch)} prices matched ({span['duration']:.2f}s)")
+            except BudgetExceededError as budget_error:
+                # Remaining positions get unit-based default prices below
+                print(f"   💶 {budget_error} - stopping AI pricing after batch {batch_num - 1}")
+                break
             except Exception as batch_error:
                 print(f"   ⚠️ Batch {batch_num} failed: {batch_error}")
+                get_metrics_registry().inc("kalkulation_pricing_batch_failures_total", phase="first")
                 failed_batches.append((batch_num, batch))
 
             # Small delay between batches to avoid rate limits
             if batch_num < total_batches:
                 time.sleep(2)
 
-        # Retry failed batches after a longer delay
-        if failed_batches:
-            if progress_callback:
-                progress_callback(86, f"Wiederhole {len(failed_batches)} fehlgeschlagene Batches...")
-            print(f"   🔄 Retrying {len(failed_batches)} failed batches after delay...")
-            time.sleep(10)
-            for batch_num, batch in failed_batches:
-                print(f"   📦 Retrying batch {batch_num}...")
-                try:
-                    prices_data = get_ai_prices_for_batch(batch)
-                    matched = apply_prices_from_data(prices_data, batch)
-                    total_matched += matched
-                    print(f"   ✓ Batch {batch_num} retry: {matched}/{len(batch)} prices matched")
-                except Exception as retry_error:
-                    print(f"   ⚠️ Batch {batch_num} retry failed: {retry_error}")
-                time.sleep(3)
-
-        print(f"   📊 Total matched: {total_matched}/{len(positions)}")
-
-        # Collect positions without prices for a second AI call
-        missing_positions = []
-        for pos in positions:
-            current_price = pos.get('unit_price', 0)
-            if current_price is None or current_price == 0:
-                missing_positions.append(pos)
-
-        # If there are missing positions, make a second AI call specifically for them
-        if missing_positions:
-            print(f"   {len(missing_positions)} positions without prices, making second AI call...")
-
-            # Create focused prompt for missing positions only
-            missing_text = "\n".join([
-                f"Pos {p['ordnungszahl']}: {p.get('beschreibung', 'Keine Beschreibung')[:200]} | Einheit: {p.get('einheit', 'Psch')} | Menge: {p.get('menge', 1)}"
-                for p in missing_positions
-            ])
-
-            fallback_prompt = f"""Du bist ein erfahrener deutscher Baukalkulant.
-Gib realistische Einheitspreise (EP) in EUR für diese Baupositionen.
-
-WICHTIG:
-- Analysiere jede Beschreibung genau
-- Gib realistische deutsche Baumarktpreise
-- Alle Preise mit Cent-Beträgen (z.B. 125.50, nicht 125.00)
-
-Positionen:
-{missing_text}
-
-Ausgabe NUR als JSON-Array:
-[
-  {{"pos": "Nummer", "unit_price": Preis}},
-  ...
-]
-"""
-            try:
-                fallback_response, _ = call_ai_with_retry(
-                    model='gemini-2.0-flash',  # Use slightly better model for retry
-                    contents=[fallback_prompt]
-                )
-
-                fallback_text = fallback_response.text.strip()
-                if fallback_text.startswith('```'):
-                    fallback_text = fallback_text.split('```')[1]
-                    if fallback_text.startswith('json'):
-                        fallback_text = fallback_text[4:]
-                    fallback_text = fallback_text.strip()
-
-                fallback_prices = json.loads(fallback_text)
-                print(f"   Second AI call returned {len(fallback_prices)} prices")
-
-                # Build lookup from fallback response
-                fallback_lookup = {}
-                for item in fallback_prices:
-                    pos_key = None
-                    for key in ['pos', 'nummer', 'position', 'ordnungszahl', 'nr']:
-                        if key in item:
-                            pos_key = str(item[key])
-                            break
-
-                    if pos_key:
-                        for key in ['unit_price', 'unitprice', 'preis', 'ep', 'einheitspreis', 'price']:
-                            if key in item:
-                                try:
-                                    fallback_lookup[pos_key] = float(item[key])
-                                except:
-                                    pass
-                                break
-                    else:
-                        for k, v in item.items():
-                            try:
-                                fallback_lookup[str(k)] = float(v)
-                            except:
-                                pass
-
-                # Create normalized fallback lookup
-                normalized_fallback = {}
-                for key, value in fallback_lookup.items():
-                    norm_key = normalize_pos(key)
-                    normalized_fallback[norm_key] = value
-                    if key not in normalized_fallback:
-                        normalized_fallback[key] = value
-
-                # Apply fallback prices from second AI call
-                for pos in missing_positions:
-                    pos_num = pos['ordnungszahl']
-                    norm_pos_num = normalize_pos(pos_num)
-
-                    if pos_num in fallback_lookup and fallback_lookup[pos_num] > 0:
-                        pos['unit_price'] = fallback_lookup[pos_num]
-                        print(f"   AI fallback matched {pos_num}: {pos['unit_price']}")
-                    elif norm_pos_num in normalized_fallback and normalized_fallback[norm_pos_num] > 0:
-                        pos['unit_price'] = normalized_fallback[norm_pos_num]
-                        print(f"   AI fallback matched {pos_num} (normalized): {pos['unit_price']}")
-
-            except Exception as fallback_error:
-                print(f"   Second AI call failed: {fallback_error}")
-
-        # Final fallback: use unit-based defaults for any still missing
-        final_missing = 0
-        for pos in positions:
-            current_price = pos.get('unit_price', 0)
-            if current_price is None or current_price == 0:
-                final_missing += 1
-                unit = pos.get('einheit', 'Psch').lower()
-                if 'psch' in unit or 'pau' in unit:
-                    pos['unit_price'] = 1500.50
-                elif 'm³' in unit or 'm3' in unit:
-                    pos['unit_price'] = 125.75
-                elif 'm²' in unit or 'm2' in unit:
-                    pos['unit_price'] = 65.50
-                elif 'm' in unit:
-                    pos['unit_price'] = 35.25
-                else:
-                    pos['unit_price'] = 85.50
-                print(f"   Final fallback for {pos['ordnungszahl']}: {pos['unit_price']}")
+        if progress_callback:
+            report_work("pricing", len(ai_positions), len(ai_positions), final=True)
 
-        if final_missing > 0:
-            print(f"   ⚠️ {final_missing} positions still needed unit-based fallback")
+        complete_missing_prices(positions, position_index, failed_batches, progress_callback)
 
         print(f"✓ Price estimation complete")
         return positions
-    
     except Exception as e:
         print(f"⚠️ Error estimating prices: {e}")
         # Add default prices
@@ -778,13 +2218,13 @@ Ausgabe NUR als JSON-Array:
                 pos['unit_price'] = 100.50
         return positions
 
-def read_excel_as_text(file_path):
+def read_excel_as_text(source):
     """
     Read Excel file and convert to text format for AI processing.
     """
     try:
         # Read all sheets with context manager to ensure proper cleanup
-        with pd.ExcelFile(file_path) as excel_file:
+        with pd.ExcelFile(open_source(source)) as excel_file:
             text_content = ""
 
             for sheet_name in excel_file.sheet_names:
@@ -797,13 +2237,13 @@ def read_excel_as_text(file_path):
         print(f"Error reading Excel file: {e}")
         return None
 
-def read_excel_as_text_chunked(file_path, max_rows=500):
+def read_excel_as_text_chunked(source, max_rows=500):
     """
     Read Excel file with row limit to prevent token overflow.
     Only reads up to max_rows per sheet.
     """
     try:
-        with pd.ExcelFile(file_path) as excel_file:
+        with pd.ExcelFile(open_source(source)) as excel_file:
             text_content = ""
 
             for sheet_name in excel_file.sheet_names:
@@ -818,61 +2258,322 @@ def read_excel_as_text_chunked(file_path, max_rows=500):
                 if total_rows > max_rows:
                     text_content += f"\n\n[NOTE: Showing first {max_rows} of {total_rows} rows to prevent token limit]"
 
-        return text_content
-    except Exception as e:
-        print(f"Error reading Excel file: {e}")
-        return None
+        return text_content
+    except Exception as e:
+        print(f"Error reading Excel file: {e}")
+        return None
+
+# Local PDF text layer: pages with fewer characters and an embedded image count as scanned.
+# A single scanned page sends the whole binary PDF to the model, so no positions are lost.
+PDF_TEXT_MIN_PAGE_CHARS = 80
+# Lines in the top/bottom margin repeated on at least this share of pages (digits ignored) are page headers/footers
+PDF_REPEATED_LINE_SHARE = 0.5
+PDF_MARGIN_LINES = 3
+# Ordnungszahl at the start of a line, e.g. "01.02.0010" or "1.2.10"
+POSITION_LINE_PATTERN = re.compile(r"^\d{1,4}(?:\.\d{1,4}){1,4}\.?\s")
+
+def pdf_page_has_image(page):
+    """True if the page draws an image XObject (a scan); blank and cover pages have none"""
+    try:
+        resources = page.get("/Resources")
+        xobjects = resources.get_object().get("/XObject") if resources is not None else None
+        if xobjects is None:
+            return False
+        xobjects = xobjects.get_object()
+        return any(xobjects[name].get_object().get("/Subtype") == "/Image" for name in xobjects)
+    except Exception:
+        return True  # Unreadable resources: do not risk dropping the page
+
+def compact_pdf_line(line):
+    """Compact one text-layer line: table columns become ' | ', fill-in dot leaders are dropped"""
+    line = re.sub(r"[._]{4,}", "", line).strip()
+    return re.sub(r"\s{3,}", " | ", line)
+
+def read_pdf_text_layer(source):
+    """
+    Read the text layer of a digital PDF (e.g. exported from AVA software) as compact text.
+    Keeps the line/column structure of the LV tables, drops repeated page headers and footers.
+    Returns None if pypdf is missing, any page is scanned, or no position lines are found;
+    the caller then uploads the binary PDF instead.
+    """
+    if PdfReader is None:
+        print("⚠️ pypdf not installed - uploading PDF as binary")
+        return None
+    try:
+        reader = PdfReader(open_source(source))
+        pages = []
+        scanned = []
+        for page_num, page in enumerate(reader.pages, start=1):
+            text = page.extract_text(extraction_mode="layout") or ""
+            if len(text.strip()) < PDF_TEXT_MIN_PAGE_CHARS and pdf_page_has_image(page):
+                scanned.append(page_num)
+            pages.append(text)
+    except Exception as e:
+        print(f"⚠️ Could not read PDF text layer: {e}")
+        return None
+    if not pages:
+        return None
+
+    # The text path would silently drop the positions on scanned pages
+    if scanned:
+        print(f"📷 {len(scanned)}/{len(pages)} pages without text layer (e.g. page {scanned[0]}) - uploading PDF as binary")
+        return None
+
+    page_lines = [[line for line in map(compact_pdf_line, text.splitlines()) if line] for text in pages]
+
+    # Page headers/footers ("Seite 3 von 120", project title) repeat on most pages
+    line_pages = {}
+    for lines in page_lines:
+        margin = lines[:PDF_MARGIN_LINES] + lines[-PDF_MARGIN_LINES:]
+        for key in {re.sub(r"\d+", "#", line) for line in margin}:
+            line_pages[key] = line_pages.get(key, 0) + 1
+    repeated = {key for key, count in line_pages.items()
+                if len(pages) >= 3 and count >= len(pages) * PDF_REPEATED_LINE_SHARE}
+
+    parts = []
+    position_lines = 0
+    for page_num, lines in enumerate(page_lines, start=1):
+        margin_end = max(len(lines) - PDF_MARGIN_LINES, PDF_MARGIN_LINES)
+        lines = [line for i, line in enumerate(lines)
+                 if PDF_MARGIN_LINES <= i < margin_end or re.sub(r"\d+", "#", line) not in repeated]
+        if lines:
+            position_lines += sum(1 for line in lines if POSITION_LINE_PATTERN.match(line))
+            parts.append(f"--- Seite {page_num} ---\n" + "\n".join(lines))
+
+    if position_lines == 0:
+        print("⚠️ No position numbers in PDF text layer - uploading PDF as binary")
+        return None
+
+    print(f"📄 PDF text layer: {len(pages)} pages, {position_lines} position lines, "
+          f"{len(repeated)} repeated header/footer lines removed")
+    return "\n".join(parts)
+
+# Word paragraphs and table cells (WordprocessingML)
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def read_docx_as_text(source):
+    """
+    Read the text of a .docx file: one line per paragraph, table rows as ' | '-separated cells.
+    Returns None if the file cannot be read (the caller then uploads it as binary).
+    """
+    try:
+        with zipfile.ZipFile(open_source(source)) as docx:
+            root = ET.fromstring(docx.read("word/document.xml"))
+    except Exception as e:
+        print(f"⚠️ Could not read Word document: {e}")
+        return None
+
+    def paragraph_text(paragraph):
+        return "".join(node.text or "" for node in paragraph.iter(f"{DOCX_NAMESPACE}t")).strip()
+
+    lines = []
+    body = root.find(f"{DOCX_NAMESPACE}body")
+    for element in (body if body is not None else []):
+        if element.tag == f"{DOCX_NAMESPACE}p":
+            text = paragraph_text(element)
+            if text:
+                lines.append(text)
+        elif element.tag == f"{DOCX_NAMESPACE}tbl":
+            for row in element.iter(f"{DOCX_NAMESPACE}tr"):
+                cells = [" ".join(filter(None, map(paragraph_text, cell.iter(f"{DOCX_NAMESPACE}p"))))
+                         for cell in row.iter(f"{DOCX_NAMESPACE}tc")]
+                if any(cells):
+                    lines.append(" | ".join(cells))
+    return "\n".join(lines) if lines else None
+
+# Boilerplate pre-filter: a block starts at a position number (first or second token),
+# a Titel/Los heading or a sheet/page marker
+PREFILTER_BLOCK_START = re.compile(
+    r"^(?:===|(?:titel|los|gewerk|abschnitt|bauteil|vorbemerkungen?)\b|(?:\S+\s+)?\d{1,4}(?:\.\d{1,4}){1,4}\.?\s)",
+    re.IGNORECASE
+)
+# Sheet markers separate blocks; page markers ("--- Seite N ---") do not, long texts continue across pages
+PREFILTER_MARKER = re.compile(r"^=== SHEET")
+# Quantity followed by a unit, e.g. "120,50 m³", "1 Psch", "25 St" (or in adjacent table columns)
+QUANTITY_UNIT_PATTERN = re.compile(
+    r"(?<![\w.,])\d{1,3}(?:[.\s]?\d{3})*(?:[.,]\d+)?\s*(?:\|\s*)?"
+    r"(?:m[²³23]?|lfdm|lfm|std|stck|stk|st|to|t|kg|psch|pauschal|l|wo|mt)(?![\w²³])",
+    re.IGNORECASE
+)
+# Clause, contract and preliminary-remark vocabulary that MASTER_EXTRACTION_PROMPT tells the model to ignore
+BOILERPLATE_PATTERN = re.compile(
+    r"vorbemerkung|ztv|vob|vertragsbedingung|auftragnehmer|auftraggeber|gewährleistung|"
+    r"haftung|abrechnung|zahlungs|vertragsstrafe|technische vorschriften|§",
+    re.IGNORECASE
+)
+# Blocks without quantity/unit longer than this are treated as prose even without clause vocabulary
+BOILERPLATE_MIN_CHARS = 400
+
+def split_text_blocks(text):
+    """
+    Split document text into blocks that start at position numbers or headings; sheet markers are blocks
+    of their own. Page markers and the lines after them stay in the open block (continued long texts).
+    """
+    blocks = []
+    for line in text.splitlines():
+        if not blocks or PREFILTER_BLOCK_START.match(line.lstrip()) or PREFILTER_MARKER.match(blocks[-1][0]):
+            blocks.append([line])
+        else:
+            blocks[-1].append(line)
+    return ["\n".join(block) for block in blocks]
+
+def is_boilerplate_block(block):
+    """
+    Rule-based classification of one text block. Blocks with a quantity and unit are position
+    candidates; blocks without one are boilerplate if they use clause vocabulary or are long prose.
+    Short blocks without either (Titel headings, table headers) are kept for context.
+    """
+    if QUANTITY_UNIT_PATTERN.search(block):
+        return False
+    return bool(BOILERPLATE_PATTERN.search(block)) or len(block) > BOILERPLATE_MIN_CHARS
 
-def extract_with_ai(file_path, file_extension, progress_bar=None, status_text=None):
+def prefilter_document_text(text, source="text"):
+    """
+    Drop non-position boilerplate (Vorbemerkungen, ZTV clauses, contract terms) before AI extraction.
+    Returns the filtered text, or the original text if no position candidates were recognized.
+    Tokens saved are reported in the log, the metrics and the run's cost tracker.
+    """
+    with metrics_span("prefilter", source=source) as span:
+        blocks = split_text_blocks(text)
+        kept = [block for block in blocks if PREFILTER_MARKER.match(block) or not is_boilerplate_block(block)]
+        if not any(QUANTITY_UNIT_PATTERN.search(block) for block in kept):
+            kept = blocks  # Nothing looks like a position - let the model see everything
+        # Sheet markers are only kept in front of remaining content
+        kept = [block for block, following in zip(kept, kept[1:] + [None])
+                if not PREFILTER_MARKER.match(block) or (following is not None and not PREFILTER_MARKER.match(following))]
+        filtered = "\n".join(kept)
+
+        tokens_before, tokens_after = len(text) // 4, len(filtered) // 4  # 1 token ≈ 4 characters
+        span["blocks"] = len(blocks)
+        span["dropped"] = len(blocks) - len(kept)
+        span["saved_tokens"] = tokens_before - tokens_after
+
+    registry = get_metrics_registry()
+    registry.inc("kalkulation_prefilter_tokens_total", tokens_after, source=source, outcome="kept")
+    registry.inc("kalkulation_prefilter_tokens_total", tokens_before - tokens_after, source=source, outcome="dropped")
+    cost_tracker = get_current_cost_tracker()
+    if cost_tracker is not None:
+        cost_tracker.prefilter_tokens += tokens_before
+        cost_tracker.prefilter_saved_tokens += tokens_before - tokens_after
+
+    saved_share = (tokens_before - tokens_after) / tokens_before if tokens_before else 0.0
+    print(f"🧹 Pre-filter ({source}): dropped {span['dropped']} of {len(blocks)} blocks, "
+          f"~{tokens_before - tokens_after:,} of ~{tokens_before:,} tokens saved ({saved_share:.0%})")
+    return filtered
+
+def extract_with_ai(source, file_extension, progress_bar=None, status_text=None, cost_budget=None, previous_df=None,
+                    file_name=None):
     """
     Master extraction function - sends file directly to AI for complete analysis.
 
     Args:
-        file_path: Path to the file to process
+        source: Path to the file to process, or the file's bytes (in-memory upload)
         file_extension: File extension (e.g., '.pdf', '.xlsx')
         progress_bar: Optional Streamlit progress bar to update
         status_text: Optional Streamlit text element to update status
+        cost_budget: Optional per-document budget in USD (None = configured default, 0 = no limit)
+        previous_df: Optional previous LV version; prices of unchanged positions are carried over
+        file_name: Display name of the document (defaults to the file name of a path source)
     """
     def update_progress(percent, message):
-        """Helper to update progress bar and status text"""
+        """Helper to update progress bar and status text (percentage and ETA from the learned stage rates)"""
+        percent, text = progress.render(percent, message)
         if progress_bar is not None:
-            progress_bar.progress(percent / 100, text=f"{percent}% - {message}")
+            progress_bar.progress(percent / 100, text=f"{percent}% - {text}")
         if status_text is not None:
-            status_text.text(message)
-        print(f"[{percent}%] {message}")
+            status_text.text(text)
+        print(f"[{percent}%] {text}")
 
-    # Start total timer
+    # Start total timer and a new trace for this run
     total_start_time = time.time()
+    progress = start_progress_tracking()
+    if file_name is None:
+        file_name = os.path.basename(source) if isinstance(source, (str, os.PathLike)) else "upload"
+    start_trace(file_name)
+    cost_tracker = start_cost_tracking(cost_budget)
 
     try:
         update_progress(5, "Starte Analyse...")
 
         print(f"\n{'='*70}")
         print(f"🤖 AI-POWERED EXTRACTION")
-        print(f"📄 File: {os.path.basename(file_path)}")
+        print(f"📄 File: {file_name}")
         print(f"📝 Extension: {file_extension}")
         print(f"{'='*70}\n")
 
-        # Check if file is Excel - handle differently
+        # Digital PDFs and Word files: send the compact, pre-filtered text instead of the binary file
         ext = file_extension.lower()
+        document_text, text_source = None, None
+        if ext == '.pdf':
+            update_progress(10, "Lese Textebene des PDF...")
+            text_source = "pdf_text"
+            with metrics_span("pdf_text_layer") as text_span:
+                document_text = read_pdf_text_layer(source)
+                text_span["chars"] = len(document_text or "")
+            if document_text is not None:
+                print(f"✅ PDF text layer read ({text_span['duration']:.2f}s)")
+        elif ext == '.docx':
+            update_progress(10, "Lese Word-Dokument...")
+            text_source = "docx_text"
+            with metrics_span("docx_text") as text_span:
+                document_text = read_docx_as_text(source)
+                text_span["chars"] = len(document_text or "")
+            if document_text is not None:
+                print(f"✅ Word document read ({text_span['duration']:.2f}s)")
+        if document_text is not None:
+            document_text = prefilter_document_text(document_text, text_source)
+
+        df = None  # Set directly by the pipelined extraction of large documents
+
+        # Check if file is Excel - handle differently
         if ext in ['.xlsx', '.xls']:
             # First check if Excel has the expected structure
             update_progress(10, "Prüfe Excel-Struktur...")
             print(f"🔍 Checking Excel structure...")
-            has_structure = check_excel_structure(file_path)
+            has_structure = check_excel_structure(source)
 
             if has_structure:
                 update_progress(15, "Excel-Struktur erkannt - Extrahiere Positionen...")
                 print(f"✓ Excel has expected structure - using direct extraction")
                 print(f"📊 Extracting positions from Excel...")
 
-                # Extract positions
-                positions = extract_positions_from_structured_excel(file_path)
+                # Extract positions; for a new LV each sheet goes straight into pricing
+                revision = previous_df is not None and not previous_df.empty
+                pipeline = None if revision else PricingPipeline(progress_callback=update_progress)
+                with metrics_span("local_extraction", source="excel_structured") as span:
+                    positions = extract_positions_from_structured_excel(source, on_sheet=pipeline.feed if pipeline else None)
+                    span["positions"] = len(positions)
 
+                if not positions and pipeline is not None:
+                    pipeline.cancel()
                 if positions:
-                    # Estimate prices with AI (pass progress callback)
-                    update_progress(30, "Schätze Preise mit KI...")
-                    positions = estimate_prices_with_ai(positions, progress_callback=update_progress)
+                    # Revised LV: only new and changed positions are priced
+                    positions_to_price = positions
+                    if revision:
+                        with metrics_span("lv_diff") as diff_span:
+                            new_df = pd.DataFrame({
+                                'pos': [p.get('ordnungszahl', '') for p in positions],
+                                'description': [p.get('langtext') or p.get('kurztext', '') for p in positions],
+                                'quantity': [p.get('menge') for p in positions],
+                                'unit': [p.get('einheit', 'Psch') for p in positions],
+                                'unit_price': 0.0,
+                                'price_source': None,
+                            })
+                            unpriced = carry_over_prices(diff_lv_versions(previous_df, new_df), previous_df, new_df)
+                            for pos, price, price_source in zip(positions, new_df['unit_price'], new_df['price_source']):
+                                if price:
+                                    pos['unit_price'] = float(price)
+                                    pos['price_source'] = price_source
+                            positions_to_price = [positions[i] for i in unpriced]
+                            diff_span["carried"] = len(positions) - len(positions_to_price)
+                        print(f"🔀 Revised LV: {diff_span['carried']} prices carried over, {len(positions_to_price)} positions to price")
+
+                    # Estimate prices with AI (pass progress callback); pipelined pricing only has the last batches left
+                    if pipeline is not None:
+                        pipeline.close()
+                    elif positions_to_price:
+                        update_progress(30, "Schätze Preise mit KI...")
+                        estimate_prices_with_ai(positions_to_price, progress_callback=update_progress)
 
                     # Convert to DataFrame
                     data = []
@@ -887,7 +2588,9 @@ def extract_with_ai(file_path, file_extension, progress_bar=None, status_text=No
                             'description': pos.get('langtext') or pos.get('kurztext', ''),
                             'quantity': qty,
                             'unit': pos.get('einheit', 'Psch'),
-                            'unit_price': pos.get('unit_price', 0.0)
+                            'unit_price': pos.get('unit_price', 0.0),
+                            'group': pos.get('sheet', ''),  # Sheet (Gewerk/Los) for grouping in the offer
+                            'price_source': pos.get('price_source', 'ai')
                         })
 
                     update_progress(90, "Erstelle Ergebnis-Tabelle...")
@@ -906,16 +2609,16 @@ def extract_with_ai(file_path, file_extension, progress_bar=None, status_text=No
             # Gemini doesn't support Excel MIME type directly
             update_progress(20, "Konvertiere Excel zu Text...")
             print(f"📊 Processing Excel file with AI (text conversion)...")
-            read_start = time.time()
 
             # Read Excel with size limit to prevent token overflow
-            excel_text = read_excel_as_text_chunked(file_path, max_rows=500)
-            read_time = time.time() - read_start
+            with metrics_span("excel_to_text") as span:
+                excel_text = read_excel_as_text_chunked(source, max_rows=500)
             update_progress(30, "Excel-Datei gelesen")
-            print(f"✅ Excel file read successfully ({read_time:.2f}s)")
+            print(f"✅ Excel file read successfully ({span['duration']:.2f}s)")
 
             if excel_text is None:
                 raise Exception("Failed to read Excel file")
+            excel_text = prefilter_document_text(excel_text, "excel_text")
 
             # Check text size and warn if too large
             text_length = len(excel_text)
@@ -924,85 +2627,129 @@ def extract_with_ai(file_path, file_extension, progress_bar=None, status_text=No
 
             if estimated_tokens > 900000:  # Leave margin below 1M token limit
                 print(f"⚠️ File is very large, using only first 500 rows to avoid token limit")
+            document_text, text_source = excel_text, "excel_text"
 
-            # Send text content to AI
+        if document_text is not None and len(document_text) > EXTRACTION_CHUNK_CHARS:
+            # Large document: extract chunk by chunk while the first positions are already being priced
             update_progress(40, "KI analysiert Dokument...")
-            print(f"\n🧠 AI analyzing document...")
+            with metrics_span("pipeline", source=text_source) as pipeline_span:
+                df = extract_text_in_pipeline(document_text, text_source,
+                                              price=previous_df is None or previous_df.empty,
+                                              progress_callback=update_progress)
+                pipeline_span["positions"] = len(df)
+            print(f"\n📥 Pipelined extraction finished: {len(df)} positions ({pipeline_span['duration']:.2f}s)")
+        elif document_text is not None:
+            update_progress(30, "Dokumenttext gelesen")
+            print(f"   Document text: ~{len(document_text) // 4:,} tokens")
+
+            extraction_units = len(document_text) / 1000  # Learned rate in seconds per 1,000 characters
+            report_work("extraction", 0, extraction_units, source=text_source)
+            update_progress(40, "KI analysiert Dokument...")
+            print(f"\n🧠 AI analyzing document text...")
             print(f"   Starting with: gemini-2.5-flash-lite (will auto-switch if needed)")
 
-            analysis_start = time.time()
-            prompt_with_data = f"{MASTER_EXTRACTION_PROMPT}\n\nDOKUMENT INHALT:\n{excel_text}"
-            response, model_used = call_ai_with_retry(
-                model='gemini-2.5-flash-lite',
-                contents=[prompt_with_data]
-            )
+            with metrics_span("analysis", source=text_source) as analysis_span:
+                response, model_used = call_ai_with_retry(
+                    model='gemini-2.5-flash-lite',
+                    contents=[f"DOKUMENT INHALT:\n{document_text}"],
+                    stage="extraction",
+                    static_prompt=MASTER_EXTRACTION_PROMPT,
+                    response_schema=POSITION_LIST_SCHEMA
+                )
+            report_work("extraction", extraction_units, extraction_units, source=text_source, final=True)
         else:
-            # For other file types, upload to Gemini
+            # For other file types (and scanned PDFs), upload to Gemini
             update_progress(15, "Lade Datei zur KI hoch...")
             print(f"📤 Uploading file to AI...")
-            upload_start = time.time()
             
             # Determine MIME type
-            mime_type = get_mime_type(file_path)
+            mime_type = get_mime_type(ext)
             print(f"   MIME Type: {mime_type}")
             
-            # Upload file to Gemini
-            try:
-                # Try with mime_type parameter
-                file_ref = genai.upload_file(
-                    path=file_path,
-                    mime_type=mime_type
-                )
-            except TypeError:
-                # Fallback: let it auto-detect
-                file_ref = genai.upload_file(path=file_path)
-            
-            upload_time = time.time() - upload_start
-            update_progress(30, "Datei hochgeladen")
-            print(f"✅ File uploaded successfully ({upload_time:.2f}s)")
-            print(f"   File URI: {file_ref.uri}")
-            print(f"   File Name: {file_ref.name}")
+            # Known documents are answered from the response cache (or a fixture in replay mode) without
+            # an upload: with file_hash the cache key depends on the file's content, not on its upload URI
+            file_hash = file_content_hash(source)
+            cached = lookup_cached_response(
+                response_cache_key('gemini-2.5-flash-lite', "extraction", [None], MASTER_EXTRACTION_PROMPT,
+                                   POSITION_LIST_SCHEMA, file_hash),
+                "extraction"
+            )
+            file_ref = None
+            if cached is None:
+                with metrics_span("upload", mime_type=mime_type) as upload_span:
+                    upload_span["bytes"] = source_size(source)
+                    # In-memory uploads are streamed from the buffer; file objects need an explicit MIME type
+                    file_ref = genai.upload_file(
+                        path=open_source(source),
+                        mime_type=mime_type,
+                        display_name=file_name
+                    )
+
+                update_progress(30, "Datei hochgeladen")
+                print(f"✅ File uploaded successfully ({upload_span['duration']:.2f}s)")
+                print(f"   File URI: {file_ref.uri}")
+                print(f"   File Name: {file_ref.name}")
 
             # Send to AI with master prompt
+            extraction_units = source_size(source) / 100000  # Learned rate in seconds per 100 KB
+            report_work("extraction", 0, extraction_units, source="file_upload")
             update_progress(40, "KI analysiert Dokument...")
             print(f"\n🧠 AI analyzing document...")
             print(f"   Starting with: gemini-2.5-flash-lite (will auto-switch if needed)")
 
-            analysis_start = time.time()
-            response, model_used = call_ai_with_retry(
-                model='gemini-2.5-flash-lite',
-                contents=[file_ref, MASTER_EXTRACTION_PROMPT]
-            )
-        analysis_time = time.time() - analysis_start
-        update_progress(70, "KI-Antwort erhalten")
-
-        if model_used != 'gemini-2.5-flash-lite':
-            print(f"   ✓ Used model: {model_used}")
-
-        text = response.text
-        print(f"\n📥 AI Response received ({analysis_time:.2f}s)")
-        print(f"   Length: {len(text)} characters")
-
-        # Parse JSON response
-        update_progress(80, "Verarbeite KI-Antwort...")
-        parse_start = time.time()
-        df = parse_json_response(text)
-        parse_time = time.time() - parse_start
-        print(f"   Parsing time: {parse_time:.2f}s")
+            with metrics_span("analysis", source="file_upload") as analysis_span:
+                if cached is not None:
+                    response, model_used = cached
+                else:
+                    response, model_used = call_ai_with_retry(
+                        model='gemini-2.5-flash-lite',
+                        contents=[file_ref],
+                        stage="extraction",
+                        static_prompt=MASTER_EXTRACTION_PROMPT,
+                        response_schema=POSITION_LIST_SCHEMA,
+                        file_hash=file_hash,
+                        use_cache=False  # Looked up above
+                    )
+            report_work("extraction", extraction_units, extraction_units, source="file_upload", final=True)
+        if df is None:
+            analysis_time = analysis_span["duration"]
+            update_progress(70, "KI-Antwort erhalten")
+
+            if model_used != 'gemini-2.5-flash-lite':
+                print(f"   ✓ Used model: {model_used}")
+
+            text = response.text
+            print(f"\n📥 AI Response received ({analysis_time:.2f}s)")
+            print(f"   Length: {len(text)} characters")
+
+            # Parse JSON response
+            update_progress(80, "Verarbeite KI-Antwort...")
+            with metrics_span("parse") as parse_span:
+                df = parse_json_response(text)
+                parse_span["positions"] = len(df)
+            print(f"   Parsing time: {parse_span['duration']:.2f}s")
         
         if not df.empty:
             print(f"\n✅ Extraction successful: {len(df)} positions found")
 
-            # Check for zero prices
-            zero_prices = (df['unit_price'] == 0).sum()
-            if zero_prices > 0:
-                update_progress(85, f"Korrigiere {zero_prices} Preise mit KI...")
-                print(f"⚠️  Warning: {zero_prices} positions with zero price")
+            # Revised LV: confirmed prices of unchanged positions replace the model's estimates
+            if previous_df is not None and not previous_df.empty:
+                with metrics_span("lv_diff") as diff_span:
+                    df['unit_price'] = pd.to_numeric(df['unit_price'], errors='coerce').fillna(0.0)
+                    unpriced = carry_over_prices(diff_lv_versions(previous_df, df), previous_df, df)
+                    diff_span["carried"] = len(df) - len(unpriced)
+                print(f"🔀 Revised LV: {diff_span['carried']} prices carried over")
+
+            # Local check for zero, implausible and outlier prices - only flagged rows go back to the model
+            price_flags = detect_price_outliers(df)
+            if not price_flags.empty and budget_allows_stage("price_correction"):
+                update_progress(85, f"Korrigiere {len(price_flags)} auffällige Preise mit KI...")
+                print(f"⚠️  Warning: {len(price_flags)} positions with zero or implausible price")
                 print(f"🔧 Requesting AI to fix prices...")
-                price_fix_start = time.time()
-                df = fix_prices_with_ai(df)
-                price_fix_time = time.time() - price_fix_start
-                print(f"   Price fixing time: {price_fix_time:.2f}s")
+                with metrics_span("price_correction") as fix_span:
+                    fix_span["flagged"] = len(price_flags)
+                    df = fix_prices_with_ai(df, price_flags)
+                print(f"   Price fixing time: {fix_span['duration']:.2f}s")
 
             # Calculate total time
             total_time = time.time() - total_start_time
@@ -1025,10 +2772,39 @@ def extract_with_ai(file_path, file_extension, progress_bar=None, status_text=No
         print(f"⏱️  Time before error: {total_time:.2f}s")
         return pd.DataFrame(columns=["pos", "description", "quantity", "unit", "unit_price"])
 
-def parse_json_response(text):
+    finally:
+        input_tokens, output_tokens = cost_tracker.total_tokens
+        print(f"💶 AI usage: {input_tokens:,} input / {output_tokens:,} output tokens, ~{cost_tracker.total_cost:.4f} USD")
+
+        # Record end-to-end duration and publish the metrics file for scraping
+        get_metrics_registry().observe(
+            "kalkulation_pipeline_duration_seconds",
+            time.time() - total_start_time,
+            file_type=file_extension.lower()
+        )
+        flush_metrics()
+
+def load_json_response(response, stage):
+    """
+    Parse a schema-constrained JSON response with a single json.loads.
+    Falls back to the tolerant text parser for models that ignore the schema.
+    Returns list of dictionaries.
+    """
+    try:
+        data = json.loads(response.text)
+        if isinstance(data, list):
+            get_metrics_registry().inc("kalkulation_parse_total", stage=stage, result="direct")
+            return data
+    except ValueError:
+        pass
+    return parse_json_response(response.text, stage=stage).to_dict('records')
+
+def parse_json_response(text, stage="extraction"):
     """
     Parse JSON from AI response with multiple fallback strategies.
+    Outcomes are counted per stage so schema-constrained output can be compared to free text.
     """
+    registry = get_metrics_registry()
     try:
         # Clean the response
         text = text.strip()
@@ -1041,6 +2817,7 @@ def parse_json_response(text):
             if isinstance(data, list) and len(data) > 0:
                 df = pd.DataFrame(data)
                 print(f"✓ JSON parsed (direct): {len(df)} positions")
+                registry.inc("kalkulation_parse_total", stage=stage, result="direct")
                 return df
         except:
             pass
@@ -1060,6 +2837,7 @@ def parse_json_response(text):
                     if isinstance(data, list) and len(data) > 0:
                         df = pd.DataFrame(data)
                         print(f"✓ JSON parsed (pattern match): {len(df)} positions")
+                        registry.inc("kalkulation_parse_total", stage=stage, result="fallback")
                         return df
                 except:
                     continue
@@ -1074,57 +2852,1384 @@ def parse_json_response(text):
                 if isinstance(data, list) and len(data) > 0:
                     df = pd.DataFrame(data)
                     print(f"✓ JSON parsed (manual extraction): {len(df)} positions")
+                    registry.inc("kalkulation_parse_total", stage=stage, result="fallback")
                     return df
             except:
                 pass
         
         print(f"⚠️  Could not parse JSON from response")
         print(f"📄 Response preview: {text[:500]}")
+        registry.inc("kalkulation_parse_total", stage=stage, result="failed")
         return pd.DataFrame(columns=["pos", "description", "quantity", "unit", "unit_price"])
     
     except Exception as e:
         print(f"❌ JSON parsing error: {e}")
+        registry.inc("kalkulation_parse_total", stage=stage, result="failed")
         return pd.DataFrame(columns=["pos", "description", "quantity", "unit", "unit_price"])
 
-def fix_prices_with_ai(df):
+def fix_prices_with_ai(df, flags=None):
     """
-    Send positions back to AI to fix zero or missing prices.
+    Re-price only rows with zero, implausible or outlier prices (see detect_price_outliers).
+    Flagged rows are sent as compact one-line records; all other prices stay untouched.
     """
     try:
-        print(f"\n🔧 PRICE CORRECTION WITH AI")
-        
-        # Convert to JSON
-        positions_json = df.to_json(orient='records', force_ascii=False, indent=2)
-        
-        print(f"📤 Sending {len(df)} positions for price correction...")
-        
-        # Create prompt with positions
-        prompt = PRICING_CORRECTION_PROMPT.format(positions_json=positions_json)
-        
-        # Send to AI with retry logic
-        response, model_used = call_ai_with_retry(
-            model='gemini-2.5-flash-lite',
-            contents=[prompt]
-        )
-        
-        if model_used != 'gemini-2.5-flash-lite':
-            print(f"   ✓ Used alternate model: {model_used}")
-        
-        # Parse response
-        df_fixed = parse_json_response(response.text)
-        
-        if not df_fixed.empty:
-            zero_after = (df_fixed['unit_price'] == 0).sum()
-            print(f"✅ Prices fixed: {zero_after} zero prices remaining")
-            return df_fixed
-        else:
-            print(f"⚠️  Price fix failed, returning original")
+        if flags is None:
+            flags = detect_price_outliers(df)
+        if flags.empty:
             return df
-            
+
+        print(f"\n🔧 PRICE CORRECTION WITH AI")
+        print(f"📤 Sending {len(flags)} of {len(df)} positions for price correction...")
+
+        df = df.copy()
+        corrected = 0
+        for batch_start in range(0, len(flags), PRICE_CORRECTION_BATCH_SIZE):
+            batch = flags.iloc[batch_start:batch_start + PRICE_CORRECTION_BATCH_SIZE]
+            row_ids = {f"Z{idx}": idx for idx in batch.index}
+            lines = "\n".join(
+                format_correction_line(row_id, df.loc[idx], batch.loc[idx]) for row_id, idx in row_ids.items()
+            )
+
+            try:
+                # Static instructions come from the context cache (or are prepended), only flagged rows vary
+                response, model_used = call_ai_with_retry(
+                    model='gemini-2.5-flash-lite',
+                    contents=[f"Positionen:\n{lines}"],
+                    stage="price_correction",
+                    static_prompt=PRICING_CORRECTION_PROMPT,
+                    response_schema=PRICE_LIST_SCHEMA
+                )
+            except BudgetExceededError as budget_error:
+                print(f"   💶 {budget_error} - stopping price correction")
+                break
+
+            if model_used != 'gemini-2.5-flash-lite':
+                print(f"   ✓ Used alternate model: {model_used}")
+
+            for item in load_json_response(response, stage="price_correction"):
+                if not isinstance(item, dict):
+                    continue
+                idx = row_ids.get(str(item.get('pos', '')).strip())
+                try:
+                    price = float(item['unit_price'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if idx is None or price <= 0:
+                    continue
+                df.loc[idx, 'unit_price'] = price
+                if 'price_source' in df.columns:
+                    df.loc[idx, 'price_source'] = "ai"
+                corrected += 1
+
+        zero_after = (pd.to_numeric(df['unit_price'], errors='coerce').fillna(0) <= 0).sum()
+        print(f"✅ Prices fixed: {corrected}/{len(flags)} corrected, {zero_after} zero prices remaining")
+        return df
+
     except Exception as e:
         print(f"❌ Price fixing error: {e}")
         return df
 
+# --- PRICE OUTLIER DETECTION ---
+# Robust statistics on log unit prices, document and price history pooled per unit and description cluster
+OUTLIER_Z_THRESHOLD = float(os.environ.get("KALKULATION_OUTLIER_Z", "3.5"))
+OUTLIER_IQR_FACTOR = 3.0        # Tukey "far out" fences on the unit level
+OUTLIER_MIN_GROUP = 5           # Groups with fewer prices give no statistics
+OUTLIER_MIN_SPREAD = 0.25       # Floor for MAD/IQR of log prices, so tight groups do not flag small deviations
+OUTLIER_UNCOMPARABLE_UNITS = {'', 'psch', 'pa'}   # Lump sums are not comparable per unit
+PRICE_CORRECTION_BATCH_SIZE = 100
+OUTLIER_REASONS = {
+    "zero": "Preis fehlt",
+    "cluster": "weicht stark von ähnlichen Positionen ab",
+    "unit": "unplausibel für die Einheit",
+}
+
+def description_clusters(descriptions):
+    """
+    Coarse description cluster per row: the longest word at the start of the text
+    (usually the noun compound, e.g. "stahlbetonwand" rather than "liefern").
+    """
+    words = descriptions.fillna("").astype(str).str[:80].str.lower().str.findall(r'[a-zäöüß]{4,}')
+    return words.map(lambda w: max(w, key=len) if w else "")
+
+def detect_price_outliers(df, history=None):
+    """
+    Flag zero, implausible and outlier unit prices without any model call.
+    Log prices are compared per (unit, description cluster) with a robust z-score (median/MAD)
+    and per unit with IQR fences; the price history is pooled in, so short documents are checked too.
+    Manual and history prices are never flagged.
+
+    Args:
+        df: Positions with description, unit, unit_price (optional price_source)
+        history: Optional DataFrame like PriceIndex.price_table() (default: the price index)
+
+    Returns:
+        DataFrame indexed like df (flagged rows only) with columns reason, reference_price
+    """
+    flags = pd.DataFrame({"reason": pd.Series(dtype=object), "reference_price": pd.Series(dtype=float)})
+    if df.empty:
+        return flags
+    if history is None:
+        history = get_price_index().price_table()
+
+    with metrics_span("outlier_detection") as span:
+        prices = pd.to_numeric(df['unit_price'], errors='coerce')
+        doc = pd.DataFrame({
+            "unit": df['unit'].fillna("").astype(str).map(normalize_unit),
+            "cluster": description_clusters(df['description']),
+            "log_price": np.log(prices.where(prices > 0)),
+        }, index=df.index)
+        hist = pd.DataFrame({
+            "unit": history['unit'].fillna("").astype(str).map(normalize_unit),
+            "cluster": description_clusters(history['description']),
+            "log_price": np.log(history['unit_price'].where(history['unit_price'] > 0)),
+        })
+        pool = pd.concat([doc, hist], ignore_index=True).dropna(subset=["log_price"])
+        pool = pool[~pool['unit'].isin(OUTLIER_UNCOMPARABLE_UNITS)]
+
+        # Cluster level: robust z-score against median and MAD
+        keys = [pool['unit'], pool['cluster']]
+        cluster_median = pool['log_price'].groupby(keys).transform('median')
+        cluster_stats = pd.DataFrame({
+            "cluster_median": pool['log_price'].groupby(keys).median(),
+            "cluster_mad": (pool['log_price'] - cluster_median).abs().groupby(keys).median(),
+            "cluster_count": pool['log_price'].groupby(keys).size(),
+        })
+        # Unit level: IQR fences for texts without a comparable cluster
+        by_unit = pool.groupby('unit')['log_price']
+        unit_stats = pd.DataFrame({
+            "unit_median": by_unit.median(),
+            "q1": by_unit.quantile(0.25),
+            "q3": by_unit.quantile(0.75),
+            "unit_count": by_unit.size(),
+        })
+        doc = doc.join(cluster_stats, on=["unit", "cluster"]).join(unit_stats, on="unit")
+
+        robust_z = 0.6745 * (doc['log_price'] - doc['cluster_median']) / doc['cluster_mad'].clip(lower=OUTLIER_MIN_SPREAD)
+        iqr = (doc['q3'] - doc['q1']).clip(lower=OUTLIER_MIN_SPREAD)
+        cluster_outlier = (doc['cluster_count'] >= OUTLIER_MIN_GROUP) & (robust_z.abs() > OUTLIER_Z_THRESHOLD)
+        unit_outlier = (doc['unit_count'] >= OUTLIER_MIN_GROUP) & (
+            (doc['log_price'] < doc['q1'] - OUTLIER_IQR_FACTOR * iqr) | (doc['log_price'] > doc['q3'] + OUTLIER_IQR_FACTOR * iqr)
+        )
+        has_text = df['description'].fillna("").astype(str).str.strip().str.len() > 3
+        zero = has_text & doc['log_price'].isna()
+
+        reason = pd.Series(np.select([zero, cluster_outlier, unit_outlier], ["zero", "cluster", "unit"], default=""), index=df.index)
+        if 'price_source' in df.columns:
+            reason[df['price_source'].isin(["manual", "history"])] = ""
+        reference = np.exp(doc['cluster_median'].where(doc['cluster_count'] >= OUTLIER_MIN_GROUP, doc['unit_median']))
+
+        flagged = reason != ""
+        flags = pd.DataFrame({"reason": reason[flagged], "reference_price": reference[flagged].round(2)})
+        span["positions"] = len(df)
+        span["flagged"] = len(flags)
+
+    registry = get_metrics_registry()
+    for name, count in flags['reason'].value_counts().items():
+        registry.inc("kalkulation_price_outliers_total", int(count), reason=name)
+    if len(flags):
+        print(f"🔎 Price check: {len(flags)}/{len(df)} positions flagged ({span['duration']*1000:.0f} ms)")
+    return flags
+
+def format_correction_line(row_id, row, flag):
+    """Compact one-line record of a flagged position for the correction prompt"""
+    description = " ".join(str(row['description']).split())[:200] if pd.notna(row['description']) else ""
+    price = pd.to_numeric(row['unit_price'], errors='coerce')
+    current = f"{price:.2f}" if pd.notna(price) and price > 0 else "-"
+    reference = f"{flag['reference_price']:.2f}" if pd.notna(flag['reference_price']) else "-"
+    quantity = row['quantity'] if pd.notna(row['quantity']) else ""
+    return (f"{row_id} | {row.get('pos', '') if pd.notna(row.get('pos')) else ''} | {description} | "
+            f"{quantity} {row['unit'] if pd.notna(row['unit']) else ''} | {current} | {OUTLIER_REASONS[flag['reason']]} | {reference}")
+
+# --- EXTRACTION/PRICING PIPELINE ---
+# Positions per pricing batch handed from extraction to pricing (one estimate_prices_with_ai batch)
+PIPELINE_BATCH_SIZE = 50
+# Batches buffered between the stages; when full, extraction waits for pricing (backpressure)
+PIPELINE_QUEUE_BATCHES = 4
+# Pause between pricing batches to stay below the API rate limits (as in estimate_prices_with_ai)
+PIPELINE_BATCH_DELAY = 2
+# Documents with more text than this are extracted chunk by chunk (~15k tokens per call)
+EXTRACTION_CHUNK_CHARS = 60000
+
+class PricingPipeline:
+    """
+    Prices positions while extraction is still running.
+    feed() hands over newly extracted positions (prefilled from the price history); full batches
+    go through a bounded queue to a worker thread that only makes the batch AI calls, matched via
+    one PositionIndex for the whole document. When the queue is full, feed() blocks, so extraction
+    never runs more than PIPELINE_QUEUE_BATCHES batches ahead of pricing. Retries of failed
+    batches, the fallback call and default prices run once in close().
+    Progress is reported from the calling (Streamlit) thread only.
+    """
+    def __init__(self, progress_callback=None, progress_range=(30, 85)):
+        self.progress_callback = progress_callback
+        self.progress_range = progress_range
+        self.queue = queue.Queue(maxsize=PIPELINE_QUEUE_BATCHES)
+        self.pending = []
+        self.positions = []           # All fed positions without a price
+        self.position_index = PositionIndex([])
+        self.failed_batches = []      # (batch number, positions) for the retry in close()
+        self.fed = 0
+        self.priced = 0
+        self.cancelled = False
+        self.budget_exhausted = False
+        # The worker gets a copy of the context so trace ID and cost tracker carry over
+        ctx = contextvars.copy_context()
+        self.worker = threading.Thread(target=ctx.run, args=(self._run,), name="pricing-pipeline", daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        batch_num = 0
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            batch_num += 1
+            if not self.cancelled and not self.budget_exhausted:
+                with metrics_span("pipeline_pricing") as span:
+                    span["batch"] = batch_num
+                    span["positions"] = len(batch)
+                    span["queued"] = self.queue.qsize()
+                    try:
+                        span["matched"] = apply_prices_from_data(get_ai_prices_for_batch(batch), batch, self.position_index)
+                    except BudgetExceededError as budget_error:
+                        # Remaining batches get unit-based default prices in close()
+                        print(f"   💶 {budget_error} - stopping AI pricing after batch {batch_num - 1}")
+                        self.budget_exhausted = True
+                    except Exception as batch_error:
+                        print(f"   ⚠️ Batch {batch_num} failed: {batch_error}")
+                        get_metrics_registry().inc("kalkulation_pricing_batch_failures_total", phase="first")
+                        self.failed_batches.append((batch_num, batch))
+            self.priced += len(batch)
+            if not self.queue.empty():
+                time.sleep(PIPELINE_BATCH_DELAY)
+
+    def _report(self, message, final=False):
+        report_work("pricing", self.priced, self.fed, final=final)
+        if self.progress_callback is not None and self.fed:
+            low, high = self.progress_range
+            self.progress_callback(low + int((high - low) * self.priced / self.fed), message)
+
+    def _put(self, batch):
+        self.fed += len(batch)
+        self.queue.put(batch)  # Blocks while pricing is PIPELINE_QUEUE_BATCHES batches behind
+        self._report(f"Schätze Preise... {self.priced}/{self.fed} Positionen")
+
+    def feed(self, positions):
+        """Queue positions without a price; full batches are priced immediately"""
+        unpriced = [pos for pos in positions if not pos.get('unit_price')]
+        self.position_index.add(unpriced)
+        self.positions.extend(unpriced)
+        self.pending.extend(prefill_prices_from_history(unpriced) if unpriced else [])
+        while len(self.pending) >= PIPELINE_BATCH_SIZE:
+            batch, self.pending = self.pending[:PIPELINE_BATCH_SIZE], self.pending[PIPELINE_BATCH_SIZE:]
+            self._put(batch)
+
+    def close(self):
+        """Price the remaining positions and wait for the pricing stage to finish"""
+        if self.pending:
+            self._put(self.pending)
+            self.pending = []
+        self.queue.put(None)
+        while self.worker.is_alive():
+            self.worker.join(timeout=0.5)
+            self._report(f"Schätze Preise... {self.priced}/{self.fed} Positionen", final=not self.worker.is_alive())
+        if not self.cancelled:
+            complete_missing_prices(self.positions, self.position_index, self.failed_batches, self.progress_callback)
+        get_metrics_registry().inc("kalkulation_pipeline_positions_total", self.fed)
+
+    def cancel(self):
+        """Stop pricing after the batch in progress (e.g. when extraction failed)"""
+        self.cancelled = True
+        self.pending = []
+        self.queue.put(None)
+
+def chunk_document_text(text, max_chars=EXTRACTION_CHUNK_CHARS):
+    """Split document text into extraction chunks at block boundaries, so no position is cut in half"""
+    chunks, current, size = [], [], 0
+    for block in split_text_blocks(text):
+        if current and size + len(block) > max_chars:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(block)
+        size += len(block) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def extract_text_in_pipeline(document_text, text_source, price=True, progress_callback=None):
+    """
+    Extract a large document text chunk by chunk. Positions of each chunk flow straight into a
+    PricingPipeline, so pricing of earlier chunks overlaps the extraction of later ones.
+    price=False (revised LVs) only extracts; the caller carries prices over instead.
+    Returns DataFrame with the columns of a single extraction call.
+    """
+    def to_price(value):
+        try:
+            return float(value or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    chunks = chunk_document_text(document_text)
+    print(f"🔀 Pipelined extraction: {len(chunks)} chunks of up to {EXTRACTION_CHUNK_CHARS:,} characters")
+    pipeline = PricingPipeline(progress_callback, progress_range=(80, 88)) if price else None
+    positions = []
+    total_units, done_units = len(document_text) / 1000, 0.0  # Extraction work in 1,000 characters
+    try:
+        for chunk_num, chunk in enumerate(chunks, start=1):
+            report_work("extraction", done_units, total_units, source=text_source)
+            if progress_callback is not None:
+                progress_callback(40 + int(40 * (chunk_num - 1) / len(chunks)), f"KI analysiert Abschnitt {chunk_num}/{len(chunks)}...")
+            with metrics_span("analysis", source=text_source) as span:
+                span["chunk"] = chunk_num
+                response, model_used = call_ai_with_retry(
+                    model='gemini-2.5-flash-lite',
+                    contents=[f"DOKUMENT INHALT (Abschnitt {chunk_num} von {len(chunks)}):\n{chunk}"],
+                    stage="extraction",
+                    static_prompt=MASTER_EXTRACTION_PROMPT,
+                    response_schema=POSITION_LIST_SCHEMA
+                )
+                chunk_positions = [
+                    {
+                        "ordnungszahl": str(item.get('pos') or ''),
+                        "kurztext": "",
+                        "langtext": str(item.get('description') or ''),
+                        "menge": item.get('quantity'),
+                        "einheit": str(item.get('unit') or 'Psch'),
+                        "unit_price": to_price(item.get('unit_price')),
+                    }
+                    for item in load_json_response(response, stage="extraction")
+                ]
+                span["positions"] = len(chunk_positions)
+            print(f"   ✓ Chunk {chunk_num}/{len(chunks)}: {len(chunk_positions)} positions ({span['duration']:.2f}s, {model_used})")
+            positions.extend(chunk_positions)
+            done_units += len(chunk) / 1000
+            report_work("extraction", done_units, total_units, source=text_source, final=chunk_num == len(chunks))
+            if pipeline is not None:
+                pipeline.feed(chunk_positions)
+    except BaseException:
+        if pipeline is not None:
+            pipeline.cancel()
+        raise
+
+    if pipeline is not None:
+        print(f"   ⏳ Waiting for pricing of {pipeline.fed - pipeline.priced} remaining positions...")
+        pipeline.close()
+
+    return pd.DataFrame({
+        'pos': [p['ordnungszahl'] for p in positions],
+        'description': [p['langtext'] for p in positions],
+        'quantity': [p['menge'] for p in positions],
+        'unit': [p['einheit'] for p in positions],
+        'unit_price': [p.get('unit_price') or 0.0 for p in positions],
+        'price_source': [p.get('price_source', 'ai') for p in positions],
+    }, columns=['pos', 'description', 'quantity', 'unit', 'unit_price', 'price_source'])
+
+# --- INCREMENTAL RE-PRICING ---
+# Manual price edits smaller than this are rounding from the German display format
+PRICE_EDIT_TOLERANCE = 0.005
+
+def position_content_hash(description, unit):
+    """Hash of the price-relevant content of a row (description and unit)"""
+    description = "" if pd.isna(description) else " ".join(str(description).split())
+    unit = "" if pd.isna(unit) else str(unit).strip()
+    return hashlib.sha1(f"{description}|{unit}".lower().encode('utf-8')).hexdigest()[:16]
+
+def mark_priced_rows(df, source="ai"):
+    """
+    Remember the priced state of every row: price_source (kept where already set) and the content hash at pricing time.
+    """
+    df['price_source'] = df['price_source'].fillna(source) if 'price_source' in df.columns else source
+    df['priced_hash'] = [position_content_hash(d, u) for d, u in zip(df['description'], df['unit'])]
+    return df
+
+def find_rows_to_reprice(df):
+    """
+    Rows that are new (never priced) or whose description/unit changed since pricing.
+    Rows with a manually entered price are never touched.
+    Returns list of index labels.
+    """
+    if df.empty:
+        return []
+    priced_hash = df['priced_hash'] if 'priced_hash' in df.columns else pd.Series(None, index=df.index)
+    price_source = df['price_source'] if 'price_source' in df.columns else pd.Series(None, index=df.index)
+
+    rows = []
+    for idx, description, unit in zip(df.index, df['description'], df['unit']):
+        if pd.isna(description) or len(str(description).strip()) <= 3:
+            continue
+        if price_source.get(idx) == "manual":
+            continue
+        if pd.isna(priced_hash.get(idx)) or priced_hash.get(idx) != position_content_hash(description, unit):
+            rows.append(idx)
+    return rows
+
+def mark_manual_price_edits(edited_df, old_df):
+    """
+    Flag rows whose unit price the user changed in the editor as price_source "manual".
+    """
+    if 'price_source' not in edited_df.columns:
+        edited_df['price_source'] = None
+    common = edited_df.index.intersection(old_df.index)
+    if len(common) == 0 or 'unit_price' not in old_df.columns:
+        return edited_df
+    new_prices = pd.to_numeric(edited_df.loc[common, 'unit_price'], errors='coerce')
+    old_prices = pd.to_numeric(old_df.loc[common, 'unit_price'], errors='coerce')
+    changed = (new_prices - old_prices).abs() > PRICE_EDIT_TOLERANCE
+    edited_df.loc[changed[changed].index, 'price_source'] = "manual"
+    return edited_df
+
+def reprice_rows(df, row_index, progress_callback=None, price_factor=1.0):
+    """
+    Send only the given rows through the pricing pipeline and merge the prices back.
+    price_factor: factor already applied to the other rows' EP (applied to the new prices as well).
+    Returns tuple: (updated DataFrame, cost_tracker)
+    """
+    start_trace("re-pricing")
+    cost_tracker = start_cost_tracking()
+
+    with metrics_span("reprice", source="editor") as span:
+        span["rows"] = len(row_index)
+        positions = []
+        for idx in row_index:
+            row = df.loc[idx]
+            positions.append({
+                "row_id": f"Z{idx}",  # Position numbers of new rows may be empty or duplicated
+                "ordnungszahl": str(row.get('pos', '')) if pd.notna(row.get('pos')) else "",
+                "kurztext": "",
+                "langtext": str(row['description']),
+                "beschreibung": str(row['description']),
+                "menge": row['quantity'] if pd.notna(row['quantity']) and row['quantity'] else 1.0,
+                "einheit": str(row['unit']) if pd.notna(row['unit']) and str(row['unit']).strip() else "Psch",
+            })
+
+        positions = estimate_prices_with_ai(positions, progress_callback=progress_callback)
+        # AI and history prices are base prices, the table's EP contain the applied factor
+        prices = apply_price_factor(pd.Series([float(pos.get('unit_price', 0.0) or 0.0) for pos in positions]), price_factor)
+
+        df = df.copy()
+        for idx, pos, price in zip(row_index, positions, prices):
+            df.loc[idx, 'unit_price'] = price
+            df.loc[idx, 'price_source'] = pos.get('price_source', "ai")
+            df.loc[idx, 'priced_hash'] = position_content_hash(df.loc[idx, 'description'], df.loc[idx, 'unit'])
+            if pd.isna(df.loc[idx, 'quantity']):
+                df.loc[idx, 'quantity'] = 1.0
+
+    flush_metrics()
+    return df, cost_tracker
+
+# --- MONEY ---
+# Fixed-point money: amounts are int64 cents, quantities int64 thousandths (vectorized in NumPy).
+# Rounding is kaufmännisch (half away from zero) and happens only at these points:
+#   EP: to the cent per position        GP = Menge x EP: to the cent per position
+#   Summen: exact integer sums of GP    MwSt: to the cent once on the offer total; Brutto = Netto + MwSt
+QUANTITY_SCALE = 1000    # Menge with 3 decimals (LV quantities have at most 3)
+FACTOR_SCALE = 10000     # Price factors with 4 decimals
+VAT_RATE_PERCENT = 19
+
+def _round_half_away(values):
+    """Round float values half away from zero to int64 (missing = 0); float noise like 0.285 -> 28.4999.. is removed first"""
+    values = np.round(np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0), 6)
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64)
+
+def _divide_half_away(numerator, denominator):
+    """Exact integer division of int64 values, rounded half away from zero"""
+    numerator = np.asarray(numerator, dtype=np.int64)
+    return np.sign(numerator) * ((np.abs(numerator) + denominator // 2) // denominator)
+
+def to_cents(euros):
+    """Euro amounts (scalar, array or Series; missing = 0) as int64 cents"""
+    return _round_half_away(np.asarray(pd.to_numeric(euros, errors='coerce'), dtype=np.float64) * 100)
+
+def cents_to_euros(cents):
+    """Cents as float euros (exact to the cent far beyond any offer total)"""
+    return np.asarray(cents, dtype=np.int64) / 100
+
+def format_cents(cents):
+    """Cents as plain decimal string without float conversion: 123456 -> '1234.56'"""
+    cents = int(cents)
+    return f"{'-' if cents < 0 else ''}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def round_prices(euros):
+    """Unit prices rounded to whole cents, kept as float euros for editing and storage (missing stays missing)"""
+    values = pd.to_numeric(pd.Series(euros), errors='coerce')
+    return pd.Series(cents_to_euros(to_cents(values)), index=values.index).where(values.notna())
+
+def round_quantity(quantity):
+    """Menge rounded to the precision used by the money engine"""
+    return float(_round_half_away(float(quantity) * QUANTITY_SCALE)) / QUANTITY_SCALE
+
+def line_totals_cents(quantity, unit_price):
+    """GP per position in cents: Menge (to 1/1000) x EP (to the cent), rounded to the cent"""
+    quantity = _round_half_away(np.asarray(pd.to_numeric(quantity, errors='coerce'), dtype=np.float64) * QUANTITY_SCALE)
+    return _divide_half_away(quantity * to_cents(unit_price), QUANTITY_SCALE)
+
+def apply_price_factor(unit_prices, factor):
+    """Unit prices (Series) times a factor (to 4 decimals), each rounded to the cent"""
+    factor = int(_round_half_away(float(factor) * FACTOR_SCALE))
+    values = pd.to_numeric(unit_prices, errors='coerce')
+    cents = _divide_half_away(to_cents(values) * factor, FACTOR_SCALE)
+    return pd.Series(cents_to_euros(cents), index=values.index).where(values.notna())
+
+def remove_price_factor(unit_prices, factor):
+    """Unit prices (Series) without a previously applied factor, each rounded to the cent"""
+    values = pd.to_numeric(unit_prices, errors='coerce')
+    cents = _round_half_away(to_cents(values) / float(factor))
+    return pd.Series(cents_to_euros(cents), index=values.index).where(values.notna())
+
+def offer_totals(net_cents):
+    """Netto, MwSt and Brutto in cents; MwSt is rounded once on the total"""
+    net_cents = int(net_cents)
+    vat_cents = int(_divide_half_away(net_cents * VAT_RATE_PERCENT, 100))
+    return net_cents, vat_cents, net_cents + vat_cents
+
+def benchmark_money_engine(rows=100000, adjustments=10):
+    """
+    Compare the cent engine with plain float arithmetic on a synthetic LV.
+    Both paths apply the price factor 1.07 `adjustments` times, then compute GP per row and Netto/MwSt/Brutto.
+    Returns dict with seconds per path (factor, totals) and the float path's gap between the sum of its
+    printed GP and its printed Netto in cents (the cent engine has none by construction).
+    """
+    rng = np.random.default_rng(0)
+    quantity = pd.Series(np.round(rng.uniform(0.5, 500, rows), 3))
+    unit_price = pd.Series(np.round(rng.uniform(5, 2500, rows), 2))
+    result = {"rows": rows}
+
+    start = time.perf_counter()
+    float_prices = unit_price
+    for _ in range(adjustments):
+        float_prices = float_prices * 1.07
+    result["float_factor_seconds"] = time.perf_counter() - start
+    start = time.perf_counter()
+    float_lines = quantity * float_prices
+    float_net = float(float_lines.sum())
+    float_gross = float_net * (1 + VAT_RATE_PERCENT / 100)
+    result["float_totals_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cent_prices = unit_price
+    for _ in range(adjustments):
+        cent_prices = apply_price_factor(cent_prices, 1.07)
+    result["cents_factor_seconds"] = time.perf_counter() - start
+    start = time.perf_counter()
+    cent_lines = line_totals_cents(quantity, cent_prices)
+    net, vat, gross = offer_totals(cent_lines.sum())
+    result["cents_totals_seconds"] = time.perf_counter() - start
+
+    result.update({
+        "float_net": float_net, "float_gross": float_gross, "cents_net": net / 100, "cents_gross": gross / 100,
+        "float_gap_cents": int(to_cents(float_lines).sum() - to_cents(float_net)),
+        "cents_gap_cents": int(cent_lines.sum() - net),
+    })
+    return result
+
+# --- SESSION DATA MODEL ---
+CALCULATION_COLUMNS = ["pos", "description", "quantity", "unit", "unit_price"]
+CALCULATION_CATEGORY_COLUMNS = ["unit", "group", "price_source"]   # Few distinct values per LV
+CALCULATION_INTERNED_COLUMNS = ["pos", "description", "priced_hash"]  # Shared between sessions and reruns
+
+def empty_calculation_df():
+    """Empty calculation table with the session column layout"""
+    return compact_calculation_df(pd.DataFrame(columns=CALCULATION_COLUMNS))
+
+def _intern_text(value):
+    """Interned string (one object per distinct text in the process), None for missing values"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return sys.intern(str(value))
+
+def compact_calculation_df(df):
+    """
+    Compact typed representation of the calculation table kept in session state:
+    float64 quantity/unit_price (EP to the cent), categorical unit/group/price_source, interned text columns.
+    Derived values (total_price, display strings) and redundant columns are not stored.
+    """
+    df = df.drop(columns=[c for c in ("total_price", "original_price", "price_factor",
+                                      "quantity_display", "unit_price_display", "total_price_display") if c in df.columns])
+    for col in ("quantity", "unit_price"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+    if 'unit_price' in df.columns:
+        df['unit_price'] = round_prices(df['unit_price'])  # EP is stored to the cent, as shown and exported
+    for col in CALCULATION_INTERNED_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.Series([_intern_text(v) for v in df[col]], index=df.index, dtype=object)
+    for col in CALCULATION_CATEGORY_COLUMNS:
+        if col in df.columns:
+            values = df[col].astype(object)
+            df[col] = (values.where(values.notna(), '') if col == 'group' else values).astype('category')
+    return df
+
+def editable_view(df):
+    """
+    Editor view of the compact table: categorical columns as plain text (free input instead of
+    a selectbox). Only assign whole columns to it; copy it before writing into cells.
+    """
+    return df.astype({col: object for col in CALCULATION_CATEGORY_COLUMNS if col in df.columns})
+
+def calculation_memory_report(df):
+    """
+    Memory used by a calculation table.
+    Returns dict: total bytes, bytes per column and bytes of distinct texts (shared storage).
+    """
+    usage = df.memory_usage(deep=True, index=True)
+    distinct_text_bytes = sum(
+        sys.getsizeof(v) for col in CALCULATION_INTERNED_COLUMNS if col in df.columns
+        for v in {id(v): v for v in df[col] if v is not None}.values()
+    )
+    return {
+        "rows": len(df),
+        "total_bytes": int(usage.sum()),
+        "columns": {col: int(size) for col, size in usage.items()},
+        "distinct_text_bytes": distinct_text_bytes,
+    }
+
+# --- LV HIERARCHY ---
+# Large LVs are edited page by page; smaller ones keep the single full editor
+EDITOR_PAGE_SIZE = 200
+EDITOR_PAGED_MIN_ROWS = 500
+
+def ordnungszahl_parents(oz):
+    """
+    Hierarchy levels (Los/Titel/Untertitel) above a position, derived from its Ordnungszahl.
+    "01.02.0030" -> ["01", "01.02"]; positions without dotted OZ have no parents.
+    """
+    if oz is None or pd.isna(oz):
+        return []
+    segments = [seg for seg in str(oz).strip().rstrip('.').split('.') if seg.strip()]
+    return ['.'.join(segments[:depth]) for depth in range(1, len(segments))]
+
+def titel_keys(df, level=1):
+    """Series with the hierarchy node of every row at the given level ('' where the OZ is shallower)"""
+    return pd.Series(
+        [parents[level - 1] if len(parents) >= level else '' for parents in map(ordnungszahl_parents, df['pos'])],
+        index=df.index, dtype=object
+    )
+
+def filter_editor_rows(df, titel=None, search=""):
+    """
+    Index labels of rows in a Titel (with all Untertitel) that match the search text
+    (OZ prefix or part of the description, case-insensitive).
+    """
+    mask = pd.Series(True, index=df.index)
+    if titel:
+        mask &= titel_keys(df, 1) == titel
+    search = (search or "").strip()
+    if search:
+        pos_text = df['pos'].astype(object).fillna('').astype(str)
+        description = df['description'].astype(object).fillna('').astype(str)
+        mask &= pos_text.str.startswith(search) | description.str.contains(search, case=False, regex=False)
+    return df.index[mask]
+
+def merge_editor_page(df, page_rows, edited_page, added_count=0):
+    """
+    Merge one edited editor page back into the full table by index label: rows of the page are
+    updated, rows missing from it are deleted, and added rows (the last added_count rows of the
+    page) are inserted after the page's last row with new labels and the group of that row.
+    Returns a new table (editable view).
+    """
+    merged = editable_view(df).copy()
+    kept = edited_page.iloc[:len(edited_page) - added_count]
+    merged.loc[kept.index, CALCULATION_COLUMNS] = kept[CALCULATION_COLUMNS]
+    if added_count:
+        added = edited_page.iloc[len(edited_page) - added_count:][CALCULATION_COLUMNS].copy()
+        start = int(df.index.max()) + 1 if len(df) else 0
+        added.index = pd.RangeIndex(start, start + added_count)
+        if 'group' in merged.columns:
+            added['group'] = merged.at[page_rows[-1], 'group'] if len(page_rows) else ''
+        insert_at = merged.index.get_loc(page_rows[-1]) + 1 if len(page_rows) else len(merged)
+        merged = pd.concat([merged.iloc[:insert_at], added, merged.iloc[insert_at:]])
+    return merged.drop(index=page_rows.difference(kept.index))
+
+# --- OFFER GROUPING ---
+def iter_offer_groups(df):
+    """
+    Split positions into offer groups (sheet / Gewerk / Los) in order of first appearance.
+    Yields tuples (group_name, group_df); a single (None, df) when there is nothing to group.
+    """
+    if 'group' not in df.columns:
+        yield None, df
+        return
+    groups = df['group'].fillna('').astype(str)
+    if groups.nunique() <= 1:
+        yield None, df
+        return
+    for group_name in groups.unique():
+        yield group_name, df[groups == group_name]
+
+class LVTree:
+    """
+    Hierarchical LV model: nodes (group, OZ prefix) with subtotals, e.g. ("", "01") for Titel 01.
+    Each group (sheet / Los) has a root node (group, ""). Row totals are remembered, so an update
+    only pushes the deltas of changed rows up their ancestor chain. All totals are integer cents,
+    so repeated updates cannot drift.
+    """
+    def __init__(self, df):
+        self.rebuild(df)
+
+    @staticmethod
+    def _row_totals(df):
+        return line_totals_cents(df['quantity'], df['unit_price'])
+
+    @staticmethod
+    def _row_keys(df):
+        groups = df['group'].astype(object).fillna('').astype(str) if 'group' in df.columns else pd.Series('', index=df.index)
+        return list(zip(groups, df['pos'].astype(object)))
+
+    def rebuild(self, df):
+        """Full build from the calculation table"""
+        self.index = df.index.copy()
+        self.row_keys = self._row_keys(df)
+        self.row_totals = self._row_totals(df)
+        self.row_nodes = [
+            [(group, '')] + [(group, parent) for parent in ordnungszahl_parents(oz)]
+            for group, oz in self.row_keys
+        ]
+        self.node_totals = {}
+        self.node_counts = {}
+        for nodes, total in zip(self.row_nodes, self.row_totals):
+            for node in nodes:
+                self.node_totals[node] = self.node_totals.get(node, 0) + int(total)
+                self.node_counts[node] = self.node_counts.get(node, 0) + 1
+
+    def update(self, df):
+        """
+        Bring subtotals in line with df. Only rows whose total changed are propagated; the tree
+        is rebuilt when rows were added, removed or renumbered.
+        Returns number of changed rows (-1 after a rebuild).
+        """
+        if not self.index.equals(df.index) or self._row_keys(df) != self.row_keys:
+            self.rebuild(df)
+            return -1
+        new_totals = self._row_totals(df)
+        changed = np.flatnonzero(new_totals != self.row_totals)
+        for row in changed:
+            delta = int(new_totals[row] - self.row_totals[row])
+            for node in self.row_nodes[row]:
+                self.node_totals[node] += delta
+        self.row_totals = new_totals
+        return len(changed)
+
+    @property
+    def total_cents(self):
+        """Offer total over all groups in cents"""
+        return sum(total for (group, path), total in self.node_totals.items() if path == '')
+
+    @property
+    def total(self):
+        """Offer total over all groups in euros"""
+        return self.total_cents / 100
+
+    def subtotal(self, group, path=''):
+        """Subtotal of a node in euros"""
+        return self.node_totals.get((group, path), 0) / 100
+
+    def parents_of(self, label):
+        """Titel nodes above a row (without the group root)"""
+        return self.row_nodes[self.index.get_loc(label)][1:]
+
+    def summary_df(self):
+        """Titel subtotals for display, in OZ order"""
+        rows = [
+            {"Los/Blatt": group, "Titel": path, "Ebene": path.count('.') + 1,
+             "Positionen": self.node_counts[(group, path)], "Summe netto": total / 100}
+            for (group, path), total in self.node_totals.items() if path
+        ]
+        return pd.DataFrame(rows, columns=["Los/Blatt", "Titel", "Ebene", "Positionen", "Summe netto"])
+
+def sync_lv_tree(tree, df):
+    """Incrementally update the session's LV tree (or build it on first use)"""
+    if tree is None:
+        return LVTree(df)
+    tree.update(df)
+    return tree
+
+def offer_section_order(group_df, tree):
+    """
+    Rows of a group ordered so that every Titel is one contiguous block: Titel and positions keep
+    the order of their first appearance, later rows of an already started Titel move up to it.
+    """
+    ranks = {}
+    keys = []
+    for label in group_df.index:
+        path = tuple(tree.parents_of(label)) + ((None, label),)
+        keys.append(tuple(ranks.setdefault(path[:depth + 1], len(ranks)) for depth in range(len(path))))
+    return group_df.iloc[sorted(range(len(keys)), key=keys.__getitem__)]
+
+def iter_offer_sections(df, tree):
+    """
+    Offer layout grouped by group and Titel structure (document order within each Titel). Yields
+      ("heading", label, depth), ("position", row), ("subtotal", label, depth, amount)
+    where row is an itertuples record and depth 0 is the group (sheet / Gewerk / Los).
+    """
+    for group_name, group_df in iter_offer_groups(df):
+        group = group_name or ''
+        group_label = group_name or 'Ohne Zuordnung'
+        if group_name is not None:
+            yield ("heading", group_label, 0)
+        open_nodes = []
+        for row in offer_section_order(group_df, tree).itertuples():
+            parents = tree.parents_of(row.Index)
+            common = 0
+            while common < min(len(open_nodes), len(parents)) and open_nodes[common] == parents[common]:
+                common += 1
+            while len(open_nodes) > common:
+                node = open_nodes.pop()
+                yield ("subtotal", f"Titel {node[1]}", len(open_nodes) + 1, tree.subtotal(*node))
+            for node in parents[common:]:
+                open_nodes.append(node)
+                yield ("heading", f"Titel {node[1]}", len(open_nodes))
+            yield ("position", row)
+        while open_nodes:
+            node = open_nodes.pop()
+            yield ("subtotal", f"Titel {node[1]}", len(open_nodes) + 1, tree.subtotal(*node))
+        if group_name is not None:
+            yield ("subtotal", group_label, 0, tree.subtotal(group))
+
+# --- LV VERSION DIFF ---
+DIFF_STATUS_LABELS = {"added": "Neu", "removed": "Entfallen", "changed": "Geändert", "unchanged": "Unverändert"}
+
+def _diff_rows(df):
+    """
+    Per row (in order): index label, pos, description, quantity, unit, unit price and the
+    normalized match keys (OZ, text, unit). Duplicate keys get an occurrence number.
+    """
+    quantity = pd.to_numeric(df['quantity'], errors='coerce')
+    unit_price = pd.to_numeric(df['unit_price'], errors='coerce').fillna(0.0)
+    rows = []
+    seen = {}
+    for idx, oz, description, qty, unit, price in zip(df.index, df['pos'], df['description'], quantity, df['unit'], unit_price):
+        text_key = "" if pd.isna(description) else " ".join(str(description).split()).lower()
+        unit_key = "" if pd.isna(unit) else normalize_unit(unit)
+        oz_key = normalize_position_number(oz) if not pd.isna(oz) and str(oz).strip() else ""
+        base = oz_key or f"#{text_key}|{unit_key}"  # Positions without OZ are matched by content
+        seen[base] = seen.get(base, 0) + 1
+        rows.append({"index": idx, "pos": oz, "description": description, "quantity": None if pd.isna(qty) else float(qty),
+                     "unit": unit, "unit_price": float(price), "oz_key": oz_key, "text_key": text_key,
+                     "unit_key": unit_key, "key": (base, seen[base])})
+    return rows
+
+def diff_lv_versions(old_df, new_df):
+    """
+    Position-level diff of two LV versions in linear time.
+    Positions are matched by OZ; unmatched ones by identical text and unit (renumbered positions).
+    Returns DataFrame (one row per position of either version) with status, changes, the
+    positions' fields and old_index / new_index, plus reuse_price: True where the old unit
+    price still applies (same text and unit; quantity or OZ may differ) and is a real price (> 0).
+    """
+    old_rows, new_rows = _diff_rows(old_df), _diff_rows(new_df)
+    old_by_key = {row["key"]: row for row in old_rows}
+    pairs = []
+    unmatched_new = []
+    for new in new_rows:
+        old = old_by_key.pop(new["key"], None)
+        if old is None:
+            unmatched_new.append(new)
+        else:
+            pairs.append((old, new))
+
+    # Renumbered positions: same text and unit under a different OZ
+    old_by_content = {}
+    for old in old_by_key.values():
+        old_by_content.setdefault((old["text_key"], old["unit_key"]), deque()).append(old)
+    for new in unmatched_new:
+        candidates = old_by_content.get((new["text_key"], new["unit_key"]))
+        pairs.append((candidates.popleft() if candidates else None, new))
+    pairs.extend((old, None) for candidates in old_by_content.values() for old in candidates)
+
+    records = []
+    for old, new in pairs:
+        if old is None or new is None:
+            status, changes, reuse_price = ("added" if old is None else "removed"), "", False
+        else:
+            same_text = old["text_key"] == new["text_key"]
+            same_unit = old["unit_key"] == new["unit_key"]
+            changes = [label for label, changed in (
+                ("OZ", old["oz_key"] != new["oz_key"]), ("Text", not same_text),
+                ("Menge", old["quantity"] != new["quantity"]), ("Einheit", not same_unit)) if changed]
+            status, changes = ("changed" if changes else "unchanged"), ", ".join(changes)
+            reuse_price = same_text and same_unit and old["unit_price"] > 0
+        current = new or old
+        records.append((status, changes, current["pos"], current["description"],
+                        old["quantity"] if old else None, new["quantity"] if new else None, current["unit"],
+                        old["unit_price"] if old else None, old["index"] if old else None,
+                        new["index"] if new else None, reuse_price))
+    return pd.DataFrame(records, dtype=object, columns=[
+        "status", "changes", "pos", "description", "old_quantity", "new_quantity",
+        "unit", "old_unit_price", "old_index", "new_index", "reuse_price"]).astype({"reuse_price": bool})
+
+def carry_over_prices(diff, old_df, new_df):
+    """
+    Copy unit price and price source of positions with unchanged text and unit into new_df.
+    Old positions without a price (0 or missing) are not reused.
+    Returns list of new_df index labels that still need pricing.
+    """
+    reuse = diff[diff['reuse_price'] & (pd.to_numeric(diff['old_unit_price'], errors='coerce') > 0)]
+    for old_idx, new_idx in zip(reuse['old_index'], reuse['new_index']):
+        new_df.loc[new_idx, 'unit_price'] = old_df.loc[old_idx, 'unit_price']
+        if 'price_source' in old_df.columns:
+            new_df.loc[new_idx, 'price_source'] = old_df.loc[old_idx, 'price_source']
+    reused = set(reuse['new_index'])
+    return [idx for idx in new_df.index if idx not in reused]
+
+def lv_diff_report(diff):
+    """Excel report of an LV diff (changed, added and removed positions; unchanged ones are summarized)"""
+    report = diff[diff['status'] != 'unchanged']
+    report = pd.DataFrame({
+        "Status": report['status'].map(DIFF_STATUS_LABELS),
+        "Änderung": report['changes'],
+        "Pos.": report['pos'],
+        "Leistungsbezeichnung": report['description'],
+        "Menge alt": report['old_quantity'],
+        "Menge neu": report['new_quantity'],
+        "Einheit": report['unit'],
+        "EP alt (€)": report['old_unit_price'],
+        "EP übernommen": report['reuse_price'].map({True: "ja", False: "nein"}),
+    })
+    counts = diff['status'].value_counts()
+    summary = pd.DataFrame([{"Status": DIFF_STATUS_LABELS[status], "Positionen": int(counts.get(status, 0))}
+                            for status in DIFF_STATUS_LABELS])
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        summary.to_excel(writer, index=False, sheet_name='Übersicht')
+        report.to_excel(writer, index=False, sheet_name='Änderungen')
+        writer.sheets['Änderungen'].column_dimensions['D'].width = 60
+    return buffer.getvalue()
+
+# --- PROJECT STORE ---
+# Projects survive browser refreshes, session timeouts and restarts (SQLite in WAL mode)
+PROJECT_DB_FILE = os.path.join(DATA_DIR, "projects.sqlite3")
+PROJECT_MAX_VERSIONS = 50   # Oldest versions beyond this are pruned per project
+PROJECT_AUTOSAVE_MINUTES = 10   # Autosaves within this interval replace the previous autosave version
+
+class ProjectStore:
+    """
+    Process-wide SQLite store for projects and their version history, scoped by owner key.
+    Every save whose content differs from the latest version adds a new version; consecutive
+    autosaves replace each other within PROJECT_AUTOSAVE_MINUTES, so editor changes do not push
+    the real history out. Positions are stored column-wise as compressed JSON so large LVs load in one read.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                link TEXT,
+                price_factor REAL,
+                created TEXT NOT NULL,
+                updated TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS versions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                created TEXT NOT NULL,
+                note TEXT,
+                row_count INTEGER NOT NULL,
+                total REAL,
+                content_hash TEXT NOT NULL,
+                positions BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_versions_project ON versions(project_id, id);
+        """)
+        # Stores created before owner scoping: their projects have no owner and are not listed
+        if "owner" not in [row[1] for row in self.conn.execute("PRAGMA table_info(projects)")]:
+            self.conn.execute("ALTER TABLE projects ADD COLUMN owner TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_projects_owner ON projects(owner, updated)")
+        self.conn.commit()
+
+    @staticmethod
+    def _encode_positions(df):
+        columns = {col: df[col].astype(object).where(df[col].notna(), None).tolist() for col in df.columns}
+        return zlib.compress(json.dumps(columns, ensure_ascii=False).encode('utf-8'), 6)
+
+    @staticmethod
+    def _decode_positions(blob):
+        return compact_calculation_df(pd.DataFrame(json.loads(zlib.decompress(blob).decode('utf-8'))))
+
+    def save(self, owner, project_id, df, name, link="", price_factor=1.0, content_hash=None, note="autosave"):
+        """
+        Save project settings and, if the positions changed, a new version (or replace the latest
+        autosave version). A project_id of another owner is not touched; a new project is created instead.
+        Returns project_id (a new one when project_id is None).
+        """
+        now = datetime.now()
+        timestamp = now.isoformat(timespec='seconds')
+        content_hash = content_hash or calculation_content_hash(df)
+        with self.lock, self.conn:
+            if project_id is not None:
+                updated = self.conn.execute(
+                    "UPDATE projects SET name = ?, link = ?, price_factor = ?, updated = ? WHERE id = ? AND owner = ?",
+                    (name, link, price_factor, timestamp, project_id, owner)
+                ).rowcount
+                if not updated:
+                    project_id = None
+            if project_id is None:
+                project_id = self.conn.execute(
+                    "INSERT INTO projects (name, link, price_factor, created, updated, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, link, price_factor, timestamp, timestamp, owner)
+                ).lastrowid
+            latest = self.conn.execute(
+                "SELECT id, content_hash, note, created FROM versions WHERE project_id = ? ORDER BY id DESC LIMIT 1", (project_id,)
+            ).fetchone()
+            if latest is None or latest[1] != content_hash:
+                total = int(line_totals_cents(df['quantity'], df['unit_price']).sum()) / 100
+                positions = self._encode_positions(df)
+                if (note == "autosave" and latest is not None and latest[2] == "autosave"
+                        and now - datetime.fromisoformat(latest[3]) < timedelta(minutes=PROJECT_AUTOSAVE_MINUTES)):
+                    self.conn.execute(
+                        "UPDATE versions SET created = ?, row_count = ?, total = ?, content_hash = ?, positions = ? WHERE id = ?",
+                        (timestamp, len(df), total, content_hash, positions, latest[0])
+                    )
+                else:
+                    self.conn.execute(
+                        "INSERT INTO versions (project_id, created, note, row_count, total, content_hash, positions) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (project_id, timestamp, note, len(df), total, content_hash, positions)
+                    )
+                    self.conn.execute(
+                        "DELETE FROM versions WHERE project_id = ? AND id NOT IN "
+                        "(SELECT id FROM versions WHERE project_id = ? ORDER BY id DESC LIMIT ?)",
+                        (project_id, project_id, PROJECT_MAX_VERSIONS)
+                    )
+        return project_id
+
+    def list_projects(self, owner, limit=20):
+        """Most recently updated projects of an owner as list of dicts"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT p.id, p.name, p.updated, (SELECT row_count FROM versions v WHERE v.project_id = p.id ORDER BY v.id DESC LIMIT 1) "
+                "FROM projects p WHERE p.owner = ? ORDER BY p.updated DESC LIMIT ?", (owner, limit)
+            ).fetchall()
+        return [{"id": r[0], "name": r[1], "updated": r[2], "rows": r[3] or 0} for r in rows]
+
+    def list_versions(self, owner, project_id):
+        """Version history of an owner's project, newest first"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT v.id, v.created, v.note, v.row_count, v.total FROM versions v JOIN projects p ON p.id = v.project_id "
+                "WHERE v.project_id = ? AND p.owner = ? ORDER BY v.id DESC", (project_id, owner)
+            ).fetchall()
+        return [{"id": r[0], "created": r[1], "note": r[2], "rows": r[3], "total": r[4]} for r in rows]
+
+    def load(self, owner, project_id, version_id=None):
+        """
+        Load an owner's project (latest version unless version_id is given).
+        Returns dict with name, link, price_factor, positions (DataFrame), version_id; None if unknown.
+        """
+        with self.lock:
+            project = self.conn.execute(
+                "SELECT name, link, price_factor FROM projects WHERE id = ? AND owner = ?", (project_id, owner)
+            ).fetchone()
+            if project is None:
+                return None
+            if version_id is None:
+                version = self.conn.execute(
+                    "SELECT id, positions, content_hash FROM versions WHERE project_id = ? ORDER BY id DESC LIMIT 1", (project_id,)
+                ).fetchone()
+            else:
+                version = self.conn.execute(
+                    "SELECT id, positions, content_hash FROM versions WHERE project_id = ? AND id = ?", (project_id, version_id)
+                ).fetchone()
+        if version is None:
+            return None
+        return {"name": project[0], "link": project[1] or "", "price_factor": project[2] or 1.0,
+                "positions": self._decode_positions(version[1]), "version_id": version[0], "content_hash": version[2]}
+
+@st.cache_resource
+def get_project_store():
+    """Return the process-wide project store"""
+    return ProjectStore(PROJECT_DB_FILE)
+
+def resolve_project_owner():
+    """
+    Owner key for the project store: the signed-in user's e-mail (Streamlit authentication), otherwise
+    a random key kept in the URL (?k=...), so projects survive refreshes and are only visible via that link.
+    """
+    try:
+        if st.user.is_logged_in:
+            return f"user:{st.user.email}"
+    except Exception:
+        pass  # Authentication not configured
+    key = st.query_params.get("k")
+    if not key or not re.fullmatch(r"[\w-]{16,64}", key):
+        key = secrets.token_urlsafe(16)
+    return f"link:{key}"
+
+def calculation_content_hash(df):
+    """Fast content hash of a calculation table (values and row order)"""
+    if df.empty:
+        return hashlib.sha1(b"").hexdigest()
+    columns = [col for col in CALCULATION_COLUMNS + ["group"] if col in df.columns]
+    row_hashes = pd.util.hash_pandas_object(df[columns].astype(object), index=False)
+    return hashlib.sha1(row_hashes.to_numpy().tobytes()).hexdigest()
+
+# --- EXCEL EXPORT ---
+# Native numbers with German display (Excel shows #,##0.00 as 1.234,56 in a German locale)
+EXCEL_NUMBER_FORMAT = '#,##0.00'
+EXCEL_COLUMN_WIDTHS = {'A': 12, 'B': 50, 'C': 15, 'D': 10, 'E': 18, 'F': 20}
+
+def write_offer_excel(df, lv_tree=None):
+    """
+    Stream the offer into an xlsx workbook (openpyxl write-only mode).
+    Menge and EP are numeric cells, GP is =ROUND(Menge*EP,2) like the cent engine, group/Titel subtotals and the offer totals
+    are SUBTOTAL/SUM formulas (SUBTOTAL ignores nested subtotals, so nothing is counted twice).
+    Returns the workbook as bytes.
+    """
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Font, Border, Side
+
+    if lv_tree is None:
+        lv_tree = LVTree(df)
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Kalkulation')
+    for column, width in EXCEL_COLUMN_WIDTHS.items():
+        worksheet.column_dimensions[column].width = width
+
+    bold = Font(bold=True)
+    right = Alignment(horizontal='right')
+    top_border = Border(top=Side(style='thin'))
+
+    def number(value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return 0.0 if np.isnan(value) else value
+
+    def cell(value, number_format=None, font=None, alignment=None, border=None):
+        c = WriteOnlyCell(worksheet, value=value)
+        if number_format:
+            c.number_format = number_format
+        if font:
+            c.font = font
+        if alignment:
+            c.alignment = alignment
+        if border:
+            c.border = border
+        return c
+
+    worksheet.append([cell(title, font=bold) for title in
+                      ['Pos.', 'Leistungsbezeichnung', 'Menge', 'Einheit', 'EP netto (€)', 'GP netto (€)']])
+    row_number = 1
+    section_starts = []  # First row of every open group / Titel section
+    for event in iter_offer_sections(df, lv_tree):
+        row_number += 1
+        if event[0] == "position":
+            row = event[1]
+            worksheet.append([
+                None if pd.isna(row.pos) else str(row.pos),
+                None if pd.isna(row.description) else str(row.description),
+                cell(round_quantity(number(row.quantity)), EXCEL_NUMBER_FORMAT),
+                None if pd.isna(row.unit) else str(row.unit),
+                cell(int(to_cents(number(row.unit_price))) / 100, EXCEL_NUMBER_FORMAT),
+                cell(f"=ROUND(C{row_number}*E{row_number},2)", EXCEL_NUMBER_FORMAT),
+            ])
+        elif event[0] == "heading":
+            section_starts.append(row_number + 1)
+            worksheet.append([None, cell(event[1], font=bold)])
+        else:
+            start = section_starts.pop()
+            worksheet.append([None, cell(f"Summe {event[1]}", font=bold), None, None, None,
+                              cell(f"=SUBTOTAL(9,F{start}:F{max(start, row_number - 1)})", EXCEL_NUMBER_FORMAT, bold, right)])
+    last_data_row = max(row_number, 2)
+
+    # Offer totals
+    worksheet.append([])
+    netto_row = row_number + 2
+    worksheet.append([cell(None, border=top_border), cell('Angebotssumme netto:', border=top_border),
+                      cell(None, border=top_border), cell('=', border=top_border), cell(None, border=top_border),
+                      cell(f"=SUBTOTAL(9,F2:F{last_data_row})", EXCEL_NUMBER_FORMAT + ' "€ netto"', alignment=right, border=top_border)])
+    worksheet.append([None, 'Mehrwertsteuer', f'zzgl. {VAT_RATE_PERCENT},0%', '=', None,
+                      cell(f"=ROUND(F{netto_row}*{VAT_RATE_PERCENT}/100,2)", EXCEL_NUMBER_FORMAT + ' "€"', alignment=right)])
+    worksheet.append([cell(None, font=bold, border=top_border), cell('Angebotssumme brutto', font=bold, border=top_border),
+                      cell(None, font=bold, border=top_border), cell('=', font=bold, border=top_border),
+                      cell(None, font=bold, border=top_border),
+                      cell(f"=F{netto_row}+F{netto_row + 1}", EXCEL_NUMBER_FORMAT + ' "€ brutto"', bold, right, top_border)])
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+def benchmark_excel_export(rows=10000):
+    """
+    Generate the Excel export for a synthetic LV with the given number of rows.
+    Time is measured in a plain run, memory in a second run with tracemalloc (which slows it down).
+    Returns dict with seconds, peak_mb (Python allocations) and size_kb.
+    """
+    import tracemalloc
+    df = pd.DataFrame({
+        'pos': [f"{i // 1000 + 1:02d}.{(i // 100) % 10:02d}.{i % 100 + 1:04d}" for i in range(rows)],
+        'description': [f"Beton C25/30 liefern und einbauen, Position {i}" for i in range(rows)],
+        'quantity': np.round(np.linspace(1, 500, rows), 2),
+        'unit': 'm3',
+        'unit_price': 185.25,
+    })
+    start = time.perf_counter()
+    data = write_offer_excel(df)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    write_offer_excel(df)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"rows": rows, "seconds": seconds, "peak_mb": peak / 1e6, "size_kb": len(data) / 1024}
+
+# --- GAEB EXPORT ---
+# Bid submission (X84) written back into the structure of the client's X83
+GAEB_SOURCE_EXTENSIONS = ('.x83', '.x84')
+GAEB_ITEM_PRICE_TAGS = ('UP', 'IT')   # Replaced in the output, ignored by the round-trip check
+
+def _local_name(name):
+    return name.split(':')[-1]
+
+class GAEBBidFilter(XMLFilterBase):
+    """
+    SAX filter turning an X83 stream into X84: DP 83 -> 84, DA83 -> DA84 namespace and UP/IT (unit price, total) inserted
+    after Qty/QU and before Description of every priced Item, as tgItem of GAEB DA XML 3.x expects. Positions are identified
+    by the RNoPart chain of the enclosing BoQCtgy elements plus the Item's RNoPart (the OZ). Only the open element path is held in memory.
+    """
+    def __init__(self, parent, prices):
+        super().__init__(parent)
+        self.prices = prices          # normalized OZ -> unit price
+        self.ctgy_parts = []
+        self.item = None              # {"oz", "depth", "qty", "written"} of the open Item
+        self.depth = 0
+        self.skip_depth = 0           # > 0 while dropping existing UP/IT
+        self.capture = None           # "DP" or "Qty" while collecting their text
+        self.buffer = []
+        self.items = 0
+        self.priced = 0
+
+    def _write_prices(self):
+        item = self.item
+        item["written"] = True
+        price = self.prices.get(normalize_position_number(item["oz"]))
+        if price is None:
+            return
+        try:
+            quantity = float(item["qty"] or 0)
+        except ValueError:
+            quantity = 0.0
+        for tag, value in (("UP", format_cents(to_cents(price))), ("IT", format_cents(line_totals_cents(quantity, price)))):
+            super().startElement(tag, xml.sax.xmlreader.AttributesImpl({}))
+            super().characters(value)
+            super().endElement(tag)
+        self.priced += 1
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        local = _local_name(name)
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+        if self.item is not None and self.depth == self.item["depth"] + 1 and local in GAEB_ITEM_PRICE_TAGS:
+            self.skip_depth = 1
+            return
+        if local == 'BoQCtgy':
+            self.ctgy_parts.append(attrs.get('RNoPart', ''))
+        elif local == 'Item':
+            self.items += 1
+            self.item = {"oz": '.'.join(self.ctgy_parts + [attrs.get('RNoPart', '')]), "depth": self.depth,
+                         "qty": None, "written": False}
+        elif local == 'DP' or (local == 'Qty' and self.item is not None and self.depth == self.item["depth"] + 1):
+            self.capture, self.buffer = local, []
+        elif (local == 'Description' and self.item is not None and self.depth == self.item["depth"] + 1
+              and not self.item["written"]):
+            self._write_prices()  # Item without QU
+        if any(key.startswith('xmlns') and '/DA83/' in value for key, value in attrs.items()):
+            attrs = xml.sax.xmlreader.AttributesImpl({
+                key: value.replace('/DA83/', '/DA84/') if key.startswith('xmlns') else value for key, value in attrs.items()
+            })
+        super().startElement(name, attrs)
+
+    def characters(self, content):
+        if self.skip_depth:
+            return
+        if self.capture:
+            self.buffer.append(content)
+            if self.capture == "DP":
+                return  # Written on endElement
+        super().characters(content)
+
+    def endElement(self, name):
+        local = _local_name(name)
+        if self.skip_depth:
+            self.skip_depth -= 1
+            self.depth -= 1
+            return
+        if self.capture == "DP" and local == 'DP':
+            super().characters('84' if ''.join(self.buffer).strip() == '83' else ''.join(self.buffer))
+            self.capture = None
+        elif self.capture == "Qty" and local == 'Qty':
+            self.item["qty"] = ''.join(self.buffer).strip()
+            self.capture = None
+        if local == 'Item' and self.item is not None and self.depth == self.item["depth"]:
+            if not self.item["written"]:
+                self._write_prices()  # Item without QU and Description
+            self.item = None
+        super().endElement(name)
+        if (local == 'QU' and self.item is not None and self.depth == self.item["depth"] + 1
+                and not self.item["written"]):
+            self._write_prices()
+        if local == 'BoQCtgy' and self.ctgy_parts:
+            self.ctgy_parts.pop()
+        self.depth -= 1
+
+def write_gaeb_x84(source, df, output):
+    """
+    Stream an X83 (path or binary file object) into an X84 bid with the unit prices of df.
+    output: binary file object. Returns dict with items and priced counts.
+    """
+    prices = {}
+    for pos, unit_price in zip(df['pos'], pd.to_numeric(df['unit_price'], errors='coerce')):
+        if pos is not None and not pd.isna(pos) and not pd.isna(unit_price):
+            prices.setdefault(normalize_position_number(pos), float(unit_price))
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, False)  # Keep qualified names and xmlns attributes as-is
+    bid_filter = GAEBBidFilter(parser, prices)
+    bid_filter.setContentHandler(XMLGenerator(output, encoding='utf-8', short_empty_elements=True))
+    bid_filter.parse(source)
+    return {"items": bid_filter.items, "priced": bid_filter.priced}
+
+def verify_gaeb_roundtrip(source, output):
+    """
+    Compare the element structure (tags and RNoPart in document order) of an X83 and the written
+    X84, ignoring the inserted UP/IT. UP/IT must follow Qty/QU and precede Description of their
+    Item; any other order is reported as a difference. Both files are streamed side by side.
+    Returns dict: ok, elements compared, first difference (or None).
+    """
+    def structure(stream):
+        parents = []  # Per open element: [is Item, price tag seen, Description seen] among its children
+        for event, element in ET.iterparse(stream, events=('start', 'end')):
+            local = _local_name(element.tag.split('}')[-1])
+            if event == 'end':
+                parents.pop()
+                element.clear()
+                continue
+            parent = parents[-1] if parents else None
+            parents.append([local == 'Item', False, False])
+            if parent is not None and parent[0]:
+                if local in GAEB_ITEM_PRICE_TAGS:
+                    parent[1] = True
+                    if parent[2]:
+                        yield f"{local} nach Description", element.get('RNoPart')
+                    continue
+                if local == 'Description':
+                    parent[2] = True
+                elif local in ('Qty', 'QU') and parent[1]:
+                    yield f"{local} nach UP/IT", element.get('RNoPart')
+                    continue
+            yield local, element.get('RNoPart')
+
+    compared = 0
+    for expected, actual in itertools.zip_longest(structure(source), structure(output)):
+        if expected != actual:
+            return {"ok": False, "elements": compared, "difference": (expected, actual)}
+        compared += 1
+    return {"ok": True, "elements": compared, "difference": None}
+
 # --- PDF GENERATION ---
 class OfferPDF(FPDF):
     def header(self):
@@ -1164,8 +4269,8 @@ class OfferPDF(FPDF):
         self.set_xy(x_start + (col_width * 2), self.get_y() - 16)
         self.cell(col_width, 4, f"Seite {self.page_no()}", align='R')
 
-def generate_offer_pdf(df, project_name):
-    """Generate professional PDF offer."""
+def generate_offer_pdf(df, project_name, lv_tree=None):
+    """Generate professional PDF offer (with Titel subtotals from lv_tree)."""
     pdf = OfferPDF()
     pdf.set_auto_page_break(auto=True, margin=40)
     pdf.add_page()
@@ -1213,29 +4318,45 @@ def generate_offer_pdf(df, project_name):
     
     # Table Content
     pdf.set_font("Arial", size=9)
-    total_netto = 0.0
-    
-    for _, row in df.iterrows():
+    if lv_tree is None:
+        lv_tree = LVTree(df)
+    total_netto, total_mwst, total_brutto = offer_totals(lv_tree.total_cents)
+
+    for event in iter_offer_sections(df, lv_tree):
+        if event[0] == "heading":
+            # Group (sheet / Gewerk / Los) or Titel heading
+            pdf.set_font("Arial", 'B', 9)
+            pdf.cell(sum(w), 8, clean(event[1]), 1, 1, 'L', 1)
+            pdf.set_font("Arial", size=9)
+            continue
+        if event[0] == "subtotal":
+            pdf.set_font("Arial", 'B', 9)
+            pdf.cell(sum(w[:5]), 8, clean(f"Summe {event[1]}"), 1, 0, 'R')
+            pdf.cell(w[5], 8, format_german_number(event[3]), 1, 1, 'R')
+            pdf.set_font("Arial", size=9)
+            continue
+
+        row = event[1]
         try:
-            qty = float(row.get('quantity', 0))
-            ep = float(row.get('unit_price', 0))
+            qty = float(getattr(row, 'quantity', 0))
+            ep = float(getattr(row, 'unit_price', 0))
         except:
             qty, ep = 0, 0
-        
-        gp = qty * ep
-        total_netto += gp
-        
-        pos = clean(str(row.get('pos', '')))
-        desc = clean(str(row.get('description', '')))[:45]
-        unit = clean(str(row.get('unit', '')))
-        
+
+        gp = int(line_totals_cents(qty, ep)) / 100
+        ep = int(to_cents(ep)) / 100
+
+        pos = clean(str(getattr(row, 'pos', '')))
+        desc = clean(str(getattr(row, 'description', '')))[:45]
+        unit = clean(str(getattr(row, 'unit', '')))
+
         pdf.cell(w[0], 8, pos, 1, 0, 'C')
         pdf.cell(w[1], 8, desc, 1, 0, 'L')
         pdf.cell(w[2], 8, f"{qty:.2f}".replace('.', ','), 1, 0, 'C')
         pdf.cell(w[3], 8, unit, 1, 0, 'C')
         pdf.cell(w[4], 8, format_german_number(ep), 1, 0, 'R')
         pdf.cell(w[5], 8, format_german_number(gp), 1, 1, 'R')
-    
+
     # Totals
     pdf.ln(5)
     
@@ -1244,10 +4365,10 @@ def generate_offer_pdf(df, project_name):
         pdf.cell(145, 8, clean(label), 0, 0, 'R')
         pdf.cell(45, 8, f"{format_german_number(value)} EUR", 1 if bold else 0, 1, 'R')
     
-    print_total("Summe Netto:", total_netto)
-    print_total("zzgl. 19% MwSt.:", total_netto * 0.19)
+    print_total("Summe Netto:", total_netto / 100)
+    print_total(f"zzgl. {VAT_RATE_PERCENT}% MwSt.:", total_mwst / 100)
     pdf.ln(2)
-    print_total("Gesamtbetrag (Brutto):", total_netto * 1.19, bold=True)
+    print_total("Gesamtbetrag (Brutto):", total_brutto / 100, bold=True)
     
     pdf.ln(15)
     pdf.set_font("Arial", '', 10)
@@ -1305,9 +4426,7 @@ with col_center:
 
 # Initialize session state
 if "calculation_df" not in st.session_state:
-    st.session_state.calculation_df = pd.DataFrame(
-        columns=["pos", "description", "quantity", "unit", "original_price", "unit_price", "price_factor"]
-    )
+    st.session_state.calculation_df = empty_calculation_df()
 if "price_factor" not in st.session_state:
     st.session_state.price_factor = 1.0
 if "project_name" not in st.session_state:
@@ -1318,6 +4437,37 @@ if "file_uploader_key" not in st.session_state:
     st.session_state.file_uploader_key = 0
 if "folder_location" not in st.session_state:
     st.session_state.folder_location = os.path.expanduser("~\\Desktop")
+if "editor_version" not in st.session_state:
+    st.session_state.editor_version = 0  # Incremented to reset editor state after programmatic changes
+if "document_budget" not in st.session_state:
+    st.session_state.document_budget = BUDGET_PER_DOCUMENT_USD
+if "lv_tree" not in st.session_state:
+    st.session_state.lv_tree = None  # LVTree with Titel subtotals, updated incrementally
+if "project_id" not in st.session_state:
+    st.session_state.project_id = None  # Project in the project store (set on first save)
+if "saved_state" not in st.session_state:
+    st.session_state.saved_state = None  # (content hash, name, link, factor) of the last save
+if "lv_diff" not in st.session_state:
+    st.session_state.lv_diff = None  # Diff against the previous LV version after a revision upload
+if "gaeb_source" not in st.session_state:
+    st.session_state.gaeb_source = None  # Uploaded X83 (name, bytes) for the X84 bid export
+if "applied_editor_delta" not in st.session_state:
+    st.session_state.applied_editor_delta = None  # (editor key, edits) already merged into calculation_df
+if "calculation_memory" not in st.session_state:
+    st.session_state.calculation_memory = None  # Memory report of calculation_df, measured on replacement
+if "calculation_derived" not in st.session_state:
+    st.session_state.calculation_derived = (None, {})  # (table, values derived from it), reset on replacement
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:8]  # Fair-share key for the admission controller
+if "project_owner" not in st.session_state:
+    st.session_state.project_owner = resolve_project_owner()  # Only this owner's projects are listed and opened
+
+# Keep the owner key in the URL, so a refresh or bookmark finds the projects again
+if st.session_state.project_owner.startswith("link:") and st.query_params.get("k") != st.session_state.project_owner[5:]:
+    st.query_params["k"] = st.session_state.project_owner[5:]
+
+# Model calls of this script run queue under this session's share
+set_session_owner(st.session_state.session_id)
 
 # Helper function for folder path input (cloud-compatible)
 def select_folder():
@@ -1328,6 +4478,73 @@ def is_cloud_environment():
     """Check if running in Streamlit Cloud"""
     return not os.path.exists(os.path.expanduser("~\\Desktop"))
 
+def replace_calculation_df(df):
+    """
+    Replace the session's calculation table: compacted (texts interned) and measured once per
+    replacement instead of on every rerun. Returns the stored table.
+    """
+    df = compact_calculation_df(df)
+    st.session_state.calculation_df = df
+    memory_report = calculation_memory_report(df)
+    st.session_state.calculation_memory = memory_report
+    get_metrics_registry().observe("kalkulation_session_table_bytes", memory_report["total_bytes"],
+                                   buckets=(1e4, 1e5, 1e6, 1e7, 1e8))
+    return df
+
+def calculation_derived(key, compute):
+    """
+    Value derived from the session's calculation table (Titel keys, filters, content hash), computed
+    once per table: every change replaces the table object, so reruns without edits reuse the value.
+    """
+    table, values = st.session_state.calculation_derived
+    if table is not st.session_state.calculation_df:
+        table, values = st.session_state.calculation_df, {}
+        st.session_state.calculation_derived = (table, values)
+    if key not in values:
+        values[key] = compute()
+    return values[key]
+
+def autosave_project(note="autosave"):
+    """Save the session's project to the project store if positions or settings changed"""
+    df = st.session_state.calculation_df
+    if df.empty:
+        return
+    content_hash = calculation_derived("content_hash", lambda: calculation_content_hash(df))
+    state = (content_hash, st.session_state.project_name, st.session_state.project_link, st.session_state.price_factor)
+    if state == st.session_state.saved_state:
+        return
+    try:
+        with metrics_span("project_save", note=note.split(' ')[0]) as span:
+            span["rows"] = len(df)
+            st.session_state.project_id = get_project_store().save(
+                st.session_state.project_owner, st.session_state.project_id, df, st.session_state.project_name, st.session_state.project_link,
+                st.session_state.price_factor, content_hash=content_hash, note=note
+            )
+        st.session_state.saved_state = state
+    except Exception as e:
+        print(f"⚠️ Autosave failed: {e}")
+
+def open_project(project_id, version_id=None):
+    """Replace the session's calculation with a stored project (version)"""
+    with metrics_span("project_load") as span:
+        project = get_project_store().load(st.session_state.project_owner, project_id, version_id)
+        span["rows"] = len(project["positions"]) if project else 0
+    if project is None:
+        return False
+    replace_calculation_df(project["positions"])
+    st.session_state.project_name = project["name"]
+    st.session_state.project_link = project["link"]
+    st.session_state.price_factor = project["price_factor"]
+    st.session_state.project_id = project_id
+    st.session_state.saved_state = (project["content_hash"], project["name"], project["link"], project["price_factor"])
+    st.session_state.lv_tree = None
+    st.session_state.lv_diff = None
+    st.session_state.gaeb_source = None
+    st.session_state.editor_version += 1
+    for key in ("export_project_name", "folder_name_input", "project_link_input"):
+        st.session_state.pop(key, None)  # Widgets pick up the loaded project name / link
+    return True
+
 # Step 1: Upload
 st.markdown("---")
 col_header1, col_header2 = st.columns([4, 1])
@@ -1336,13 +4553,39 @@ with col_header1:
 with col_header2:
     if not st.session_state.calculation_df.empty:
         if st.button("🔄 Neu starten", use_container_width=True, help="Alle Daten löschen und von vorne beginnen"):
-            st.session_state.calculation_df = pd.DataFrame(
-                columns=["pos", "description", "quantity", "unit", "original_price", "unit_price", "price_factor"]
-            )
+            replace_calculation_df(empty_calculation_df())
             st.session_state.price_factor = 1.0
+            st.session_state.project_id = None  # Next extraction starts a new stored project
+            st.session_state.saved_state = None
+            st.session_state.lv_diff = None
+            st.session_state.gaeb_source = None
             st.session_state.file_uploader_key += 1  # Reset file uploader
+            st.session_state.editor_version += 1
             st.rerun()
 
+# Reopen a stored project instead of extracting again (e.g. after a refresh or timeout)
+stored_projects = get_project_store().list_projects(st.session_state.project_owner)
+if stored_projects:
+    with st.expander("📂 Gespeichertes Projekt öffnen", expanded=st.session_state.calculation_df.empty):
+        if st.session_state.project_owner.startswith("link:"):
+            st.caption("🔗 Projekte sind an diesen Link gebunden - Adresse als Lesezeichen speichern.")
+        project_labels = {p["id"]: f"{p['name']} ({p['rows']} Pos., {p['updated'].replace('T', ' ')})" for p in stored_projects}
+        col_project1, col_project2 = st.columns(2)
+        with col_project1:
+            selected_project = st.selectbox("Projekt:", list(project_labels), format_func=project_labels.get, key="open_project_id")
+        versions = get_project_store().list_versions(st.session_state.project_owner, selected_project)
+        version_labels = {
+            v["id"]: f"{v['created'].replace('T', ' ')} · {v['note']} · {v['rows']} Pos. · {format_german_number(v['total'] or 0)} €"
+            for v in versions
+        }
+        with col_project2:
+            selected_version = st.selectbox("Version:", list(version_labels), format_func=version_labels.get, key="open_project_version")
+        if st.button("📂 Projekt laden", use_container_width=True, disabled=not versions):
+            if open_project(selected_project, selected_version):
+                st.toast(f"✅ Projekt geladen: {project_labels[selected_project]}")
+                st.rerun()
+            st.error("❌ Projekt konnte nicht geladen werden.")
+
 uploaded_file = st.file_uploader(
     "Wählen Sie eine Datei:",
     type=['pdf', 'docx', 'doc', 'txt', 'xlsx', 'xls',
@@ -1367,23 +4610,31 @@ if uploaded_file:
         st.markdown(f"**💾 Größe:**<br>{file_size:.1f} KB", unsafe_allow_html=True)
     st.markdown("</div>", unsafe_allow_html=True)
     
+    # A revised LV of the current project: reuse prices of unchanged positions, price only the delta
+    revise_current = False
+    if not st.session_state.calculation_df.empty:
+        revise_current = st.checkbox(
+            "🔀 Als überarbeitete LV-Version des aktuellen Projekts einlesen",
+            value=False,
+            help="Positionen werden mit der aktuellen Kalkulation verglichen. Preise unveränderter Positionen "
+                 "(gleicher Text und Einheit) werden übernommen, nur neue und geänderte Positionen werden bepreist."
+        )
+
     if st.button("🚀 Jetzt analysieren", type="primary", use_container_width=True, help="Dokument mit KI analysieren und Positionen extrahieren"):
         # Create progress bar and status text
         progress_bar = st.progress(0, text="0% - Starte...")
         status_text = st.empty()
 
-        # Save uploaded file temporarily
         suffix = f".{uploaded_file.name.split('.')[-1]}"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(uploaded_file.getvalue())
-            temp_path = tmp.name
 
         try:
-            # Extract with AI (pass progress bar)
-            df_result = extract_with_ai(temp_path, suffix.lower(), progress_bar=progress_bar, status_text=status_text)
-
-            # Cleanup temp file
-            safe_remove_file(temp_path)
+            # Extract with AI (pass progress bar); the upload is read from memory, large files from a spooled temp file
+            previous_df = editable_view(st.session_state.calculation_df) if revise_current else None
+            with upload_source(uploaded_file, suffix) as source:
+                df_result = extract_with_ai(source, suffix.lower(), progress_bar=progress_bar, status_text=status_text,
+                                            cost_budget=st.session_state.document_budget, previous_df=previous_df,
+                                            file_name=uploaded_file.name)
+            cost_tracker = get_current_cost_tracker()
 
             # Clear progress bar after completion
             progress_bar.empty()
@@ -1392,17 +4643,24 @@ if uploaded_file:
             if not df_result.empty:
                 # Clean and validate data
                 df_result = df_result[df_result['description'].notna()]
-                df_result = df_result[df_result['description'].str.len() > 3]
+                df_result = df_result[df_result['description'].str.len() > 3].copy()
                 df_result['quantity'] = pd.to_numeric(df_result['quantity'], errors='coerce').fillna(1.0)
                 df_result['unit_price'] = pd.to_numeric(df_result['unit_price'], errors='coerce').fillna(0.0)
-                # Store original prices
-                df_result['original_price'] = df_result['unit_price'].copy()
-                # Initialize price factor
-                df_result['price_factor'] = 1.0
                 df_result = df_result.reset_index(drop=True)
+                # Remember priced content so later edits can be re-priced incrementally
+                df_result = replace_calculation_df(mark_priced_rows(df_result))
 
-                st.session_state.calculation_df = df_result
+                st.session_state.lv_diff = diff_lv_versions(previous_df, df_result) if revise_current else None
+                st.session_state.gaeb_source = (
+                    {"name": uploaded_file.name, "data": uploaded_file.getvalue()}
+                    if suffix.lower() in GAEB_SOURCE_EXTENSIONS else None
+                )
                 st.session_state.price_factor = 1.0
+                st.session_state.editor_version += 1
+                if not revise_current:
+                    st.session_state.project_id = None  # New document, new stored project
+                st.session_state.saved_state = None
+                autosave_project(note=f"{'Revision' if revise_current else 'Extraktion'} {uploaded_file.name}")
                 st.success(f"✅ **Erfolgreich!** {len(df_result)} Positionen extrahiert")
 
                 # Statistics with enhanced display
@@ -1414,14 +4672,38 @@ if uploaded_file:
                     priced = (df_result['unit_price'] > 0).sum()
                     st.metric("💰 Mit Preis", f"{priced}", help="Positionen mit Preisangabe")
                 with col3:
-                    total = (df_result['quantity'] * df_result['unit_price']).sum()
-                    st.metric("💵 Summe Netto", f"{format_german_number(total, 0)} €", help="Gesamtsumme ohne MwSt.")
+                    total, _, total_brutto = offer_totals(line_totals_cents(df_result['quantity'], df_result['unit_price']).sum())
+                    st.metric("💵 Summe Netto", f"{format_german_number(total / 100, 0)} €", help="Gesamtsumme ohne MwSt.")
                 with col4:
-                    total_brutto = total * 1.19
-                    st.metric("✅ Summe Brutto", f"{format_german_number(total_brutto, 0)} €", help="Gesamtsumme inkl. 19% MwSt.")
+                    st.metric("✅ Summe Brutto", f"{format_german_number(total_brutto / 100, 0)} €", help=f"Gesamtsumme inkl. {VAT_RATE_PERCENT}% MwSt.")
             else:
                 st.error("❌ Keine Positionen gefunden. Bitte prüfen Sie das Dokument.")
 
+            # AI usage and estimated cost of this run
+            if cost_tracker is not None:
+                input_tokens, output_tokens = cost_tracker.total_tokens
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("🔤 Input-Tokens", f"{format_german_number(input_tokens, 0)}", help="An die KI gesendete Tokens")
+                with col2:
+                    st.metric("🔡 Output-Tokens", f"{format_german_number(output_tokens, 0)}", help="Von der KI erzeugte Tokens")
+                with col3:
+                    st.metric("💶 KI-Kosten (geschätzt)", f"{format_german_number(cost_tracker.total_cost, 4)} USD",
+                              help="Geschätzt anhand der Listenpreise je Modell")
+                if cost_tracker.queue_wait_seconds >= 1.0:
+                    st.caption(f"🚦 Wartezeit auf freie KI-Kapazität: {cost_tracker.queue_wait_seconds:.0f} s "
+                               f"(Anfragen aller Nutzer werden fair abwechselnd bedient)")
+                if cost_tracker.prefilter_saved_tokens:
+                    saved_share = cost_tracker.prefilter_saved_tokens / cost_tracker.prefilter_tokens
+                    st.caption(f"🧹 Vorfilter: ~{format_german_number(cost_tracker.prefilter_saved_tokens, 0)} Tokens "
+                               f"({saved_share:.0%}) Vorbemerkungen und Vertragstexte lokal entfernt")
+                if cost_tracker.skipped_stages:
+                    st.warning(f"💶 KI-Budget knapp: {len(cost_tracker.skipped_stages)} optionale KI-Aufrufe übersprungen "
+                               f"({', '.join(sorted(set(cost_tracker.skipped_stages)))}). Fehlende Preise wurden mit Standardwerten belegt.")
+                if cost_tracker.entries:
+                    with st.expander("🔍 Kosten nach Modell und Stufe", expanded=False):
+                        st.dataframe(cost_tracker.summary_df(), use_container_width=True, hide_index=True)
+
         except Exception as e:
             # Clear progress bar on error
             progress_bar.empty()
@@ -1439,7 +4721,6 @@ if uploaded_file:
                     st.info("💡 Das System hat automatisch 5 verschiedene Modelle versucht. Bitte warten Sie einige Minuten.")
             elif "Unsupported MIME type" in str(e) or "INVALID_ARGUMENT" in str(e):
                 st.warning("⚠️ Dieses Dateiformat wird möglicherweise nicht direkt unterstützt. Das System verarbeitet das Dokument lokal.")
-            safe_remove_file(temp_path)
 
 st.markdown("---")
 
@@ -1453,16 +4734,84 @@ if not st.session_state.calculation_df.empty:
     num_positions = len(st.session_state.calculation_df)
     st.info(f"📋 **{num_positions} Positionen** extrahiert")
 
-    # Calculate total price for display (GP = Menge × EP)
-    display_df = st.session_state.calculation_df.copy()
-    # GP netto = quantity × unit_price (EP already includes any factor applied)
-    display_df['total_price'] = display_df['quantity'] * display_df['unit_price']
+    # Changes of a revised LV against the previous version
+    lv_diff = st.session_state.lv_diff
+    if lv_diff is not None:
+        diff_counts = lv_diff['status'].value_counts()
+        with st.expander(f"🔀 Änderungen gegenüber Vorversion: {diff_counts.get('added', 0)} neu, "
+                         f"{diff_counts.get('changed', 0)} geändert, {diff_counts.get('removed', 0)} entfallen", expanded=True):
+            st.caption(f"{int(lv_diff['reuse_price'].sum())} Preise aus der Vorversion übernommen, "
+                       f"{diff_counts.get('unchanged', 0)} Positionen unverändert.")
+            diff_view = lv_diff[lv_diff['status'] != 'unchanged']
+            st.dataframe(
+                pd.DataFrame({
+                    "Status": diff_view['status'].map(DIFF_STATUS_LABELS),
+                    "Änderung": diff_view['changes'],
+                    "Pos.": diff_view['pos'],
+                    "Leistungsbezeichnung": diff_view['description'],
+                    "Menge alt": diff_view['old_quantity'],
+                    "Menge neu": diff_view['new_quantity'],
+                    "Einheit": diff_view['unit'],
+                }),
+                use_container_width=True, hide_index=True, height=250
+            )
+            st.download_button(
+                label="⬇️ Änderungsbericht (Excel)",
+                data=lv_diff_report(lv_diff),
+                file_name=f"Aenderungen_{sanitize_filename(st.session_state.project_name)}_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key="download_lv_diff"
+            )
+
+    # Large LVs: only one page (filtered by Titel / search) is sent to the browser
+    calculation_df = st.session_state.calculation_df
+    paged_editor = len(calculation_df) > EDITOR_PAGED_MIN_ROWS
+    view_rows = calculation_df.index
+    if paged_editor:
+        titel_series = calculation_derived("titel_keys", lambda: titel_keys(calculation_df, 1))
+        titel_counts = calculation_derived("titel_counts", lambda: titel_series[titel_series != ''].value_counts(sort=False))
+        col_nav1, col_nav2, col_nav3 = st.columns([2, 3, 1])
+        with col_nav1:
+            selected_titel = st.selectbox(
+                "Titel:", [""] + list(titel_counts.index),
+                format_func=lambda t: "Alle Titel" if not t else f"Titel {t} ({titel_counts[t]} Pos.)",
+                key="editor_titel"
+            )
+        with col_nav2:
+            search_text = st.text_input("🔍 Suche (OZ oder Text):", key="editor_search",
+                                        placeholder="z.B. 01.02 oder Bodenplatte")
+        filtered_rows = calculation_derived(("filter", selected_titel, search_text),
+                                            lambda: filter_editor_rows(calculation_df, selected_titel, search_text))
+        page_count = max(1, -(-len(filtered_rows) // EDITOR_PAGE_SIZE))
+        with col_nav3:
+            page = st.number_input("Seite:", min_value=1, max_value=page_count, value=1, step=1,
+                                   key=f"editor_page_{selected_titel}_{search_text}")
+        view_rows = filtered_rows[(page - 1) * EDITOR_PAGE_SIZE:page * EDITOR_PAGE_SIZE]
+        st.caption(f"Zeilen {(page - 1) * EDITOR_PAGE_SIZE + min(1, len(view_rows))}–{(page - 1) * EDITOR_PAGE_SIZE + len(view_rows)} "
+                   f"von {len(filtered_rows)} (Seite {page}/{page_count}). Neue Zeilen werden nach der letzten Zeile dieser Seite eingefügt.")
+        editor_key = f"editor_{st.session_state.editor_version}_{selected_titel}_{search_text}_{page}"
+    else:
+        editor_key = f"editor_{st.session_state.editor_version}"
+
+    # Calculate total price for display (GP = Menge × EP); a lazy view, the session table is not copied
+    display_df = editable_view(calculation_df.loc[view_rows] if paged_editor else calculation_df)
+    if paged_editor:
+        display_df.insert(0, "titel", titel_series.loc[view_rows])
+    # GP netto = quantity × unit_price to the cent (EP already includes any factor applied)
+    display_df['total_price'] = cents_to_euros(line_totals_cents(display_df['quantity'], display_df['unit_price']))
 
     # Create formatted display columns for German number format
     display_df['quantity_display'] = display_df['quantity'].apply(lambda x: format_german_number(x, 2))
     display_df['unit_price_display'] = display_df['unit_price'].apply(lambda x: format_german_number(x, 2))
     display_df['total_price_display'] = display_df['total_price'].apply(lambda x: format_german_number(x, 2))
 
+    # Show the sheet / Gewerk / Los column only for multi-sheet LVs
+    editor_columns = ["pos", "description", "quantity_display", "unit", "unit_price_display", "total_price_display"]
+    if calculation_derived("multi_group", lambda: 'group' in calculation_df.columns and calculation_df['group'].nunique() > 1):
+        editor_columns = ["group"] + editor_columns
+    if paged_editor:
+        editor_columns = ["titel"] + editor_columns
+
     edited_df = st.data_editor(
         display_df,
         column_config={
@@ -1475,62 +4824,110 @@ if not st.session_state.calculation_df.empty:
             "quantity": None,  # Hide raw numeric columns
             "unit_price": None,
             "total_price": None,
-            "original_price": None,
-            "price_factor": None
+            "price_source": None,
+            "priced_hash": None,
+            "group": st.column_config.TextColumn("Los/Blatt", width="small", help="Tabellenblatt (Gewerk/Los) der Position"),
+            "titel": st.column_config.TextColumn("Titel", width="small", help="Aus der Ordnungszahl abgeleiteter Titel")
         },
-        column_order=["pos", "description", "quantity_display", "unit", "unit_price_display", "total_price_display"],
+        column_order=editor_columns,
         num_rows="dynamic",
         use_container_width=True,
         height=400,
-        key="editor",
-        disabled=["total_price_display"]
+        key=editor_key,
+        disabled=["total_price_display", "titel"]
     )
 
-    # Convert German formatted strings back to numbers for calculations
-    def parse_german_number(value_str):
-        """Convert German formatted string back to float: '1.234,56' -> 1234.56"""
-        if pd.isna(value_str) or value_str == "":
-            return 0.0
-        try:
-            # Remove thousand separators (dots) and replace decimal comma with dot
-            cleaned = str(value_str).replace('.', '').replace(',', '.')
-            return float(cleaned)
-        except:
-            return 0.0
+    # Only a new editor delta (edited, added or deleted rows) replaces the session table; other reruns reuse it
+    editor_state = st.session_state.get(editor_key) or {}
+    editor_delta = (editor_key, json.dumps(editor_state, sort_keys=True, default=str))
+    table_edited = (any(editor_state.get(part) for part in ("edited_rows", "added_rows", "deleted_rows"))
+                    and editor_delta != st.session_state.applied_editor_delta)
+
+    if table_edited:
+        # Convert German formatted strings back to numbers for calculations
+        def parse_german_number(value_str):
+            """Convert German formatted string back to float: '1.234,56' -> 1234.56"""
+            if pd.isna(value_str) or value_str == "":
+                return 0.0
+            try:
+                # Remove thousand separators (dots) and replace decimal comma with dot
+                cleaned = str(value_str).replace('.', '').replace(',', '.')
+                return float(cleaned)
+            except:
+                return 0.0
 
-    # Update numeric values from edited German-formatted strings
-    if 'quantity_display' in edited_df.columns:
-        edited_df['quantity'] = edited_df['quantity_display'].apply(parse_german_number)
-    if 'unit_price_display' in edited_df.columns:
-        edited_df['unit_price'] = edited_df['unit_price_display'].apply(parse_german_number)
-    
-    # Recalculate total_price (GP = Menge × EP)
-    edited_df['quantity'] = pd.to_numeric(edited_df['quantity'], errors='coerce').fillna(0)
-    edited_df['unit_price'] = pd.to_numeric(edited_df['unit_price'], errors='coerce').fillna(0)
-    edited_df['total_price'] = edited_df['quantity'] * edited_df['unit_price']
-    
-    # Check if data has changed (comparing key columns)
-    old_df = st.session_state.calculation_df
-    data_changed = False
-    
-    if len(edited_df) != len(old_df):
-        data_changed = True
+        # Update numeric values from edited German-formatted strings
+        if 'quantity_display' in edited_df.columns:
+            edited_df['quantity'] = edited_df['quantity_display'].apply(parse_german_number)
+        if 'unit_price_display' in edited_df.columns:
+            edited_df['unit_price'] = edited_df['unit_price_display'].apply(parse_german_number)
+
+        # Paged editor: merge the edited page (changed, deleted and added rows) back into the full table
+        if paged_editor:
+            edited_df = merge_editor_page(calculation_df, view_rows, edited_df, len(editor_state.get("added_rows") or []))
+
+        edited_df['quantity'] = pd.to_numeric(edited_df['quantity'], errors='coerce').fillna(0)
+        edited_df['unit_price'] = pd.to_numeric(edited_df['unit_price'], errors='coerce').fillna(0)
+
+        # Check if data has changed (comparing key columns)
+        old_df = st.session_state.calculation_df
+        data_changed = False
+
+        if len(edited_df) != len(old_df):
+            data_changed = True
+        else:
+            # Compare quantities and unit prices
+            data_changed = bool(
+                (edited_df['quantity'].to_numpy() != old_df['quantity'].to_numpy()).any() or
+                (edited_df['unit_price'].to_numpy() != old_df['unit_price'].to_numpy()).any()
+            )
+
+        # Prices typed in by the user are never overwritten by re-pricing
+        edited_df = mark_manual_price_edits(edited_df, old_df)
+
+        # Update session state with edited values (compact form; total_price is derived on demand)
+        replace_calculation_df(edited_df)
+        st.session_state.applied_editor_delta = editor_delta
+        if editor_state.get("added_rows") or editor_state.get("deleted_rows"):
+            # Added/deleted rows are now part of the table; a new editor does not apply them again
+            st.session_state.editor_version += 1
+        autosave_project()
+
+        # If data changed, trigger rerun to update display
+        if data_changed:
+            st.rerun()
     else:
-        # Compare quantities and unit prices
-        for idx in range(len(edited_df)):
-            if idx < len(old_df):
-                if (edited_df.iloc[idx]['quantity'] != old_df.iloc[idx]['quantity'] or
-                    edited_df.iloc[idx]['unit_price'] != old_df.iloc[idx]['unit_price']):
-                    data_changed = True
-                    break
-    
-    # Update session state with edited values
-    st.session_state.calculation_df = edited_df
-    
-    # If data changed, trigger rerun to update display
-    if data_changed:
-        st.rerun()
-    
+        autosave_project()  # Name, link or factor may have changed
+    edited_df = st.session_state.calculation_df
+
+    # Incremental re-pricing: only new rows and rows with changed description/unit
+    rows_to_reprice = calculation_derived("rows_to_reprice", lambda: find_rows_to_reprice(edited_df))
+    col_reprice1, col_reprice2 = st.columns([3, 1])
+    with col_reprice1:
+        if rows_to_reprice:
+            st.caption(f"✏️ {len(rows_to_reprice)} neue oder geänderte Positionen ohne aktuellen KI-Preis. Manuell eingegebene Preise bleiben erhalten.")
+    with col_reprice2:
+        if st.button(f"🔁 Geänderte neu bepreisen ({len(rows_to_reprice)})", use_container_width=True,
+                     disabled=not rows_to_reprice, help="Nur neue oder geänderte Zeilen mit KI bepreisen"):
+            with st.spinner(f"Bepreise {len(rows_to_reprice)} Positionen..."):
+                repriced_df, reprice_costs = reprice_rows(edited_df, rows_to_reprice, price_factor=st.session_state.price_factor)
+            replace_calculation_df(repriced_df)
+            st.session_state.editor_version += 1  # Reset editor deltas, data now comes from session state
+            st.toast(f"✅ {len(rows_to_reprice)} Positionen neu bepreist (~{reprice_costs.total_cost:.4f} USD)")
+            st.rerun()
+
+    # Confirmed prices feed the local price history used for future offers
+    col_history1, col_history2 = st.columns([3, 1])
+    with col_history1:
+        st.caption(f"📚 Preis-Historie: {len(get_price_index())} Positionen. Ähnliche Positionen werden künftig daraus vorbelegt.")
+    with col_history2:
+        if st.button("📚 Preise als Referenz speichern", use_container_width=True,
+                     help="Aktuelle Einheitspreise (ohne angewendeten Faktor) in die lokale Preis-Historie übernehmen"):
+            # History holds prices without markup, otherwise prefilled prices would be marked up again
+            base_prices = remove_price_factor(edited_df['unit_price'], st.session_state.price_factor)
+            added = get_price_index().add_many(zip(edited_df['description'], edited_df['unit'], base_prices))
+            st.toast(f"✅ Preis-Historie aktualisiert ({added} neue Positionen)")
+
     # Price multiplier with enhanced UI
     st.markdown("")
     st.markdown("**🔢 Preisanpassung - Alle Preise auf einmal ändern**")
@@ -1558,18 +4955,21 @@ if not st.session_state.calculation_df.empty:
     with col_mult3:
         st.markdown("<div style='margin-top: 28px;'>", unsafe_allow_html=True)
         if st.button("✅ Anwenden", use_container_width=True, type="primary"):
-            # Update unit_price directly (EP changes, GP recalculates automatically)
-            st.session_state.calculation_df['unit_price'] = st.session_state.calculation_df['unit_price'] * price_multiplier
-            st.session_state.price_factor = price_multiplier
-            st.success(f"✅ Faktor {price_multiplier} angewendet! EP wurde angepasst.")
+            # Update unit_price directly, each EP rounded to the cent (GP recalculates automatically)
+            factored_df = st.session_state.calculation_df.copy()
+            factored_df['unit_price'] = apply_price_factor(factored_df['unit_price'], price_multiplier)
+            replace_calculation_df(factored_df)
+            # Cumulative factor contained in the current EP (removed again for the price history)
+            st.session_state.price_factor = st.session_state.price_factor * price_multiplier
+            st.session_state.editor_version += 1
+            st.success(f"✅ Faktor {price_multiplier} angewendet! EP wurde angepasst (Gesamtfaktor {st.session_state.price_factor:.4g}).")
             st.rerun()
         st.markdown("</div>", unsafe_allow_html=True)
     
-    # Calculate totals (already calculated in edited_df above, just sum them)
-    
-    total_netto = edited_df["total_price"].sum()
-    total_mwst = total_netto * 0.19
-    total_brutto = total_netto * 1.19
+    # Calculate totals from the LV tree (only changed rows are propagated to the Titel subtotals)
+    st.session_state.lv_tree = calculation_derived("lv_tree", lambda: sync_lv_tree(st.session_state.lv_tree, edited_df))
+    lv_tree = st.session_state.lv_tree
+    total_netto, total_mwst, total_brutto = (cents / 100 for cents in offer_totals(lv_tree.total_cents))
     
     # Display totals
     st.markdown("")
@@ -1579,9 +4979,17 @@ if not st.session_state.calculation_df.empty:
     with col1:
         st.metric("💵 Summe Netto", f"{format_german_number(total_netto)} €", help="Gesamtsumme ohne Mehrwertsteuer")
     with col2:
-        st.metric("📊 MwSt. (19%)", f"{format_german_number(total_mwst)} €", help="Mehrwertsteuer 19%")
+        st.metric(f"📊 MwSt. ({VAT_RATE_PERCENT}%)", f"{format_german_number(total_mwst)} €", help=f"Mehrwertsteuer {VAT_RATE_PERCENT}%")
     with col3:
         st.metric("✅ Summe Brutto", f"{format_german_number(total_brutto)} €", delta=f"+{format_german_number(total_mwst)} €", help="Gesamtsumme inkl. MwSt.")
+
+    titel_summary = lv_tree.summary_df()
+    if not titel_summary.empty:
+        with st.expander(f"📑 Titel-Summen ({len(titel_summary)})", expanded=False):
+            if 'group' not in edited_df.columns or edited_df['group'].nunique() <= 1:
+                titel_summary = titel_summary.drop(columns=["Los/Blatt"])
+            titel_summary["Summe netto"] = titel_summary["Summe netto"].apply(lambda x: f"{format_german_number(x)} €")
+            st.dataframe(titel_summary, use_container_width=True, hide_index=True)
     
     st.markdown("---")
     
@@ -1784,98 +5192,14 @@ if not st.session_state.calculation_df.empty:
     with col1:
         # Excel Export with proper German number formatting
         # Prepare Excel data
-        excel_buffer = io.BytesIO()
-
-        # Prepare export dataframe with German-formatted text
-        export_df = edited_df[['pos', 'description', 'quantity', 'unit', 'unit_price']].copy()
-        # Calculate GP (Menge × EP)
-        export_df['total_price'] = edited_df['quantity'] * edited_df['unit_price']
-
-        # --- TOTALS CALCULATION ---
-        total_netto = export_df['total_price'].sum()
-        total_mwst = total_netto * 0.19
-        total_brutto = total_netto * 1.19
-        # --- END TOTALS CALCULATION ---
-
-        # Convert numeric columns to German-formatted text strings
-        export_df['quantity'] = export_df['quantity'].apply(lambda x: format_german_number(x, 2))
-        export_df['unit_price'] = export_df['unit_price'].apply(lambda x: format_german_number(x, 2))
-        export_df['total_price'] = export_df['total_price'].apply(lambda x: format_german_number(x, 2))
-
-        # Rename columns to German
-        export_df.columns = ['Pos.', 'Leistungsbezeichnung', 'Menge', 'Einheit', 'EP netto (€)', 'GP netto (€)']
-
-        # --- ADD TOTALS TO DATAFRAME ---
-        # Add an empty row for spacing
-        export_df.loc[len(export_df)] = [''] * len(export_df.columns)
-
-        # Add total rows
-        export_df.loc[len(export_df)] = ['', 'Angebotssumme netto:', '', '=', '', f'{format_german_number(total_netto)} € netto']
-        export_df.loc[len(export_df)] = ['', 'Mehrwertsteuer', 'zzgl. 19,0%', '=', '', f'{format_german_number(total_mwst)} €']
-        export_df.loc[len(export_df)] = ['', 'Angebotssumme brutto', '', '=', '', f'{format_german_number(total_brutto)} € brutto']
-        # --- END ADD TOTALS ---
-
-        # Write to Excel
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            export_df.to_excel(writer, index=False, sheet_name='Kalkulation')
-
-            # Get the worksheet for styling
-            worksheet = writer.sheets['Kalkulation']
-
-            # Clean up values and set as text
-            from openpyxl.styles import Alignment, Font, Border, Side
-            from openpyxl.cell.cell import TYPE_STRING
-
-            # Style the data rows
-            for row in range(2, len(export_df) - 2): # Stop before the total rows
-                # Menge (column C/3)
-                cell_c = worksheet.cell(row=row, column=3)
-                clean_value_c = str(cell_c.value).lstrip("'") if cell_c.value else ""
-                cell_c.value = clean_value_c
-                cell_c.data_type = TYPE_STRING
-                cell_c.alignment = Alignment(horizontal='right')
-
-                # EP netto (column E/5)
-                cell_e = worksheet.cell(row=row, column=5)
-                clean_value_e = str(cell_e.value).lstrip("'") if cell_e.value else ""
-                cell_e.value = clean_value_e
-                cell_e.data_type = TYPE_STRING
-                cell_e.alignment = Alignment(horizontal='right')
-
-                # GP netto (column F/6)
-                cell_f = worksheet.cell(row=row, column=6)
-                clean_value_f = str(cell_f.value).lstrip("'") if cell_f.value else ""
-                cell_f.value = clean_value_f
-                cell_f.data_type = TYPE_STRING
-                cell_f.alignment = Alignment(horizontal='right')
-
-            # --- STYLE TOTALS ---
-            last_row = worksheet.max_row
-            brutto_row_index = last_row
-            netto_row_index = last_row - 2
-
-            thin_top_border = Border(top=Side(style='thin'))
-
-            # Style Netto row and add border
-            for col_idx in range(1, worksheet.max_column + 1):
-                cell = worksheet.cell(row=netto_row_index, column=col_idx)
-                cell.border = thin_top_border
-
-            # Style Brutto row (bold) and add border
-            for col_idx in range(1, worksheet.max_column + 1):
-                cell = worksheet.cell(row=brutto_row_index, column=col_idx)
-                cell.font = Font(bold=True)
-                cell.border = thin_top_border
-            # --- END STYLE TOTALS ---
-
-
-            # Adjust column widths
-            worksheet.column_dimensions['A'].width = 12
-            worksheet.column_dimensions['B'].width = 50
-            worksheet.column_dimensions['C'].width = 15
-            worksheet.column_dimensions['D'].width = 10 
-            worksheet.column_dimensions['E'].width = 18
-            worksheet.column_dimensions['F'].width = 20
+        # Streamed workbook, rebuilt only when positions or Titel structure changed
+        export_key = ("xlsx", calculation_derived("content_hash", lambda: calculation_content_hash(edited_df)))
+        if st.session_state.get("excel_export_key") != export_key:
+            with metrics_span("export", format="xlsx") as export_span:
+                export_span["rows"] = len(edited_df)
+                st.session_state.excel_export = write_offer_excel(edited_df, lv_tree)
+            st.session_state.excel_export_key = export_key
+        excel_buffer = io.BytesIO(st.session_state.excel_export)
 
         # Sanitize filename
         safe_filename = sanitize_filename(export_filename_base)
@@ -1928,12 +5252,17 @@ if not st.session_state.calculation_df.empty:
         # Prepare PDF data
         with st.spinner("Erstelle PDF..."):
             try:
-                # Prepare dataframe for PDF with calculated total prices
-                pdf_df = edited_df.copy()
-                pdf_df['total_price'] = pdf_df['quantity'] * pdf_df['unit_price']
-
-                # Generate PDF
-                pdf_bytes = generate_offer_pdf(pdf_df, export_filename_base)
+                # GP are computed by the PDF writer with the cent engine
+                pdf_df = edited_df
+
+                # Generate PDF (only when positions, project name or date changed)
+                export_key = ("pdf", calculation_derived("content_hash", lambda: calculation_content_hash(pdf_df)), export_filename_base, datetime.now().strftime('%Y%m%d'))
+                if st.session_state.get("pdf_export_key") != export_key:
+                    with metrics_span("export", format="pdf") as export_span:
+                        export_span["rows"] = len(pdf_df)
+                        st.session_state.pdf_export = generate_offer_pdf(pdf_df, export_filename_base, lv_tree=lv_tree)
+                    st.session_state.pdf_export_key = export_key
+                pdf_bytes = st.session_state.pdf_export
 
                 # Sanitize filename
                 safe_filename = sanitize_filename(export_filename_base)
@@ -1991,6 +5320,44 @@ if not st.session_state.calculation_df.empty:
                 except Exception as e:
                     st.error(f"❌ PDF-Fehler: {str(e)}")
 
+    # GAEB bid (X84) in the structure of the uploaded X83
+    gaeb_source = st.session_state.gaeb_source
+    if gaeb_source is not None:
+        st.markdown("")
+        export_key = ("x84", calculation_derived("content_hash", lambda: calculation_content_hash(edited_df)), gaeb_source["name"])
+        if st.session_state.get("gaeb_export_key") != export_key:
+            try:
+                with metrics_span("export", format="x84") as export_span:
+                    gaeb_buffer = io.BytesIO()
+                    gaeb_result = write_gaeb_x84(io.BytesIO(gaeb_source["data"]), edited_df, gaeb_buffer)
+                    gaeb_result.update(verify_gaeb_roundtrip(io.BytesIO(gaeb_source["data"]), io.BytesIO(gaeb_buffer.getvalue())))
+                    export_span["rows"] = gaeb_result["items"]
+                st.session_state.gaeb_export = (gaeb_buffer.getvalue(), gaeb_result)
+            except Exception as e:
+                st.session_state.gaeb_export = (None, {"error": str(e)})
+            st.session_state.gaeb_export_key = export_key
+        gaeb_bytes, gaeb_result = st.session_state.gaeb_export
+
+        if gaeb_bytes is None:
+            st.error(f"❌ GAEB-Fehler: {gaeb_result['error']}")
+        else:
+            col_gaeb1, col_gaeb2 = st.columns([1, 1])
+            with col_gaeb1:
+                st.download_button(
+                    label="📤 GAEB X84 (Angebotsabgabe) herunterladen",
+                    data=gaeb_bytes,
+                    file_name=f"Angebot_{sanitize_filename(export_filename_base)}_{datetime.now().strftime('%Y%m%d')}.X84",
+                    mime="application/xml",
+                    use_container_width=True,
+                    key="download_x84"
+                )
+            with col_gaeb2:
+                if gaeb_result["ok"]:
+                    st.caption(f"✓ Struktur des X83 erhalten ({gaeb_result['elements']} Elemente geprüft). "
+                               f"{gaeb_result['priced']} von {gaeb_result['items']} Positionen mit Preis.")
+                else:
+                    st.warning(f"⚠️ Struktur weicht vom X83 ab: {gaeb_result['difference']}")
+
 else:
     st.markdown("""
     <div style='text-align: center; padding: 40px; background-color: #f9fafb; border-radius: 10px; margin: 20px 0;'>
@@ -2002,6 +5369,83 @@ else:
     </div>
     """, unsafe_allow_html=True)
 
+# Sidebar: AI budget and runtime metrics (Prometheus text + JSONL trace log on disk)
+with st.sidebar:
+    with st.expander("💶 KI-Budget", expanded=False):
+        st.number_input(
+            "Budget pro Dokument (USD, 0 = unbegrenzt):",
+            min_value=0.0,
+            step=0.05,
+            format="%.2f",
+            key="document_budget",
+            help="Ab 80% werden nur günstigere Modelle genutzt und optionale KI-Aufrufe übersprungen"
+        )
+        spent_today = get_cost_ledger().spent_today()
+        if BUDGET_PER_DAY_USD > 0:
+            st.progress(min(spent_today / BUDGET_PER_DAY_USD, 1.0),
+                        text=f"Heute: {spent_today:.2f} / {BUDGET_PER_DAY_USD:.2f} USD")
+        else:
+            st.caption(f"Heute verbraucht: {spent_today:.4f} USD (kein Tageslimit)")
+
+    with st.expander("📈 Laufzeit-Metriken", expanded=False):
+        flush_metrics()
+        metrics_text = get_metrics_registry().to_prometheus_text()
+        st.caption(f"Prometheus-Datei: `{PROMETHEUS_FILE}`  \nTrace-Log: `{TRACE_LOG_FILE}`")
+        st.code(metrics_text if metrics_text.strip() else "# Noch keine Messwerte", language="text")
+        st.download_button(
+            label="⬇️ Metriken herunterladen",
+            data=metrics_text,
+            file_name="kalkulation.prom",
+            mime="text/plain",
+            use_container_width=True,
+            key="download_metrics"
+        )
+        if st.button("⏱️ Excel-Export messen (10.000 Zeilen)", use_container_width=True, key="benchmark_excel"):
+            with st.spinner("Erstelle Test-Export..."):
+                result = benchmark_excel_export(10000)
+            st.caption(f"{result['rows']} Zeilen: {result['seconds']:.2f} s, Speicher-Spitze {result['peak_mb']:.1f} MB, "
+                       f"Datei {result['size_kb']:.0f} KB")
+        if st.button("⏱️ Cent-Rechnung messen (100.000 Zeilen)", use_container_width=True, key="benchmark_money"):
+            with st.spinner("Rechne Test-LV..."):
+                result = benchmark_money_engine(100000)
+            st.caption(f"{result['rows']} Zeilen, Faktor 10× angewendet:  \n"
+                       f"Cent: Faktor {result['cents_factor_seconds'] * 1000:.0f} ms, Summen {result['cents_totals_seconds'] * 1000:.0f} ms, "
+                       f"Differenz Σ GP zu Netto {result['cents_gap_cents']} ct  \n"
+                       f"Float: Faktor {result['float_factor_seconds'] * 1000:.0f} ms, Summen {result['float_totals_seconds'] * 1000:.0f} ms, "
+                       f"Differenz Σ GP zu Netto {result['float_gap_cents']} ct")
+
+    with st.expander("🚦 KI-Warteschlange", expanded=False):
+        admission = get_admission_controller().status(st.session_state.session_id)
+        col_q1, col_q2 = st.columns(2)
+        with col_q1:
+            st.metric("Aktive Aufrufe", f"{admission['active']} / {admission['limit']}",
+                      help=f"Gleichzeitige KI-Aufrufe aller Sitzungen (Maximum {admission['max']}; sinkt bei 429/503)")
+        with col_q2:
+            st.metric("Wartend", admission['waiting'], help="KI-Aufrufe in der Warteschlange (alle Sitzungen)")
+        st.caption(f"Diese Sitzung: {admission['session_active']} aktiv, {admission['session_waiting']} wartend  \n"
+                   f"Wartezeit (letzte Aufrufe): Median {admission['wait_p50']:.1f} s, max. {admission['wait_max']:.1f} s  \n"
+                   f"Sitzungen mit KI-Aufrufen: {admission['sessions']}")
+
+    with st.expander("♻️ Antwort-Cache", expanded=False):
+        cache_stats = get_response_cache().stats()
+        st.caption(f"{cache_stats['entries']} Antworten, {cache_stats['bytes'] / 1024:.0f} KB  \n"
+                   f"Treffer seit Start: {cache_stats['hits']} von {cache_stats['hits'] + cache_stats['misses']} Anfragen  \n"
+                   f"Modus: `{AI_MODE}`" + (f" (Fixtures: `{AI_FIXTURE_DIR}`)" if AI_MODE != "live" else ""))
+        if not RESPONSE_CACHE_ENABLED:
+            st.caption("Cache deaktiviert (KALKULATION_RESPONSE_CACHE=0)")
+        if st.button("🗑️ Cache leeren", use_container_width=True, key="clear_response_cache"):
+            get_response_cache().clear()
+            st.rerun()
+
+    with st.expander("🧠 Speicher (Sitzung)", expanded=False):
+        memory_report = st.session_state.calculation_memory or calculation_memory_report(st.session_state.calculation_df)
+        st.caption(f"Kalkulationstabelle: {memory_report['rows']} Zeilen, "
+                   f"{memory_report['total_bytes'] / 1024:.0f} KB (Texte davon einmalig: {memory_report['distinct_text_bytes'] / 1024:.0f} KB)")
+        st.dataframe(
+            pd.DataFrame([{"Spalte": col, "KB": round(size / 1024, 1)} for col, size in memory_report["columns"].items()]),
+            use_container_width=True, hide_index=True
+        )
+
 # Footer with enhanced styling
 st.markdown("---")
 st.markdown(f"""
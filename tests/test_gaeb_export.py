@@ -0,0 +1,134 @@
+"""Round trip X83 -> X84: structure, texts and UP/IT of the written bid"""
+import io
+import os
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+import pytest
+
+# app.py runs as a Streamlit script on import (bare mode): give it a key and a scratch data directory
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("KALKULATION_DATA_DIR", tempfile.mkdtemp(prefix="kalkulation-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+NS83 = "http://www.gaeb.de/GAEB_DA_XML/DA83/3.2"
+NS84 = "http://www.gaeb.de/GAEB_DA_XML/DA84/3.2"
+
+X83 = f"""<?xml version="1.0" encoding="utf-8"?>
+<GAEB xmlns="{NS83}">
+  <GAEBInfo><Version>3.2</Version></GAEBInfo>
+  <Award>
+    <DP>83</DP>
+    <BoQ ID="b1">
+      <BoQBody>
+        <BoQCtgy ID="c1" RNoPart="01">
+          <LblTx>Erdarbeiten</LblTx>
+          <BoQBody>
+            <BoQCtgy ID="c2" RNoPart="02">
+              <LblTx>Aushub</LblTx>
+              <BoQBody>
+                <Itemlist>
+                  <Item ID="i1" RNoPart="0010">
+                    <Qty>12.500</Qty>
+                    <QU>m3</QU>
+                    <Description><CompleteText><OutlineText><OutlTxt><TextOutlTxt><span>Boden ausheben, Klasse 3-5</span></TextOutlTxt></OutlTxt></OutlineText></CompleteText></Description>
+                  </Item>
+                  <Item ID="i2" RNoPart="0020">
+                    <Qty>3</Qty>
+                    <QU>St</QU>
+                    <Description><CompleteText><OutlineText><OutlTxt><TextOutlTxt><span>Schacht herstellen</span></TextOutlTxt></OutlTxt></OutlineText></CompleteText></Description>
+                  </Item>
+                </Itemlist>
+              </BoQBody>
+            </BoQCtgy>
+          </BoQBody>
+        </BoQCtgy>
+      </BoQBody>
+    </BoQ>
+  </Award>
+</GAEB>
+""".encode("utf-8")
+
+# 01.02.0010 is priced (EP 45,67 €), 01.02.0020 has no price and stays as in the X83
+PRICES = pd.DataFrame({
+    "pos": ["01.02.0010", "01.02.0020"],
+    "description": ["Boden ausheben, Klasse 3-5", "Schacht herstellen"],
+    "quantity": [12.5, 3.0],
+    "unit": ["m3", "St"],
+    "unit_price": [45.67, None],
+})
+
+
+@pytest.fixture
+def x84():
+    output = io.BytesIO()
+    result = app.write_gaeb_x84(io.BytesIO(X83), PRICES, output)
+    return result, output.getvalue()
+
+
+def _items(root, ns):
+    return {item.get("RNoPart"): item for item in root.iter(f"{{{ns}}}Item")}
+
+
+def _texts(root, ns):
+    return [(element.tag.split("}")[-1], (element.text or "").strip(), element.get("RNoPart"))
+            for element in root.iter()
+            if element.tag.split("}")[-1] not in app.GAEB_ITEM_PRICE_TAGS]
+
+
+def test_counts_items_and_priced(x84):
+    result, _ = x84
+    assert result == {"items": 2, "priced": 1}
+
+
+def test_data_phase_and_namespace(x84):
+    _, data = x84
+    root = ET.fromstring(data)
+    assert root.tag == f"{{{NS84}}}GAEB"
+    assert root.find(f"{{{NS84}}}Award/{{{NS84}}}DP").text == "84"
+    assert NS83.encode() not in data
+
+
+def test_oz_hierarchy_and_texts_unchanged(x84):
+    _, data = x84
+    source = _texts(ET.fromstring(X83), NS83)
+    written = _texts(ET.fromstring(data), NS84)
+    assert [(tag, rno) for tag, _, rno in written] == [(tag, rno) for tag, _, rno in source]
+    assert [text for tag, text, _ in written if tag != "DP"] == [text for tag, text, _ in source if tag != "DP"]
+
+
+def test_prices_in_cents_after_quantity_unit(x84):
+    _, data = x84
+    item = _items(ET.fromstring(data), NS84)["0010"]
+    assert [child.tag.split("}")[-1] for child in item] == ["Qty", "QU", "UP", "IT", "Description"]
+    assert item.find(f"{{{NS84}}}UP").text == "45.67"
+    assert item.find(f"{{{NS84}}}IT").text == "570.88"  # 12,5 x 45,67 = 570,875 -> rounded half up
+
+
+def test_unpriced_item_untouched(x84):
+    _, data = x84
+    written = _items(ET.fromstring(data), NS84)["0020"]
+    source = _items(ET.fromstring(X83), NS83)["0020"]
+    assert [child.tag.split("}")[-1] for child in written] == [child.tag.split("}")[-1] for child in source]
+    assert written.find(f"{{{NS84}}}Qty").text == "3"
+
+
+def test_roundtrip_check_accepts_output(x84):
+    _, data = x84
+    assert app.verify_gaeb_roundtrip(io.BytesIO(X83), io.BytesIO(data))["ok"]
+
+
+def test_roundtrip_check_rejects_prices_after_description(x84):
+    _, data = x84
+    misplaced = data.replace(b"<UP>45.67</UP><IT>570.88</IT>", b"")
+    misplaced = misplaced.replace(b"Klasse 3-5</span></TextOutlTxt></OutlTxt></OutlineText></CompleteText></Description>",
+                                  b"Klasse 3-5</span></TextOutlTxt></OutlTxt></OutlineText></CompleteText></Description>"
+                                  b"<UP>45.67</UP><IT>570.88</IT>")
+    assert misplaced != data
+    result = app.verify_gaeb_roundtrip(io.BytesIO(X83), io.BytesIO(misplaced))
+    assert not result["ok"]
+    assert result["difference"][1][0] == "UP nach Description"